@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from main import get_logger
+from analysis_cache import file_digest
+
+batch_logger = get_logger()
+
+# Same layout xfi.sh uses
+rewrite_path = Path(__file__).resolve().parent
+current_path = rewrite_path.parent
+input_path = current_path / "input"
+result_path = current_path / "result"
+
+home_dir = Path.home()
+coreutils_build_path = home_dir / "coreutils_xfi"
+musl_gcc = home_dir / "XFI" / "musl_build" / "bin" / "musl-gcc"
+
+STATE_FILE = ".batch_state.json"
+
+class StepFailed(Exception):
+    pass
+
+@dataclass
+class Job:
+    name: str
+    kind: str
+    action: object                  # callable(job, log_file)
+    deps: list = field(default_factory=list)
+    inputs: list = field(default_factory=list)
+    status: str = "pending"         # pending / running / ok / failed / skipped / cached
+    seconds: float = 0.0
+    error: str = None
+    output: str = None              # Digest of the file the step produced, if any
+
+    # Inputs are fingerprinted by content so a resumed run notices edited files
+    def fingerprint(self):
+        parts = []
+        for path in self.inputs:
+            try:
+                parts.append(f"{path}:{file_digest(path)}")
+            except FileNotFoundError:
+                parts.append(f"{path}:missing")
+        return "|".join(parts)
+
+def run_command(command, log_file, cwd=None, env=None):
+    log_file.write(f"$ {' '.join(str(c) for c in command)}\n")
+    log_file.flush()
+    result = subprocess.run([str(c) for c in command], cwd=cwd, env=env,
+                            stdout=log_file, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        raise StepFailed(f"{Path(str(command[0])).name} exited with {result.returncode}")
+
+class BatchBuilder:
+    def __init__(self, args):
+        self.coreutils = Path(args.coreutils)
+        self.coreutils_src = self.coreutils / "src"
+        self.musl_gcc = Path(args.musl_gcc)
+        self.result = Path(args.result)
+        self.rewrite_args = args.rewrite_args
+        # client.py runs the rewrites in the daemon (main.py --serve) when one is running
+        self.rewrite_script = "client.py" if args.rewrite_daemon else "main.py"
+        self.jobs = {}
+        self.state_path = self.result / STATE_FILE
+        self.state = {}
+        self.state_lock = threading.Lock()
+
+    def add(self, job):
+        self.jobs[job.name] = job
+        return job
+
+    # ---- Steps (mirroring the coreutils() path of xfi.sh) ---- #
+
+    def stage(self, util):
+        def action(job, log_file):
+            util_dir = self.result / util
+            util_dir.mkdir(parents=True, exist_ok=True)
+            src = self.coreutils_src
+            if not (src / f"{util}.s").is_file():
+                raise StepFailed(f"No assembly file {src / f'{util}.s'}")
+            default_bin = src / f"{util}_def.out"
+            if not default_bin.is_file():
+                shutil.copy2(src / util, default_bin)  # Create a default copy of bin file
+            for name in (f"{util}_def.out", f"{util}.s"):
+                shutil.copy2(src / name, util_dir / name)
+            # After a previous batch src/<util>.o is our own instrumented object; keep the staged original then
+            assembled = self.state.get(f"{util}:assemble", {}).get("output")
+            if not (util_dir / f"{util}.o").is_file() or file_digest(src / f"{util}.o") != assembled:
+                shutil.copy2(src / f"{util}.o", util_dir / f"{util}.o")
+            shutil.copy2(src / f"{util}.s", src / f"{util}.s.bak")
+            bak = util_dir / f"{util}.s.bak"
+            if bak.is_file():
+                log_file.write("Backup file exists. Restoring it to the original assembly file.\n")
+                shutil.copy2(bak, util_dir / f"{util}.s")
+            else:
+                shutil.copy2(src / f"{util}.s.bak", bak)
+        return self.add(Job(f"{util}:stage", "stage", action, inputs=[self.coreutils_src / f"{util}.s"]))
+
+    def rewrite(self, util, deps):
+        util_dir = self.result / util
+        def action(job, log_file):
+            # Always start from the original assembly, as the rewrite option of xfi.sh does
+            bak = util_dir / f"{util}.s.bak"
+            if bak.is_file():
+                shutil.copy2(bak, util_dir / f"{util}.s")
+            command = [sys.executable, rewrite_path / self.rewrite_script, "--input", util, "--result-dir", self.result,
+                       *self.rewrite_args]
+            run_command(command, log_file, cwd=rewrite_path)
+        return self.add(Job(f"{util}:rewrite", "rewrite", action, deps,
+                            inputs=[util_dir / f"{util}.s.bak", util_dir / f"{util}.o"]))
+
+    def assemble(self, util, deps):
+        util_dir = self.result / util
+        def action(job, log_file):
+            run_command(["as", "-o", self.coreutils_src / f"{util}.o", util_dir / f"{util}.s"], log_file)
+            job.output = file_digest(self.coreutils_src / f"{util}.o")
+        return self.add(Job(f"{util}:assemble", "assemble", action, deps, inputs=[util_dir / f"{util}.s"]))
+
+    def link(self, util, deps):
+        def action(job, log_file):
+            env = dict(os.environ, CC=str(self.musl_gcc))
+            run_command(["make", f"src/{util}", "V=1"], log_file, cwd=self.coreutils, env=env)
+        return self.add(Job(f"{util}:link", "link", action, deps, inputs=[self.coreutils_src / f"{util}.o"]))
+
+    # xfi.so is the same for every utility, so it is built once and shared by all links
+    def xfi_lib(self):
+        lib_dir = self.result / "_xfi"
+        def action(job, log_file):
+            lib_dir.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(input_path / "xfi.c", lib_dir / "xfi.c")
+            shutil.copy2(input_path / "scripts" / "libMakefile", lib_dir / "Makefile")
+            env = dict(os.environ, PWD=str(lib_dir))
+            run_command(["make", "xfi"], log_file, cwd=lib_dir, env=env)
+            shutil.copytree(lib_dir / "lib", self.coreutils_src / "lib", dirs_exist_ok=True)
+        return self.add(Job("xfi:lib", "lib", action,
+                            inputs=[input_path / "xfi.c", input_path / "scripts" / "libMakefile"]))
+
+    def build_graph(self, utils):
+        lib = self.xfi_lib()
+        for util in utils:
+            stage = self.stage(util)
+            rewrite = self.rewrite(util, [stage.name])
+            assemble = self.assemble(util, [rewrite.name])
+            self.link(util, [assemble.name, lib.name])
+
+    # ---- Resumable state ---- #
+
+    def load_state(self):
+        try:
+            self.state = json.loads(self.state_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = {}
+
+    def save_state(self):
+        with self.state_lock:
+            self.result.mkdir(parents=True, exist_ok=True)
+            temp_path = self.state_path.with_suffix('.tmp')
+            temp_path.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+            os.replace(temp_path, self.state_path)
+
+    def up_to_date(self, job, rerun):
+        if any(dep in rerun for dep in job.deps):
+            return False
+        previous = self.state.get(job.name)
+        return previous is not None and previous.get("status") == "ok" and previous.get("fingerprint") == job.fingerprint()
+
+    # ---- Scheduler ---- #
+
+    def run_job(self, job):
+        log_dir = self.result / "_logs"
+        log_dir.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        with open(log_dir / f"{job.name.replace(':', '.')}.log", 'w') as log_file:
+            try:
+                job.action(job, log_file)
+                job.status = "ok"
+            except (StepFailed, OSError) as e:
+                job.status = "failed"
+                job.error = str(e)
+                log_file.write(f"FAILED: {e}\n")
+        job.seconds = time.perf_counter() - start
+        return job
+
+    def run(self, jobs, link_jobs, resume):
+        self.load_state()
+        limits = {"link": threading.Semaphore(link_jobs)}
+        rerun = set()   # jobs executed in this session; their dependents must run again
+        pending = dict(self.jobs)
+        running = {}
+
+        def run_limited(job):
+            limit = limits.get(job.kind)
+            if limit is None:
+                return self.run_job(job)
+            with limit:
+                return self.run_job(job)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                progressed = False
+                for name, job in list(pending.items()):
+                    dep_status = [self.jobs[dep].status for dep in job.deps]
+                    if any(status in ("failed", "skipped") for status in dep_status):
+                        job.status = "skipped"
+                        job.error = "dependency failed"
+                    elif all(status in ("ok", "cached") for status in dep_status):
+                        if resume and self.up_to_date(job, rerun):
+                            job.status = "cached"
+                        else:
+                            job.status = "running"
+                            rerun.add(name)
+                            batch_logger.info(f"Starting {name}")
+                            running[executor.submit(run_limited, job)] = job
+                    else:
+                        continue
+                    del pending[name]
+                    progressed = True
+                if not running:
+                    if not progressed:
+                        raise RuntimeError(f"Unsatisfiable dependencies: {sorted(pending)}")
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    future.result()
+                    if job.status == "ok":
+                        batch_logger.info(f"Finished {job.name} in {job.seconds:.2f}s")
+                        self.state[job.name] = {"status": "ok", "fingerprint": job.fingerprint(),
+                                                "seconds": job.seconds, "output": job.output}
+                    else:
+                        batch_logger.error(f"{job.name} failed: {job.error}")
+                        self.state.pop(job.name, None)
+                    self.save_state()
+
+    def summary(self, utils):
+        kinds = ["stage", "rewrite", "assemble", "link"]
+        batch_logger.info(f"{'utility':<16}" + "".join(f"{kind:>18}" for kind in kinds))
+        failed = [job for job in self.jobs.values() if job.status in ("failed", "skipped")]
+        for util in utils:
+            cells = []
+            for kind in kinds:
+                job = self.jobs[f"{util}:{kind}"]
+                cells.append(f"{job.status}" + (f" {job.seconds:.2f}s" if job.status == "ok" else ""))
+            batch_logger.info(f"{util:<16}" + "".join(f"{cell:>18}" for cell in cells))
+        lib = self.jobs["xfi:lib"]
+        batch_logger.info(f"xfi.so: {lib.status}" + (f" ({lib.error})" if lib.error else ""))
+        for job in failed:
+            if job.status == "failed":
+                batch_logger.error(f"{job.name}: {job.error}")
+        return 1 if failed else 0
+
+def discover_utils(coreutils_src):
+    return sorted(path.stem for path in coreutils_src.glob("*.s")
+                  if (coreutils_src / f"{path.stem}.o").is_file() and (coreutils_src / path.stem).is_file())
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite, assemble and link many coreutils programs under XFI.')
+    parser.add_argument('utils', nargs='*', help='Utilities to build (e.g. ls cat wc)')
+    parser.add_argument('--all', action='store_true', help='Build every utility with a .s/.o pair in the coreutils src directory')
+    parser.add_argument('--list', type=str, help='File with one utility name per line', default=None)
+    parser.add_argument('--jobs', '-j', type=int, help='Number of steps to run concurrently', default=os.cpu_count())
+    parser.add_argument('--link-jobs', type=int, help='Number of concurrent make invocations in the coreutils tree', default=1)
+    parser.add_argument('--coreutils', type=str, help='Coreutils build directory', default=str(coreutils_build_path))
+    parser.add_argument('--musl-gcc', type=str, help='musl-gcc used for linking', default=str(musl_gcc))
+    parser.add_argument('--result', type=str, help='Result directory', default=str(result_path))
+    parser.add_argument('--resume', action='store_true', help='Skip steps that succeeded in the previous run and whose inputs are unchanged')
+    parser.add_argument('--rewrite-daemon', action='store_true', help='Rewrite through client.py, served by a running main.py --serve')
+    parser.add_argument('--rewrite-args', nargs=argparse.REMAINDER, help='Extra arguments passed to main.py', default=[])
+    args = parser.parse_args()
+
+    utils = list(args.utils)
+    if args.list:
+        utils += [line.strip() for line in Path(args.list).read_text().splitlines() if line.strip()]
+    if args.all:
+        utils += discover_utils(Path(args.coreutils) / "src")
+    utils = list(dict.fromkeys(utils))
+    if not utils:
+        parser.error("No utilities given")
+
+    builder = BatchBuilder(args)
+    builder.build_graph(utils)
+    start = time.perf_counter()
+    builder.run(max(args.jobs, 1), max(args.link_jobs, 1), args.resume)
+    batch_logger.info(f"Batch finished in {time.perf_counter() - start:.2f}s")
+    sys.exit(builder.summary(utils))
+
+if __name__ == '__main__':
+    main()
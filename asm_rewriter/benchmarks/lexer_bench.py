@@ -0,0 +1,45 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+
+from asm_analysis import parse_assembly_line, parse_assembly_line_regex
+
+# Throughput of the line lexer against the reference regex parser, in lines/sec.
+# Lines are stripped first, as parse_assembly_file does.
+
+def time_parser(parser, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parser(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parse_assembly_line against the regex implementation.')
+    parser.add_argument('files', nargs='+', help='Assembly files to parse')
+    parser.add_argument('--repeat', type=int, help='Runs per parser (the best one is reported)', default=3)
+    args = parser.parse_args()
+
+    lines = []
+    for path in args.files:
+        with open(path, 'r') as file:
+            lines.extend(line.strip() for line in file)
+
+    mismatches = sum(1 for line in lines if parse_assembly_line(line) != parse_assembly_line_regex(line))
+
+    regex_time = time_parser(parse_assembly_line_regex, lines, args.repeat)
+    lexer_time = time_parser(parse_assembly_line, lines, args.repeat)
+    print(f"lines:   {len(lines)}")
+    print(f"regex:   {len(lines) / regex_time:12.0f} lines/sec")
+    print(f"lexer:   {len(lines) / lexer_time:12.0f} lines/sec")
+    print(f"speedup: {regex_time / lexer_time:.2f}x")
+    print(f"results differing from the regex parser: {mismatches}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, replace
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+
+import main
+from asm_analysis import parse_assembly_file, asm_analysis, StreamingPlan, body_line_table
+from liveness import flow_table
+from rewriter import rewriter
+from synth_asm import SynthConfig, write, stub_symbols
+
+# Offline throughput benchmark of the three rewriter stages on synthetic input.
+# Every scale runs parse_assembly_file, asm_analysis and rewriter separately and
+# reports lines/sec and peak traced memory; the stream stage runs analysis and
+# rewriting together through a StreamingPlan, whose peak memory should not grow
+# with the scale. Results are compared against a
+# baseline file with three kinds of thresholds:
+#  - absolute: lines/sec may drop and peak memory may grow by a fraction of the
+#    baseline (machine dependent, regenerate the baseline with --update-baseline)
+#  - scaling: lines/sec at the largest scale divided by lines/sec at the
+#    smallest; superlinear work per line (e.g. quadratic symbol matching) shows
+#    up here on any machine
+#  - stream memory: growth of the stream peak memory from the smallest to the
+#    largest scale, as a fraction of the growth of the analysis (whole file)
+#    peak; holding the plan of the whole file makes it 1 or more
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+DEFAULT_SCALES = (25, 100, 400)  # Functions per file
+DEFAULT_THRESHOLDS = {"throughput": 0.30, "memory": 0.30, "scaling": 0.60, "stream_memory": 0.10}
+
+stages = ('parse', 'analysis', 'rewrite', 'stream')
+
+def run_stage(stage, asm_path, symbols):
+    if stage == 'parse':
+        parse_assembly_file(asm_path)
+        return None
+    if stage == 'analysis':
+        return asm_analysis(asm_path, symbols)
+    raise ValueError(stage)
+
+# Times one stage (best of repeat) and measures its peak memory in a separate
+# traced run, since tracemalloc slows the code down considerably. The traced run
+# starts with empty memo tables, which the earlier stages would otherwise have
+# filled outside of the trace.
+def measure(stage, source, workdir, symbols, repeat):
+    asm_path = workdir / 'synth.s'
+    plan = None
+    if stage == 'rewrite':
+        shutil.copyfile(source, asm_path)
+        plan = asm_analysis(asm_path, symbols)
+
+    def once():
+        # The rewriter works in place, so it always gets a fresh copy
+        shutil.copyfile(source, asm_path)
+        start = time.perf_counter()
+        if stage == 'rewrite':
+            rewriter(asm_path, plan)
+        elif stage == 'stream':
+            rewriter(asm_path, StreamingPlan(asm_path, symbols))
+        else:
+            run_stage(stage, asm_path, symbols)
+        return time.perf_counter() - start
+
+    best = min(once() for _ in range(repeat))
+    body_line_table.clear()
+    flow_table.clear()
+    tracemalloc.start()
+    try:
+        once()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def run(config, scales, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        for functions in scales:
+            scale_config = replace(config, functions=functions)
+            source = workdir / f"synth_{functions}.s"
+            lines = write(scale_config, source)
+            symbols = stub_symbols(scale_config)
+            entry = {"lines": lines}
+            for stage in stages:
+                seconds, peak = measure(stage, source, workdir, symbols, repeat)
+                entry[stage] = {"seconds": round(seconds, 6), "lines_per_sec": round(lines / seconds),
+                                "peak_kb": peak // 1024}
+            results[str(functions)] = entry
+    return results
+
+def print_results(results):
+    print(f"{'functions':>10} {'lines':>9} " + " ".join(f"{stage + ' l/s':>14} {'peak KB':>9}" for stage in stages))
+    for functions, entry in results.items():
+        print(f"{functions:>10} {entry['lines']:>9} " +
+              " ".join(f"{entry[stage]['lines_per_sec']:>14} {entry[stage]['peak_kb']:>9}" for stage in stages))
+
+def scaling(results):
+    scales = list(results)
+    first, last = results[scales[0]], results[scales[-1]]
+    return {stage: last[stage]['lines_per_sec'] / first[stage]['lines_per_sec'] for stage in stages}
+
+def stream_memory(results):
+    scales = list(results)
+    first, last = results[scales[0]], results[scales[-1]]
+    return ((last['stream']['peak_kb'] - first['stream']['peak_kb'])
+            / max(last['analysis']['peak_kb'] - first['analysis']['peak_kb'], 1))
+
+# Returns the list of regressions against the baseline (empty if none)
+def compare(results, baseline):
+    thresholds = {**DEFAULT_THRESHOLDS, **baseline.get("thresholds", {})}
+    regressions = []
+    for functions, entry in results.items():
+        reference = baseline["results"].get(functions)
+        if reference is None:
+            continue
+        for stage in stages:
+            if stage not in reference: # Recorded before the stage existed
+                continue
+            now, then = entry[stage], reference[stage]
+            if now['lines_per_sec'] < then['lines_per_sec'] * (1 - thresholds["throughput"]):
+                regressions.append(f"{stage} @ {functions} functions: {now['lines_per_sec']} lines/sec, baseline {then['lines_per_sec']}")
+            if now['peak_kb'] > then['peak_kb'] * (1 + thresholds["memory"]):
+                regressions.append(f"{stage} @ {functions} functions: peak {now['peak_kb']} KB, baseline {then['peak_kb']} KB")
+    if len(results) > 1:
+        for stage, ratio in scaling(results).items():
+            if ratio < thresholds["scaling"]:
+                regressions.append(f"{stage}: throughput at the largest scale is {ratio:.2f}x the smallest (minimum {thresholds['scaling']})")
+        growth = stream_memory(results)
+        if growth > thresholds["stream_memory"]:
+            regressions.append(f"stream: peak memory grows {growth:.2f}x as much as the analysis peak (maximum {thresholds['stream_memory']})")
+    return regressions
+
+def main_bench():
+    parser = argparse.ArgumentParser(description='Benchmark the rewriter stages on synthetic assembly.')
+    parser.add_argument('--scales', type=int, nargs='+', help='Function counts to generate', default=list(DEFAULT_SCALES))
+    parser.add_argument('--repeat', type=int, help='Timed runs per stage (the best one is kept)', default=3)
+    parser.add_argument('--baseline', type=str, help='Baseline results file', default=str(DEFAULT_BASELINE))
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--output', type=str, help='Also write the results to this JSON file', default=None)
+    for name, default in asdict(SynthConfig()).items():
+        if name != 'functions':
+            parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    main.configure_logging(logging.WARNING)
+    config = SynthConfig(**{name: getattr(args, name) for name in asdict(SynthConfig()) if name != 'functions'})
+    results = run(config, sorted(args.scales), args.repeat)
+    print_results(results)
+
+    report = {"python": platform.python_version(), "machine": platform.machine(),
+              "config": asdict(config), "thresholds": DEFAULT_THRESHOLDS, "results": results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        if baseline_path.exists():
+            # Keep hand-tuned thresholds
+            report["thresholds"] = {**DEFAULT_THRESHOLDS, **json.loads(baseline_path.read_text()).get("thresholds", {})}
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}; run with --update-baseline to create one")
+        return 0
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get("config") != asdict(config):
+        print("Warning: the baseline was recorded with a different generator configuration")
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if not regressions:
+        print("No regressions against the baseline")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main_bench())
@@ -0,0 +1,111 @@
+import argparse
+import random
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+
+from elf_reader import Symbol
+
+# Synthetic AT&T assembly in the shape gcc -S -g emits, so the rewriter can be
+# benchmarked without a real build. The densities are per-instruction
+# probabilities; whatever is left over becomes stack/register arithmetic and
+# local branches that the analysis has to parse but never patches.
+
+@dataclass(unsafe_hash=True)
+class SynthConfig:
+    functions: int = 100
+    instructions: int = 200      # Per function
+    globals: int = 64            # Data symbols the code refers to
+    extra_symbols: int = 0       # Symbols in the table that the code never uses
+    global_density: float = 0.2  # Loads/stores/leas of a global
+    movz_density: float = 0.05   # movz loads of a global
+    indirect_density: float = 0.02
+    ret_density: float = 0.01    # Early returns on top of the final ret
+    loc_density: float = 0.5     # .loc directives per instruction
+    seed: int = 0
+
+global_loads = ('movl\t{sym}(%rip), %eax', 'movq\t{sym}(%rip), %rax', 'movb\t{sym}(%rip), %al', 'movw\t{sym}(%rip), %ax')
+global_stores = ('movl\t%eax, {sym}(%rip)', 'movq\t%rdx, {sym}(%rip)', 'movb\t%al, {sym}(%rip)')
+global_leas = ('leaq\t{sym}(%rip), %rax', 'leaq\t{sym}+8(%rip), %rdx')
+movz_loads = ('movzbl\t{sym}(%rip), %eax', 'movzwl\t{sym}(%rip), %eax', 'movzwq\t{sym}(%rip), %rax')
+indirect_transfers = ('call\t*%rax', 'call\t*%rdx', 'jmp\t*%rax', 'call\t*8(%rbx)')
+local_insts = ('movl\t-4(%rbp), %eax', 'movl\t%eax, -8(%rbp)', 'addl\t$1, %eax', 'movq\t-24(%rbp), %rax',
+               'movq\t%rax, %rdi', 'subq\t$16, %rsp', 'cmpl\t$9, %eax', 'imull\t%edx, %eax', 'xorl\t%eax, %eax')
+
+def global_name(index):
+    return f"g_var{index}"
+
+def function_name(index):
+    return f"synth_fn{index}"
+
+def generate(config):
+    rng = random.Random(config.seed)
+    globals_ = [global_name(index) for index in range(config.globals)]
+    lines = ['\t.file\t"synth.c"', '\t.text', '.Ltext0:']
+    label = 0
+    loc = 1
+    for fn in range(config.functions):
+        name = function_name(fn)
+        lines += [f'\t.globl\t{name}', f'\t.type\t{name}, @function', f'{name}:', f'.LFB{fn}:',
+                  f'\t.loc 1 {loc} 0', '\t.cfi_startproc', '\tpushq\t%rbp', '\t.cfi_def_cfa_offset 16',
+                  '\tmovq\t%rsp, %rbp']
+        for _ in range(config.instructions):
+            if rng.random() < config.loc_density:
+                loc += 1
+                lines.append(f'\t.loc 1 {loc} 0')
+            roll = rng.random()
+            sym = rng.choice(globals_) if globals_ else 'g_none'
+            if roll < config.global_density:
+                lines.append('\t' + rng.choice(rng.choice((global_loads, global_stores, global_leas))).format(sym=sym))
+                continue
+            roll -= config.global_density
+            if roll < config.movz_density:
+                lines.append('\t' + rng.choice(movz_loads).format(sym=sym))
+                continue
+            roll -= config.movz_density
+            if roll < config.indirect_density:
+                lines.append('\t' + rng.choice(indirect_transfers))
+                continue
+            roll -= config.indirect_density
+            if roll < config.ret_density:
+                lines += ['\tpopq\t%rbp', '\tret']
+                continue
+            if rng.random() < 0.1:
+                lines += [f'\tjle\t.L{label}', f'\tcall\t{function_name(rng.randrange(config.functions))}', f'.L{label}:']
+                label += 1
+            else:
+                lines.append('\t' + rng.choice(local_insts))
+        lines += ['\tpopq\t%rbp', '\t.cfi_def_cfa 7, 8', '\tret', '\t.cfi_endproc', f'.LFE{fn}:',
+                  f'\t.size\t{name}, .-{name}']
+    lines.append('\t.data')
+    for sym in globals_:
+        lines += [f'\t.globl\t{sym}', '\t.align 8', f'\t.type\t{sym}, @object', f'\t.size\t{sym}, 16', f'{sym}:', '\t.zero\t16']
+    lines += ['\t.text', '.Letext0:', '\t.section\t.note.GNU-stack,"",@progbits', '']
+    return '\n'.join(lines)
+
+# Stub symbol provider: what a symbol backend would report for the generated
+# object, without having to assemble it
+def stub_symbols(config):
+    symbols = [Symbol(global_name(index), 0x1000 + 16 * index, 16, '.data') for index in range(config.globals)]
+    base = 0x1000 + 16 * config.globals
+    symbols += [Symbol(f"unused_sym{index}", base + 8 * index, 8, '.bss') for index in range(config.extra_symbols)]
+    return symbols
+
+def write(config, path):
+    text = generate(config)
+    Path(path).write_text(text)
+    return text.count('\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic assembly file for the rewriter benchmarks.')
+    parser.add_argument('output', help='Output .s file')
+    for name, default in vars(SynthConfig()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    config = SynthConfig(**{name: getattr(args, name) for name in vars(SynthConfig())})
+    print(f"{write(config, args.output)} lines written to {args.output}")
+
+if __name__ == '__main__':
+    main()
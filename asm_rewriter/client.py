@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+
+# Thin client of the rewriter daemon (main.py --serve): takes the arguments of
+# main.py, has the daemon run them and exits with the status of the run. It
+# only loads the standard library; the modules, the symbol backend and the
+# workers stay loaded in the daemon. Without a daemon on the socket, main.py
+# runs in this process instead.
+
+rewrite_path = Path(__file__).resolve().parent
+
+def default_socket():
+    path = os.environ.get("XFI_REWRITER_SOCKET")
+    if path:
+        return path
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, f"xfi-rewriter-{os.getuid()}.sock")
+
+# Runs argv in the daemon listening on path, copying its output as it comes
+def request(path, argv):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        message = {"argv": argv, "cwd": os.getcwd(), "color": sys.stderr.isatty()}
+        connection.sendall(json.dumps(message).encode() + b"\n")
+        with connection.makefile('r', encoding='utf-8') as replies:
+            for line in replies:
+                reply = json.loads(line)
+                if "exit" in reply:
+                    return reply["exit"]
+                for name, text in reply.items():
+                    stream = sys.stdout if name == "stdout" else sys.stderr
+                    stream.write(text)
+                    stream.flush()
+    print(f"client.py: the daemon on {path} closed the connection", file=sys.stderr)
+    return 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Run main.py in the rewriter daemon; every other argument goes to main.py.',
+                                     add_help=False, allow_abbrev=False)
+    parser.add_argument('--socket', type=str, help='Unix socket of the daemon', default=None)
+    parser.add_argument('--no-fallback', action='store_true', help='Fail instead of running main.py here when no daemon is running')
+    args, argv = parser.parse_known_args()
+    path = args.socket or default_socket()
+    try:
+        return request(path, argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if args.no_fallback:
+            print(f"client.py: no daemon on {path} (start one with main.py --serve)", file=sys.stderr)
+            return 1
+    os.execv(sys.executable, [sys.executable, str(rewrite_path / "main.py"), *argv])
+
+if __name__ == '__main__':
+    sys.exit(main())
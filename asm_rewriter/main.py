@@ -2,8 +2,21 @@ import logging
 import argparse
 import shutil
 import sys
+import os
+import io
+import json
+import time
+import contextlib
+import signal
+import socket
+import socketserver
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field, asdict
 
 # Add the src directory to the system path
 sys.path.append(str(Path(__file__).resolve().parent / 'src'))
@@ -11,6 +24,10 @@ sys.path.append(str(Path(__file__).resolve().parent / 'src'))
 from asm_analysis import *
 from bin_analysis import *
 from rewriter import *
+from analysis_cache import *
+from run_stats import *
+from patch_cost import plan_file
+from client import default_socket
 
 # Define the CustomFormatter class for colored output (optional)
 class CustomFormatter(logging.Formatter):
@@ -29,15 +46,21 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: red + format + reset,
         logging.CRITICAL: bold_green + format + reset
     }
+    # Uncolored variant for log files
+    PLAIN_FORMATS = dict.fromkeys(FORMATS, format)
+
+    # The per-level formatters are built once instead of once per record
+    def __init__(self, color=True):
+        super().__init__()
+        formats = self.FORMATS if color else self.PLAIN_FORMATS
+        self.formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in formats.items()}
 
     def format(self, record):
         record.funcName = f"{record.funcName:>20}"  # Adjust the function name to be right-aligned with a width of 20 characters
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.formatters[record.levelno].format(record)
 
-# Create and configure logger
-custom_logger = logging.getLogger(__name__)
+# Create and configure logger (the same 'main' logger the src modules log to)
+custom_logger = logging.getLogger('main')
 custom_logger.setLevel(logging.DEBUG)
 
 # Create console handler
@@ -54,6 +77,39 @@ if not custom_logger.handlers:
 # Ensure log propagation is disabled to prevent duplicate logs
 custom_logger.propagate = False
 
+log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+# Per thread of the daemon serving a request: its log stream, level and color
+request_state = threading.local()
+
+# Console output is limited to level; with log_file, the diagnostics go to the
+# file instead and the console only shows warnings, errors and the summary.
+# The logger level is the most verbose handler level, so disabled diagnostics
+# are dropped by isEnabledFor() before anything is formatted.
+# (The console handler is looked up on the logger: src/rewriter.py imports this
+# file a second time as 'main', and the handler of that first import is the one installed.)
+def configure_logging(level=logging.DEBUG, log_file=None):
+    console_level = max(level, logging.WARNING) if log_file else level
+    for handler in custom_logger.handlers:
+        handler.setLevel(console_level)
+    if log_file:
+        file_handler = logging.FileHandler(log_file, mode='w', encoding='utf-8')
+        file_handler.setLevel(level)
+        file_handler.setFormatter(CustomFormatter(color=False))
+        custom_logger.addHandler(file_handler)
+    custom_logger.setLevel(min(handler.level for handler in custom_logger.handlers))
+
+# Where worker output collected by process_file_worker is written; a request
+# of the daemon has its own
+def log_stream():
+    stream = getattr(request_state, 'stream', None)
+    if stream is not None:
+        return stream
+    for handler in custom_logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.stream
+    return sys.stderr
+
 def get_logger():
     return custom_logger
 
@@ -63,28 +119,465 @@ class FileData:
     asm_path: str = None
     obj_path: str = None
 
-def process_dir(directory):
+@dataclass
+class FileResult:
+    name: str = None
+    patch_counts: Counter = field(default_factory=Counter)
+    error: str = None
+    output: str = ""
+    cached: bool = False
+    stats: FileStats = None
+    plan: dict = None # Dry run result, see patch_cost.plan_file
+
+# With plan, the patch plan is costed (patch_cost.plan_file) instead of applied
+# and the assembly file is left untouched. Assembly files larger than
+# stream_above bytes are analyzed one function at a time while they are
+# rewritten (asm_analysis.StreamingPlan); their analysis is not cached.
+def process_file(file_data, backend=None, cache=None, options=None, plan=False, stream_above=None):
+    stats = FileStats(file_data.name)
+    custom_logger.info("ASM Path: %s", file_data.asm_path)
+    custom_logger.info("OBJ Path: %s", file_data.obj_path)
+    stream = stream_above is not None and os.path.getsize(file_data.asm_path) > stream_above
+    # Where the backend reads the symbols from
+    symbol_path = file_data.asm_path if get_backend(backend).reads_assembly else file_data.obj_path
+
+    entry = None
+    if cache is not None:
+        backend_name = get_backend(backend).name
+        symbol_digest = file_digest(symbol_path)
+        key = cache.key(backend_name, symbol_digest, file_digest(file_data.asm_path))
+        entry = cache.load(key)
+        if entry is not None and entry.get("rewritten"):
+            # The .s already holds our output for this object; rewriting it again would double-instrument it
+            custom_logger.info(f"{file_data.name} is already rewritten, skipping")
+            if plan:
+                return FileResult(file_data.name, error="Already rewritten, nothing to plan", cached=True, stats=stats)
+            stats.patches.update(entry["patch_counts"])
+            return FileResult(file_data.name, entry["patch_counts"], cached=True, stats=stats)
+
+    if stream:
+        entry = None # A cached plan holds the sites of the whole file
+    if entry is not None:
+        custom_logger.info(f"Using cached analysis for {file_data.name}")
+        symbols, patch_plan = entry["symbols"], entry["patch_plan"]
+    else:
+        try:
+            with stats.stage('symbols'):
+                symbols = process_binary(symbol_path, backend)
+        except ElfError as e:
+            return FileResult(file_data.name, error=f"Failed to read symbols: {e}", stats=stats)
+        if custom_logger.isEnabledFor(logging.INFO):
+            for symbol in symbols:
+                custom_logger.info("Symbol: %s at %#x", symbol.name, symbol.address)
+        # exit()
+        if stream:
+            custom_logger.info("Streaming the analysis of %s", file_data.name)
+            patch_plan = StreamingPlan(file_data.asm_path, symbols, stats)
+        else:
+            patch_plan = asm_analysis(file_data.asm_path, symbols, stats)
+        if cache is not None and not stream:
+            cache.store(key, {"symbols": cacheable_symbols(symbols), "patch_plan": patch_plan})
+
+    stats.count_symbols(symbols)
+
+    if plan:
+        with stats.stage('plan'):
+            file_plan, patch_counts = plan_file(file_data.asm_path, patch_plan, options, stats)
+        stats.patches.update(patch_counts)
+        return FileResult(file_data.name, patch_counts, cached=entry is not None, stats=stats, plan=file_plan)
+
+    with stats.stage('rewrite'):
+        patch_counts = rewriter(file_data.asm_path, patch_plan, options, stats)
+    stats.patches.update(patch_counts)
+    if cache is not None:
+        rewritten_key = cache.key(backend_name, symbol_digest, file_digest(file_data.asm_path))
+        cache.store(rewritten_key, {"rewritten": True, "patch_counts": patch_counts})
+    return FileResult(file_data.name, patch_counts, cached=entry is not None, stats=stats)
+
+# Each pool worker creates its symbol backend once and keeps it for every file it handles
+def init_worker(backend, log_level=logging.DEBUG):
+    custom_logger.setLevel(log_level)
+    get_backend(backend)
+
+# Run process_file in a worker, capturing its log output so the parent can
+# print it in file order instead of interleaving the workers. The workers of the
+# daemon serve requests of any log level and color, which come with every file.
+def process_file_worker(file_data, backend, cache, options, plan=False, stream_above=None, log_level=None, color=None):
+    if log_level is not None:
+        custom_logger.setLevel(log_level)
+    buffer = io.StringIO()
+    handler = logging.StreamHandler(buffer)
+    handler.setLevel(custom_logger.level)
+    handler.setFormatter(CustomFormatter(color=log_stream() is sys.stderr if color is None else color))
+    saved_handlers = custom_logger.handlers
+    custom_logger.handlers = [handler]
+    try:
+        with contextlib.redirect_stdout(buffer):
+            result = process_file(file_data, backend, cache, options, plan, stream_above)
+    except Exception as e:
+        result = FileResult(file_data.name, error=f"{type(e).__name__}: {e}", stats=FileStats(file_data.name))
+    finally:
+        custom_logger.handlers = saved_handlers
+        trim_memo_tables()
+    result.output = buffer.getvalue()
+    return result
+
+# With executor (the pool of the daemon), every file goes through its workers
+def process_dir(directory, backend=None, jobs=1, cache=None, options=None, plan=False, stream_above=None,
+                executor=None):
+    start = time.perf_counter()
     asm_files = sorted(directory.glob("*.s"))
     obj_files = sorted(directory.glob("*.o"))
 
     if not asm_files:
         custom_logger.warning("No ASM files found in the directory.")
-    if not obj_files:
-        custom_logger.warning("No OBJ files found in the directory.")
-
-
-    for asm_file, obj_file in zip(asm_files, obj_files):
-        temp_file = FileData(asm_file.stem, asm_file, obj_file)
-        custom_logger.info(f"ASM Path: {temp_file.asm_path}")
-        custom_logger.info(f"OBJ Path: {temp_file.obj_path}")
-        
-        symbols = process_binary(temp_file.obj_path)
-        for symbol in symbols:
-            custom_logger.info(f"Symbol: {symbol.name} at {hex(symbol.address)}")
-        # exit()
-        asm_insts: Dict
-        asm_insts = asm_analysis(temp_file.asm_path, symbols)
-        rewriter(temp_file.asm_path, asm_insts)
+    if get_backend(backend).reads_assembly:
+        files = [FileData(asm_file.stem, asm_file) for asm_file in asm_files]
+    else:
+        if not obj_files:
+            custom_logger.warning("No OBJ files found in the directory.")
+        files = [FileData(asm_file.stem, asm_file, obj_file) for asm_file, obj_file in zip(asm_files, obj_files)]
+
+    if executor is not None or (jobs > 1 and len(files) > 1):
+        results = []
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=min(jobs, len(files)), initializer=init_worker,
+                                                                   initargs=(backend, custom_logger.level)))
+                worker_level = color = None
+            else:
+                worker_level, color = request_state.level, request_state.color
+            # map() yields in submission order, so the output is deterministic
+            for result in executor.map(process_file_worker, files, repeat(backend), repeat(cache), repeat(options),
+                                       repeat(plan), repeat(stream_above), repeat(worker_level), repeat(color)):
+                log_stream().write(result.output)
+                results.append(result)
+    else:
+        results = [process_file(file_data, backend, cache, options, plan, stream_above) for file_data in files]
+
+    total_counts = Counter()
+    cached = sum(1 for result in results if result.cached)
+    errors = 0
+    for result in results:
+        if result.error:
+            custom_logger.error("%s: %s", result.name, result.error)
+            errors += 1
+        else:
+            total_counts.update(result.patch_counts)
+    # One summary line for the whole run, whatever the log level
+    macros = " ".join(f"{macro}={count}" for macro, count in sorted(total_counts.items()))
+    custom_logger.critical("Total patch count: %d (%d files, %d from cache, %d failed, %.2fs) %s",
+                           sum(total_counts.values()), len(results), cached, errors, time.perf_counter() - start, macros)
+    return results
+
+# Machine-readable run report: per-stage wall/CPU time, counters, patches per
+# macro and symbols per section, per file and summed over the run
+def write_report(path, results, wall, **run_info):
+    totals = FileStats()
+    files = []
+    for result in results:
+        entry = {"name": result.name, "cached": result.cached, "error": result.error}
+        if result.stats is not None:
+            totals.update(result.stats)
+            entry.update(result.stats.to_dict())
+        files.append(entry)
+    report = {
+        **run_info,
+        "wall": round(wall, 6),
+        "files_total": len(results),
+        "files_cached": sum(1 for result in results if result.cached),
+        "files_failed": sum(1 for result in results if result.error),
+        "totals": totals.to_dict(),
+        "files": files,
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+        file.write("\n")
+    custom_logger.info("Run report written to %s", path)
+
+# Dry run output: every patch site with its macro, operand size and estimated
+# added instructions/bytes, per function and file, and the totals of the run
+def write_plan(path, results, options, **run_info):
+    files = []
+    totals = Counter()
+    patches = Counter()
+    for result in results:
+        entry = {"name": result.name, "error": result.error}
+        if result.plan is not None:
+            entry.update(result.plan)
+            for key in ("instructions", "bytes", "original_instructions"):
+                totals[key] += result.plan[key]
+            patches.update(result.patch_counts)
+        files.append(entry)
+    plan = {
+        **run_info,
+        "options": asdict(options),
+        "files_total": len(results),
+        "files_failed": sum(1 for result in results if result.error),
+        "instructions": totals["instructions"],
+        "bytes": totals["bytes"],
+        "original_instructions": totals["original_instructions"],
+        "patches": dict(sorted(patches.items())),
+        "files": files,
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(plan, file, indent=2)
+        file.write("\n")
+    custom_logger.critical("Patch plan written to %s: %d instructions, ~%d bytes added", path,
+                           totals["instructions"], totals["bytes"])
+
+# Daemon mode (--serve): one process keeps the modules, the symbol backend and
+# a pool of warm workers loaded and serves the runs of client.py on a Unix
+# socket. A request is one JSON line {"argv": [...], "cwd": ..., "color": ...}
+# with the arguments of a main.py run; the answer is a JSON line per piece of
+# output ({"stderr": text} or {"stdout": text}) and a last {"exit": status}.
+
+# Arguments naming files, resolved against the directory of the client
+path_arguments = ('input', 'result_dir', 'cache_dir', 'profile_in', 'log_file', 'report', 'plan')
+
+# Output of a request, sent to its client as it is written. A client that went
+# away does not stop the run: its output is dropped.
+class ClientStream:
+    def __init__(self, wfile, channel='stderr'):
+        self.wfile = wfile
+        self.channel = channel
+        self.connected = True
+
+    def send(self, message):
+        if self.connected:
+            try:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+            except OSError:
+                self.connected = False
+
+    def write(self, text):
+        if text:
+            self.send({self.channel: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        stderr = ClientStream(self.wfile)
+        status = self.server.serve_request(request, ClientStream(self.wfile, 'stdout'), stderr)
+        stderr.send({"exit": status})
+
+# Requests are served by a thread each; their files all go to the same pool.
+# The log records of a request only reach the handlers of that request.
+class RewriteServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, args):
+        self.args = args
+        self.jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        self.executor = self.start_pool()
+        self.parse_lock = threading.Lock()
+        self.log_lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        self.requests = set() # Threads serving a request
+        # The handlers of the daemon itself leave the requests out
+        for handler in custom_logger.handlers:
+            handler.addFilter(lambda record: record.thread not in self.requests)
+        super().__init__(path, RequestHandler)
+
+    def start_pool(self):
+        executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker,
+                                       initargs=(self.args.backend, custom_logger.level))
+        # Start every worker, which loads the backend, before the first request
+        for future in [executor.submit(os.getpid) for _ in range(self.jobs)]:
+            future.result()
+        return executor
+
+    def serve_request(self, request, stdout, stderr):
+        parser = build_parser()
+        try:
+            # argparse prints usage, help and errors to sys.stdout/sys.stderr
+            with self.parse_lock, contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                args = parser.parse_args(request["argv"])
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        if args.serve:
+            stderr.write("main.py: error: --serve is not a request\n")
+            return 2
+        for name in path_arguments:
+            if getattr(args, name) is not None:
+                setattr(args, name, os.path.join(request["cwd"], getattr(args, name)))
+        executor = self.executor
+        with self.request_logging(args, stderr, request.get("color", False)):
+            try:
+                return run(args, executor)
+            except BrokenProcessPool:
+                custom_logger.error("A worker of the daemon died, restarting the pool")
+                self.restart_pool(executor)
+            except Exception:
+                custom_logger.exception("The request failed")
+        return 1
+
+    # Once for all the requests that were using the broken pool
+    def restart_pool(self, executor):
+        with self.pool_lock:
+            if self.executor is executor:
+                self.executor = self.start_pool()
+                executor.shutdown(wait=False)
+
+    # Handlers of the current request, as configure_logging would set them up
+    # for a run of its own
+    @contextlib.contextmanager
+    def request_logging(self, args, stream, color):
+        thread = threading.get_ident()
+        level = log_level(args)
+        console = logging.StreamHandler(stream)
+        console.setLevel(max(level, logging.WARNING) if args.log_file else level)
+        console.setFormatter(CustomFormatter(color))
+        handlers = [console]
+        if args.log_file:
+            file_handler = logging.FileHandler(args.log_file, mode='w', encoding='utf-8')
+            file_handler.setLevel(level)
+            file_handler.setFormatter(CustomFormatter(color=False))
+            handlers.append(file_handler)
+        for handler in handlers:
+            handler.addFilter(lambda record: record.thread == thread)
+        request_state.stream = handlers[-1].stream
+        request_state.level = level
+        request_state.color = color and not args.log_file
+        # The handler list is replaced rather than changed, other requests may be logging through it
+        with self.log_lock:
+            self.requests.add(thread)
+            custom_logger.handlers = custom_logger.handlers + handlers
+            custom_logger.setLevel(min(handler.level for handler in custom_logger.handlers))
+        try:
+            yield
+        finally:
+            with self.log_lock:
+                custom_logger.handlers = [handler for handler in custom_logger.handlers if handler not in handlers]
+                custom_logger.setLevel(min(handler.level for handler in custom_logger.handlers))
+                self.requests.discard(thread)
+            for handler in handlers:
+                handler.close()
+            request_state.__dict__.clear()
+
+# A socket file whose daemon is gone is removed; False if a daemon still
+# accepts connections on it
+def claim_socket(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except FileNotFoundError:
+            return True
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return True
+    return False
+
+def serve(args):
+    path = args.socket or default_socket()
+    if not claim_socket(path):
+        custom_logger.error("A daemon is already serving on %s", path)
+        return 1
+    # Only the user running the daemon may connect: requests rewrite files as that user
+    umask = os.umask(0o177)
+    try:
+        server = RewriteServer(path, args)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    custom_logger.critical("Serving on %s with %d workers", path, server.jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown(cancel_futures=True)
+        os.unlink(path)
+    return 0
+
+# Arguments of a run, shared by the command line, the daemon and client.py
+def build_parser():
+    parser = argparse.ArgumentParser(description='Process some inputs.')
+    parser.add_argument('--input', type=str, help='Specify an input (directory in the result)', default=None)
+    parser.add_argument('--result-dir', type=str, help='Result directory holding <input>/ (default: ../result)', default=None)
+    parser.add_argument('--backend', type=str, choices=sorted(backend_types), help='Symbol extraction backend (asm: from the assembly files, without object files)', default=None)
+    parser.add_argument('--jobs', '-j', type=int, help='Number of files to process in parallel (0 = one per CPU)', default=1)
+    parser.add_argument('--cache-dir', type=str, help='Analysis cache directory', default=str(DEFAULT_CACHE_DIR))
+    parser.add_argument('--cache-size', type=int, help='Maximum analysis cache size in MB', default=DEFAULT_MAX_BYTES >> 20)
+    parser.add_argument('--no-cache', action='store_true', help='Always re-run symbol extraction and analysis')
+    parser.add_argument('--no-bb-reuse', action='store_true', help='Recompute the sandbox delta for every memory access instead of once per basic block')
+    parser.add_argument('--no-liveness', action='store_true', help='Use the fixed macro scratch registers (%%r14/%%r15) instead of dead registers')
+    parser.add_argument('--no-ctrl-flow-elision', action='store_true', help='Check every indirect call/jump, even when its target is proven to be code of the file')
+    parser.add_argument('--shadow-stack', type=str, choices=list(shadow_stack_policies), default='leaf',
+                        help='Functions that skip the shadow stack: no function, the shadow stack is always kept (always), leaves without memory stores (pure-leaf), '
+                             'or leaves that only store to their frame and globals (leaf)')
+    parser.add_argument('--addressing', type=str, choices=list(addressing_headers), default='delta',
+                        help='Sandboxed memory accesses: translate the address with the sandbox delta (delta), or a single '
+                             '%%gs:-relative access, which needs the GS base set up by the gs mode of the loader (gs)')
+    parser.add_argument('--emission', type=str, choices=['inline', 'outlined'], default='inline',
+                        help='Expand the checks inline, or call trampolines shared by all files (smaller code, one call per check)')
+    parser.add_argument('--outline-threshold', type=int, default=0,
+                        help='With --emission outlined, only outline functions whose inline checks would add more than this '
+                             'many bytes (0: every function)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Count the executions of every patched site; the loader dumps the counters at exit and '
+                             'profile_report.py maps them back to the sources')
+    parser.add_argument('--profile-in', type=str, default=None,
+                        help='Profile written by profile_report.py: with --emission outlined, its hot sites stay inline')
+    parser.add_argument('--log-level', type=str.upper, choices=log_levels, help='Most verbose log level to show', default='DEBUG')
+    parser.add_argument('--log-file', type=str, help='Write the log to this file; the console only shows warnings and the summary', default=None)
+    parser.add_argument('--report', type=str, help='Write per-stage timings and patch/symbol counters to this JSON file', default=None)
+    parser.add_argument('--plan', type=str, help='Dry run: write the patch sites and their estimated instruction/size cost '
+                                                 'to this JSON file instead of rewriting the assembly files', default=None)
+    parser.add_argument('--stream-above', type=int, default=64,
+                        help='Analyze assembly files larger than this many MB one function at a time while rewriting them, '
+                             'in bounded memory (0: every file, -1: none)')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Only show warnings, errors and the final summary (same as --log-level WARNING)')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a daemon serving the runs of client.py on --socket with a pool of --jobs warm workers')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Unix socket of the daemon (default: $XFI_REWRITER_SOCKET, or xfi-rewriter-<uid>.sock in '
+                             '$XDG_RUNTIME_DIR or the temporary directory)')
+    return parser
+
+def log_level(args):
+    return logging.WARNING if args.quiet else getattr(logging, args.log_level)
+
+def rewrite_options(args):
+    return RewriteOptions(bb_reuse=not args.no_bb_reuse, liveness=not args.no_liveness,
+                          shadow_stack=args.shadow_stack, ctrl_flow_elision=not args.no_ctrl_flow_elision,
+                          addressing=args.addressing, emission=args.emission,
+                          outline_threshold=args.outline_threshold, profile=args.profile,
+                          profile_in=args.profile_in)
+
+# One run of the parsed arguments; returns the exit status. The daemon passes
+# its pool of warm workers as executor.
+def run(args, executor=None):
+    base_name = Path(args.input).stem 
+    if args.result_dir:
+        result_dir = Path(args.result_dir) / base_name
+    else:
+        result_dir = Path(args.input).resolve().parent.parent / "result" / base_name
+    custom_logger.info("Input: %s", base_name)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    cache = None if args.no_cache else AnalysisCache(args.cache_dir, args.cache_size << 20)
+    if not result_dir.is_dir():
+        custom_logger.error("Input file directory does not exist or is not a directory.")
+        return 1
+    start = time.perf_counter()
+    options = rewrite_options(args)
+    stream_above = args.stream_above << 20 if args.stream_above >= 0 else None
+    results = process_dir(result_dir, args.backend, jobs, cache, options, plan=args.plan is not None,
+                          stream_above=stream_above, executor=executor)
+    if args.plan:
+        write_plan(args.plan, results, options, input=base_name)
+    if args.report:
+        write_report(args.report, results, time.perf_counter() - start, input=base_name,
+                     backend=get_backend(args.backend).name, jobs=jobs, cache=cache is not None)
+    return 1 if any(result.error for result in results) else 0
 
 def main():
     # Get the size of the terminal
@@ -92,23 +585,13 @@ def main():
 
     # Create a string that fills the terminal width with spaces
     empty_space = ' ' * (columns - 1)
-    
-    # Create the parser
-    parser = argparse.ArgumentParser(description='Process some inputs.')
-
-    # Add arguments
-    parser.add_argument('--input', type=str, help='Specify an input (directory in the result)', default=None)
 
     # Parse arguments
-    args = parser.parse_args()
-    
-    base_name = Path(args.input).stem 
-    result_dir = Path(args.input).resolve().parent.parent / "result" / base_name
-    print(base_name)
-    if result_dir.is_dir():
-        process_dir(result_dir)
-    else:
-        custom_logger.error("Input file directory does not exist or is not a directory.")
+    args = build_parser().parse_args()
+    configure_logging(log_level(args), args.log_file)
+    if args.serve:
+        return serve(args)
+    return run(args)
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
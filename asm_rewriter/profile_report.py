@@ -0,0 +1,52 @@
+import argparse
+import json
+import logging
+from pathlib import Path
+
+from main import get_logger, configure_logging
+from site_profile import build_profile, hot_coverage
+
+report_logger = get_logger()
+
+# Reads the site counters dumped by a program rewritten with main.py --profile,
+# maps them back to function:line through the site maps of the rewritten files
+# and prints the hottest sites. The profile written with --output is what
+# main.py --profile-in takes.
+
+def print_report(profile, top):
+    sites = sorted(((name, site) for name, entry in profile["files"].items() for site in entry["sites"]),
+                   key=lambda item: item[1]["count"], reverse=True)
+    total = profile["executions"]
+    print(f"{total} site executions over {profile['runs']} run(s), {profile['hot_sites']} hot sites cover "
+          f"{profile['coverage']:.0%}")
+    print(f"{'executions':>14} {'share':>7} {'total':>7}  site")
+    cumulative = 0
+    for name, site in sites[:top]:
+        if not site["count"]:
+            break
+        cumulative += site["count"]
+        print(f"{site['count']:>14} {site['count'] / total:>7.2%} {cumulative / total:>7.2%}  "
+              f"{name}:{site['function']}:{site['line']} {site['macro']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Map the site counters of a --profile run back to the assembly sources.')
+    parser.add_argument('dump', type=str, help='Counter dump written by the loader (XFI_PROFILE, default xfi_profile.txt)')
+    parser.add_argument('directory', type=str, help='Directory of the rewritten files and their .sites.json maps')
+    parser.add_argument('--output', '-o', type=str, help='Write the profile for main.py --profile-in to this JSON file', default=None)
+    parser.add_argument('--top', type=int, help='Number of sites to list', default=20)
+    parser.add_argument('--coverage', type=float, help='Share of the executions the hot sites cover', default=hot_coverage)
+    args = parser.parse_args()
+    configure_logging(logging.WARNING)
+
+    profile = build_profile(args.dump, Path(args.directory), args.coverage)
+    if not profile["executions"]:
+        report_logger.error("No site was executed in %s", args.dump)
+    else:
+        print_report(profile, args.top)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(profile, file, indent=1)
+            file.write("\n")
+
+if __name__ == '__main__':
+    main()
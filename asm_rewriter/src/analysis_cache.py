@@ -0,0 +1,167 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+cache_logger = logging.getLogger('main')
+
+import os
+import fcntl
+import hashlib
+import pickle
+import tempfile
+
+from elf_reader import Symbol
+
+# Bump when the layout of the cached entries changes
+CACHE_FORMAT = 1
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("XFI_CACHE_DIR", Path.home() / ".cache" / "xfi"))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Fraction of max_bytes an eviction leaves
+LOW_WATER = 0.75
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The rewriter version is the hash of the analysis/rewriter sources, so any
+# change to them invalidates every cached plan
+def rewriter_version():
+    digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+    for path in sorted(Path(__file__).resolve().parent.glob('*.py')):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+# Content-addressed on-disk cache of analysis results (symbols + patch plan).
+# Entries are pickles named by their key; the least recently used ones are
+# evicted once the cache grows past max_bytes. The size file keeps the running
+# total of the entries, so only a store that crosses max_bytes lists the cache.
+class AnalysisCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.version = rewriter_version()
+        self.size_path = self.directory / "size"
+
+    def key(self, *parts):
+        digest = hashlib.sha256(self.version.encode())
+        for part in parts:
+            digest.update(b'\0')
+            digest.update(str(part).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.pickle"
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                entry = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            cache_logger.warning(f"Dropping unreadable cache entry {path.name}: {e}")
+            self._account(-self._remove(path))
+            return None
+        # Touch the entry so eviction sees it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, entry):
+        path = self._path(key)
+        try:
+            data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            cache_logger.warning(f"Analysis result is not cacheable: {e}")
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            cache_logger.warning(f"Failed to write cache entry {path.name}: {e}")
+            self._remove(Path(temp_path))
+            return
+        self._account(len(data) - replaced)
+
+    # Adds delta to the running total, evicting once it is past max_bytes. The
+    # lock on the size file serializes the processes sharing the cache.
+    def _account(self, delta):
+        if delta == 0:
+            return
+        try:
+            with open(self.size_path, 'a+') as size_file:
+                fcntl.flock(size_file, fcntl.LOCK_EX)
+                size_file.seek(0)
+                try:
+                    total = int(size_file.read()) + delta
+                except ValueError: # New or damaged size file: the listing includes delta
+                    total = sum(size for mtime, size, path in self._entries())
+                if total > self.max_bytes:
+                    total = self.evict()
+                size_file.seek(0)
+                size_file.truncate()
+                size_file.write(str(total))
+        except OSError as e:
+            cache_logger.warning(f"Failed to update the cache size: {e}")
+
+    # (mtime, size, path) of every entry
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob('*/*.pickle'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError: # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    # Once the cache is past max_bytes, removes the least recently used entries
+    # down to LOW_WATER of it, so that the next listing is many stores away;
+    # returns the size left
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for mtime, size, path in entries)
+        if total <= self.max_bytes:
+            return total
+        target = int(self.max_bytes * LOW_WATER)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+        cache_logger.info(f"Evicted cache entries down to {total} bytes")
+        return total
+
+    # Size of the removed file, 0 if it was already gone
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return 0
+        return size
+
+# Symbols from other backends may not be picklable; keep only what the analysis needs
+def cacheable_symbols(symbols):
+    return [symbol if isinstance(symbol, Symbol) else
+            Symbol(symbol.name, symbol.address, getattr(symbol, 'size', 0), getattr(symbol, 'section', None))
+            for symbol in symbols]
@@ -12,7 +12,14 @@ import os
 from dataclasses import dataclass, fields
 from pprint import pprint
 
-@dataclass(unsafe_hash=True)
+from symbol_index import SymbolIndex
+from run_stats import FileStats
+from liveness import BodyLine, function_liveness, written_registers, instruction_effects, stored_operands, gpr_bits, strip_suffix, flow_table
+from transfer_targets import ReadOnlyData, resolve_transfer_targets
+
+# Slotted records: one is allocated per parsed operand, and big translation
+# units keep hundreds of thousands of them alive during the analysis
+@dataclass(unsafe_hash=True, slots=True)
 class OperandData:
     symbol: str = None   # For direct addressing and RIP-relative addressing
     base: str = None    # For base register in addressing
@@ -29,17 +36,30 @@ class OperandData:
 
 
 class PatchingInst:
+    __slots__ = ('line_num', 'opcode', 'prefix', 'src', 'dest', 'src_op', 'dest_op', 'patching_info', 'block',
+                 'free_regs', 'free_since', 'shadow_class', 'resolved_target')
+
     def __init__(self, line_num, opcode, prefix, src, dest):
         self.line_num = line_num
-        self.opcode = opcode
-        self.prefix = prefix
-        self.src = src
-        self.dest = dest
+        # Mnemonics, suffixes and operands repeat all over a file; interning
+        # makes every record share a single copy of each string
+        self.opcode = sys.intern(opcode)
+        self.prefix = sys.intern(prefix)
+        self.src = sys.intern(src) if src is not None else None
+        self.dest = sys.intern(dest) if dest is not None else None
         self.src_op = None
         self.dest_op = None
         self.patching_info = None 
+        self.block = 0 # Basic block id, see parse_assembly_file
+        self.free_regs = None # Registers dead at this instruction (liveness mask), see assign_free_registers
+        self.free_since = None # Registers dead and untouched since the previous patched instruction
+        self.shadow_class = None # Shadow stack class of the function (.cfi_startproc and ret), see classify_shadow_stack
+        self.resolved_target = None # Proven in-module target of an indirect call/jump, see assign_resolved_targets
         
     def inst_print(self):
+        # Skip the padding work entirely unless the debug output is shown
+        if not asm_logger.isEnabledFor(logging.DEBUG):
+            return
         # Determine the length of the source field and set the tab stop accordingly
         line_num = 4
         line_field = f"{self.line_num}"
@@ -57,9 +77,8 @@ class PatchingInst:
         src_field = f"{self.src}"
         padded_src_field = f"{src_field:<{src_field_length}}"
 
-        asm_logger.debug(f"\nLine: {padded_line_field}\t| Opcode: {padded_opcode_field} | Prefix: {padded_prefix_field} | Source: {padded_src_field} | Dest: {self.dest}\n\t\t| Patching: {self.patching_info}")
+        asm_logger.debug(f"\nLine: {padded_line_field}\t| Opcode: {padded_opcode_field} | Prefix: {padded_prefix_field} | Source: {padded_src_field} | Dest: {self.dest}\n\t\t| Patching: {self.patching_info}\n")
         # asm_logger.debug(self.src_op)
-        print()
         # print("Source Operand:")
         # self.src_op.pretty_print()
         # print("Destination Operand:")
@@ -106,7 +125,129 @@ indirect_transfer_pattern = re.compile(
 
 start_fun_pattern = re.compile(r'^\s*(?P<directive>\.cfi_startproc)\s*')
 
+# ---- Single-pass line lexer ---- #
+# parse_assembly_line classifies a line by its first character/token and only
+# looks at the operands of real instructions; directives, labels and comments
+# (most of a -gdwarf-2 .s file) are rejected without running any regex. The
+# results match parse_assembly_line_regex, except that a memory operand with an
+# index register is no longer split at its inner comma (the regex turned
+# 'incl 4(%rax,%rdx)' into src '4(%rax', dest '%rdx)'); like every other
+# indexed operand it is now rejected.
+
+# Mnemonics the combined pattern tries before its generic \w+? alternative
+special_opcodes = ('call', 'jmp', 'ret', 'nop', 'movzwl', 'movzwq', 'movzlq', 'movzbl')
+transfer_opcodes = ('jmp', 'call', 'ret')
+size_suffixes = frozenset('bwlq')
+
+word_pattern = re.compile(r'\w+')
+operand_token_pattern = re.compile(r'\$?[%\w.\-+()]+')
+transfer_operand_pattern = re.compile(r'\*?\$?[%\w.\-+()]+')
+
+# Opcode dispatch table: mnemonic -> (opcode, prefix), or None if the first
+# token cannot start an instruction. Filled lazily, one entry per distinct token.
+mnemonic_table = {}
+
+def split_mnemonic(head):
+    entry = mnemonic_table.get(head)
+    if entry is not None or head in mnemonic_table:
+        return entry
+    if not word_pattern.fullmatch(head):
+        entry = None
+    else:
+        for opcode in special_opcodes:
+            if head.startswith(opcode) and (len(head) == len(opcode) or
+                                            (len(head) == len(opcode) + 1 and head[-1] in size_suffixes)):
+                break
+        else:
+            # Shortest opcode whose remainder is an optional size suffix
+            opcode = head[:-1] if len(head) > 1 and head[-1] in size_suffixes else head
+        prefix = '' if opcode in no_prefix_instructions else head[len(opcode):]
+        entry = (opcode, prefix)
+    mnemonic_table[head] = entry
+    return entry
+
+# Split an operand list on top-level commas; commas inside parentheses belong
+# to the memory operand (e.g. 8(%rax,%rbx,4))
+def split_operands(text):
+    if '(' not in text:
+        return [operand.strip() for operand in text.split(',')]
+    operands = []
+    depth = 0
+    start = 0
+    for pos, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth <= 0:
+            operands.append(text[start:pos].strip())
+            start = pos + 1
+    operands.append(text[start:].strip())
+    return operands
+
+# Source/destination of a one- or two-operand instruction, or None if the
+# operands are not in the form the analysis handles
+def instruction_operands(text):
+    operands = split_operands(text)
+    if len(operands) == 1:
+        src = operands[0]
+        if operand_token_pattern.fullmatch(src):
+            return src, None
+        # Operands separated only by whitespace or by a '$' immediate
+        parts = src.split()
+        if len(parts) == 1:
+            dollar = src.find('$', 1)
+            if dollar < 0:
+                return None
+            parts = [src[:dollar], src[dollar:]]
+        if len(parts) == 2 and operand_token_pattern.fullmatch(parts[0]) and operand_token_pattern.fullmatch(parts[1]):
+            return parts[0], parts[1]
+        return None
+    if len(operands) == 2:
+        src, dest = operands
+        if not operand_token_pattern.fullmatch(src):
+            return None
+        if not dest:
+            return src, None
+        if operand_token_pattern.fullmatch(dest):
+            return src, dest
+    return None
+
 def parse_assembly_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    first = line[0]
+    if first == '.':
+        if line.startswith('.cfi_startproc'):
+            return '.cfi_startproc', '', None, None
+        return None # Any other directive or local label
+    if first == '#':
+        return None
+
+    parts = line.split(None, 1)
+    if len(parts) == 2:
+        mnemonic = split_mnemonic(parts[0])
+        if mnemonic is not None:
+            operands = instruction_operands(parts[1])
+            if operands is not None:
+                return mnemonic[0], mnemonic[1], operands[0], operands[1]
+
+    # Indirect transfers: operand-less ret/call/jmp and '*' operands
+    if first in 'jcr':
+        for opcode in transfer_opcodes:
+            if line.startswith(opcode):
+                operand = line[len(opcode):].strip()
+                if not operand:
+                    return opcode, '', None, None
+                if transfer_operand_pattern.fullmatch(operand):
+                    return opcode, '', operand, None
+                return None
+    return None
+
+# Reference regex implementation of parse_assembly_line, kept for benchmarking
+# and for checking the lexer below against it
+def parse_assembly_line_regex(line):
     start_match = start_fun_pattern.match(line)
     indirect_match = indirect_transfer_pattern.match(line)
     match = pattern.match(line)
@@ -142,36 +283,107 @@ def parse_assembly_line(line):
     else:
         return None
 
+# Mnemonics (and mnemonic prefixes) of instructions that end a basic block
+block_end_mnemonics = ('j', 'call', 'ret', 'loop', 'syscall', 'sysenter', 'int', 'ud2', 'hlt', 'iret')
+instruction_prefixes = {'notrack', 'bnd', 'rep', 'repz', 'repe', 'lock'}
+
+# True if the sandbox delta kept in %r15 is not valid after this instruction:
+# control transfers (callees run their own XFI checks on %r15) and anything
+# that names %r15 itself
+def ends_block(line):
+    words = line.split(None, 2)
+    mnemonic = words[0]
+    if mnemonic in instruction_prefixes and len(words) > 1:
+        mnemonic = words[1]
+    return mnemonic.startswith(block_end_mnemonics) or '%r15' in line
+
+# Line -> (label, mnemonic, operands), one entry per distinct body line
+body_line_table = {}
+
+# Record of an instruction or label line of a function body for the register
+# liveness analysis; instructions it cannot split get mnemonic None
+def body_line(line_num, line):
+    entry = body_line_table.get(line)
+    if entry is None:
+        entry = split_body_line(line)
+        body_line_table[line] = entry
+    return BodyLine(line_num, *entry)
+
+def split_body_line(line):
+    if line.endswith(':'):
+        return line[:-1], None, ()
+    parts = line.split('#', 1)[0].split(None, 1)
+    while len(parts) == 2 and parts[0] in ('notrack', 'bnd'):
+        parts = parts[1].split(None, 1)
+    if ';' in line or parts[0] in instruction_prefixes:
+        return None, None, ()
+    operands = split_operands(parts[1]) if len(parts) == 2 else []
+    return None, sys.intern(parts[0]), tuple(operands)
+
 # parsed_instructions = []
 
-# Function to parse the assembly file and create PatchingInst objects
-def parse_assembly_file(file_path):
+# Function to parse the assembly file and create PatchingInst objects.
+# Every instruction is tagged with a basic block id; the id changes at labels,
+# inline asm (#APP ... #NO_APP) and after the instructions in ends_block, so
+# two instructions with the same id can share the sandbox delta.
+# If bodies is a dict, it receives the (line number, line) of every instruction
+# and label of each function (up to its .cfi_endproc) for the liveness analysis;
+# data (a ReadOnlyData) receives the labelled data of the read-only sections.
+def parse_assembly_file(file_path, stats=None, bodies=None, data=None):
+    with open(file_path, 'r') as file:
+        function_dict, parsed_instructions, _ = parse_assembly_lines(file, stats, bodies, data)
+    return function_dict, parsed_instructions
+
+# parse_assembly_file on lines, the first of which is line line_num of the
+# file; block ids continue from block. Also returns the last block id.
+def parse_assembly_lines(lines, stats=None, bodies=None, data=None, line_num=1, block=0):
     parsed_instructions = []
     function_dict = {}
     current_function = None
-    line_num = 1
+    first_line = line_num
+    in_app = False
+    body = None
 
-    with open(file_path, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if line.startswith('.type') and '@function' in line:
-                # Extract the function name
-                function_name = line.split()[1].strip('",')
-                current_function = function_name
-                function_dict[current_function] = []
-            else:
-                result = parse_assembly_line(line)
-                if result:
-                    opcode, prefix, src, dest = result
-                    inst = PatchingInst(line_num, opcode, prefix, src, dest)
-                    # inst.inst_print()
-                    if current_function:
-                        function_dict[current_function].append(inst)
-                    else:
-                        parsed_instructions.append(inst)
-            line_num += 1
-        
-    return function_dict, parsed_instructions
+    for line in lines:
+        line = line.strip()
+        if line.startswith('.type') and '@function' in line:
+            # Extract the function name
+            function_name = line.split()[1].strip('",')
+            current_function = function_name
+            function_dict[current_function] = []
+            block += 1
+            if bodies is not None:
+                body = bodies[current_function] = []
+        else:
+            if line.endswith(':') or line.startswith(('#APP', '#NO_APP')):
+                block += 1
+                in_app = line.startswith('#APP')
+            result = parse_assembly_line(line)
+            if result:
+                opcode, prefix, src, dest = result
+                inst = PatchingInst(line_num, opcode, prefix, src, dest)
+                inst.block = block
+                # inst.inst_print()
+                if current_function:
+                    function_dict[current_function].append(inst)
+                else:
+                    parsed_instructions.append(inst)
+            if in_app or (line and line[0] not in '.#' and ends_block(line)):
+                block += 1
+            if data is not None and line and (line[0] == '.' or line.endswith(':')):
+                data.feed(line)
+            if body is not None and line:
+                if line.startswith('.cfi_endproc'):
+                    body = None
+                elif line[0] not in '.#' or line.endswith(':'):
+                    body.append((line_num, line))
+        line_num += 1
+
+    if stats is not None:
+        stats.counters['lines'] += line_num - first_line
+        stats.counters['functions'] += len(function_dict)
+        stats.counters['instructions'] += len(parsed_instructions) + sum(len(insts) for insts in function_dict.values())
+    return function_dict, parsed_instructions, block
 
 # Condensed regex pattern to capture different addressing modes for an operand
 operand_pattern = re.compile(r'''
@@ -194,6 +406,7 @@ operand_pattern = re.compile(r'''
 ''', re.VERBOSE)
 
 # Function to parse an operand and return an OperandData object
+# symbols is a SymbolIndex, so every membership check below is a hash lookup
 def parse_operand(operand, symbols):
     symbol_found = False
     
@@ -209,11 +422,12 @@ def parse_operand(operand, symbols):
             return OperandData(op_type='Register', value=value), symbol_found
         elif '(' in value:
             if value.endswith('(%rip)'):
+                symb = None
                 symb_match = re.match(r'([-]?\d*\+)?([.\w]+)\(%rip\)', value)
                 if symb_match:
                     disp, symb = symb_match.groups()
                     disp = disp.strip('+') if disp else None
-                    symbol_found = any(symbol.name == symb for symbol in symbols)
+                    symbol_found = symb in symbols
                 return OperandData(symbol=symb, op_type='RIP-relative addressing'), symbol_found
             elif ',' in value:
                 parts = value.split('(')
@@ -229,7 +443,7 @@ def parse_operand(operand, symbols):
                 return OperandData(base=base.strip(), disp=displacement.strip(), op_type='Base + displacement'), symbol_found
         else:
             op_data = OperandData(symbol=value, op_type='Direct addressing')
-            if any(symbol.name == value for symbol in symbols):
+            if value in symbols:
                 symbol_found = True
             return op_data, symbol_found
     return OperandData(op_type='Unknown'), symbol_found
@@ -296,54 +510,367 @@ def extract_operand(operand):
 # Dictionary to store functions and their corresponding instructions
 functions_dict = {}
 
-def asm_analysis(target_file, symbols):
-    asm_logger.info(f"Analyzing the assembly file: {target_file}")
-    function_instructions, general_instructions = parse_assembly_file(target_file)
-    
-    count = 99
-    pprint(symbols[:count])
-    copied_symbols = symbols[:count] # [count-1:count] specific debug
+# Build the patch plan consumed by the rewriter: line number -> PatchingInst for
+# every line that has to be rewritten (patched instructions and the
+# .cfi_startproc of each function, which receives the shadow stack push)
+def build_patch_plan(function_instructions):
+    patch_plan = {}
+    for func, instructions in function_instructions.items():
+        for inst in instructions:
+            if inst.patching_info is not None or inst.opcode == ".cfi_startproc":
+                patch_plan[inst.line_num] = inst
+    return patch_plan
+
+# Decide the patching of every parsed instruction against the symbol index
+def analyze_instructions(function_instructions, general_instructions, symbol_index):
+    # Checked once: the per-instruction diagnostics below are skipped entirely when debug output is off
+    debug = asm_logger.isEnabledFor(logging.DEBUG)
 
     for func, instructions in function_instructions.items():
-        asm_logger.info(f"Analyzing function: {func}")
+        asm_logger.info("Analyzing function: %s", func)
         for inst in instructions:
             inst: PatchingInst
             if inst.opcode not in indirect_instructions:
-                print()
-                asm_logger.warning("\tRegular instruction found")
+                if debug:
+                    asm_logger.debug("\n\tRegular instruction found")
                 # ---- Non control-flow instructions analysis ---- #
-                inst.src_op, src_symbol_found = parse_operand(inst.src, copied_symbols)
-                inst.dest_op, dest_symbol_found = parse_operand(inst.dest, copied_symbols)
+                inst.src_op, src_symbol_found = parse_operand(inst.src, symbol_index)
+                inst.dest_op, dest_symbol_found = parse_operand(inst.dest, symbol_index)
                 if src_symbol_found:
-                    asm_logger.debug(f"\tSymbols found in src at inst line {inst.line_num}")
                     inst.patching_info = "src"
-                    inst.inst_print()
+                    if debug:
+                        asm_logger.debug("\tSymbols found in src at inst line %d", inst.line_num)
+                        inst.inst_print()
                 if dest_symbol_found:
-                    asm_logger.debug(f"\tSymbols found in dest at inst line {inst.line_num}")
                     inst.patching_info = "dest"
-                    inst.inst_print()
+                    if debug:
+                        asm_logger.debug("\tSymbols found in dest at inst line %d", inst.line_num)
+                        inst.inst_print()
+                if inst.patching_info is None:
+                    # Nothing to patch, the rewriter never looks at these operands
+                    inst.src_op = inst.dest_op = None
             else:
-                print()
-                asm_logger.warning("\tIndirect transfer found")
+                if debug:
+                    asm_logger.debug("\n\tIndirect transfer found")
                 if inst.src == None:
-                    asm_logger.debug("\tNo operand inst")
                     inst.patching_info = "ret"
                 else:
-                    asm_logger.debug("\tOperand inst")
                     inst.src_op, patching_info = extract_operand(inst.src)
                     inst.patching_info = patching_info
-                inst.inst_print()
+                if debug:
+                    asm_logger.debug("\tNo operand inst" if inst.src == None else "\tOperand inst")
+                    inst.inst_print()
 
     asm_logger.info("Analyzing general instructions")
     for inst in general_instructions:
-        inst.src_op, src_symbol_found = parse_operand(inst.src, copied_symbols)
-        inst.dest_op, dest_symbol_found = parse_operand(inst.dest, copied_symbols)
+        inst.src_op, src_symbol_found = parse_operand(inst.src, symbol_index)
+        inst.dest_op, dest_symbol_found = parse_operand(inst.dest, symbol_index)
         if src_symbol_found:
-            asm_logger.debug(f"Symbols found in src at inst line {inst.line_num}")
+            asm_logger.debug("Symbols found in src at inst line %d", inst.line_num)
             inst.patching_info = "src"
         if dest_symbol_found:
-            asm_logger.debug(f"Symbols found in dest at inst line {inst.line_num}")
+            asm_logger.debug("Symbols found in dest at inst line %d", inst.line_num)
             inst.patching_info = "dest"
         inst.inst_print()
-        
-    return function_instructions
\ No newline at end of file
+
+# Attach the liveness masks the rewriter picks macro scratch registers from
+def assign_free_registers(function_instructions, bodies):
+    for func, instructions in function_instructions.items():
+        patched = {inst.line_num: inst for inst in instructions if inst.patching_info is not None}
+        # The shadow stack push runs before the first instruction
+        start = next((inst for inst in instructions if inst.opcode == ".cfi_startproc"), None)
+        if not (patched or start) or not bodies.get(func):
+            continue
+        body = [body_line(line_num, line) for line_num, line in bodies[func]]
+        # The registers the function does not write are live throughout (written_registers)
+        writable = written_registers(body)
+        since = writable
+        entry_live = None
+        for entry, live_in, live_out, uses, defs in function_liveness(body):
+            if entry_live is None:
+                entry_live = live_in
+            free = writable & ~(live_in | live_out | uses | defs)
+            since &= free
+            inst = patched.get(entry.line_num)
+            if inst is not None:
+                # Control-flow checks run before the instruction, so only its inputs matter
+                inst.free_regs = writable & ~live_in if inst.opcode in indirect_instructions else free
+                inst.free_since = since
+                since = writable
+        if start is not None and entry_live is not None:
+            start.free_regs = writable & ~entry_live
+
+# ---- Shadow stack elision ---- #
+# A function can only overwrite its return address through a store above its
+# own frame. Leaf functions (no calls, tail calls, indirect jumps or system
+# calls) that only store to their frame, below %rsp or to globals return through
+# an intact return address, so the rewriter may skip their shadow stack push and
+# check. %rsp is followed from the entry through push, pop and add/sub/and of an
+# immediate, and must never rise above its entry value: above it, a store below
+# %rsp (or a push) can hit the return address. Classes, from the most to the
+# least restrictive:
+#  'pure-leaf': a leaf without any memory store
+#  'leaf':      a leaf whose stores are negative offsets from %rbp (once the entry
+#               code set up the frame pointer) or %rsp, or RIP-relative/absolute
+shadow_stack_classes = ('pure-leaf', 'leaf')
+stack_slot_pattern = re.compile(r'-\d+\((%rbp|%rsp)\)')
+global_slot_pattern = re.compile(r'[-\w.+]*\(%rip\)|[A-Za-z_.][\w.]*(?:[-+]\d+)?')
+system_mnemonics = ('syscall', 'sysenter', 'int', 'iret')
+frame_registers = gpr_bits['rsp'] | gpr_bits['rbp']
+# Stack offset of a %rsp aligned (and) to somewhere at or below its entry value
+below_entry = 'below'
+
+# Offset of %rsp from its entry value after the instruction, from offset before
+# it: an int, below_entry once it was aligned (and) to somewhere at or below the
+# entry, or None if it cannot be followed
+def stack_offset(offset, base, mnemonic, operands):
+    if base in ('push', 'pop'):
+        size = 2 if mnemonic.endswith('w') else 8
+        if offset == below_entry:
+            return below_entry if base == 'push' else None
+        return offset - size if base == 'push' else offset + size
+    try:
+        immediate = int(operands[0][1:], 0)
+    except ValueError: # Symbolic immediate
+        return None
+    if base == 'and':
+        return below_entry
+    if offset == below_entry:
+        return below_entry if base == 'sub' and immediate >= 0 else None
+    return offset - immediate if base == 'sub' else offset + immediate
+
+# (class, reason) of a function body (a list of BodyLine): class is one of
+# shadow_stack_classes, or None with the reason the function does not qualify
+def classify_shadow_stack(body):
+    labels = {entry.label for entry in body if entry.label is not None}
+    targets = {entry.operands[0] for entry in body
+               if entry.mnemonic is not None and entry.mnemonic.startswith(('j', 'loop')) and len(entry.operands) == 1}
+    entry_code = True # Straight-line code at the function entry, before any branch or branch target
+    frame = None # Stack offset %rbp holds, once the entry code set up the frame pointer
+    epilogue = False
+    stores = False
+    offset = 0 # Stack offset of %rsp (see stack_offset)
+    reachable = True # The previous instruction falls through
+    label_offsets = {} # Label -> stack offset of the jumps to it and of the code after it
+    for entry in body:
+        if entry.label is not None:
+            entry_code = entry_code and entry.label not in targets
+            # Code only reached by later jumps assumes the current offset, the jumps check it
+            if entry.label in label_offsets:
+                if reachable and label_offsets[entry.label] != offset:
+                    return None, f"stack offset differs at {entry.label}"
+                offset = label_offsets[entry.label]
+            label_offsets[entry.label] = offset
+            reachable = True
+            continue
+        mnemonic, operands = entry.mnemonic, entry.operands
+        if mnemonic is None:
+            return None, "unparsed instruction"
+        if mnemonic.startswith('ret'):
+            epilogue = False
+            reachable = False
+            continue
+        if epilogue:
+            return None, f"{mnemonic} after the frame pointer is restored"
+        if mnemonic.startswith('call'):
+            return None, "calls"
+        if mnemonic.startswith(('j', 'loop')):
+            if len(operands) != 1 or operands[0] not in labels:
+                return None, "tail call or indirect jump"
+            if label_offsets.setdefault(operands[0], offset) != offset:
+                return None, f"stack offset differs at {operands[0]}"
+            entry_code = False
+            reachable = strip_suffix(mnemonic) != 'jmp'
+            continue
+        if mnemonic.startswith(system_mnemonics):
+            return None, "system call"
+        if mnemonic.startswith(('ud2', 'hlt')):
+            reachable = False
+            continue
+        effects = instruction_effects(mnemonic, operands)
+        if effects is None:
+            return None, f"unmodelled instruction {mnemonic}"
+        if effects[1] & frame_registers:
+            base = strip_suffix(mnemonic)
+            if base == 'leave' or (base == 'pop' and operands == ('%rbp',)):
+                epilogue = True
+            elif base == 'mov' and operands == ('%rsp', '%rbp') and entry_code:
+                frame = offset
+            elif base in ('push', 'pop') or (base in ('sub', 'add', 'and') and operands[0].startswith('$')
+                                             and operands[1] == '%rsp'):
+                offset = stack_offset(offset, base, mnemonic, operands)
+                if offset is None:
+                    return None, f"untracked stack pointer ({mnemonic})"
+                if offset != below_entry and offset > 0:
+                    return None, f"stack pointer above the return address ({mnemonic})"
+            else:
+                return None, f"writes the stack or frame pointer ({mnemonic})"
+        for operand in stored_operands(mnemonic, operands):
+            stores = True
+            slot = stack_slot_pattern.fullmatch(operand)
+            if slot is not None:
+                if slot.group(1) == '%rbp' and frame is None:
+                    return None, "store through %rbp without a frame"
+            elif not global_slot_pattern.fullmatch(operand):
+                return None, f"store through a computed address ({operand})"
+    return ('leaf' if stores else 'pure-leaf'), None
+
+# Attach the shadow stack class of every function to its .cfi_startproc and ret
+def assign_shadow_stack_classes(function_instructions, bodies, stats=None):
+    for func, instructions in function_instructions.items():
+        if not bodies.get(func):
+            continue
+        shadow_class, reason = classify_shadow_stack([body_line(line_num, line) for line_num, line in bodies[func]])
+        if shadow_class is None:
+            asm_logger.debug("Shadow stack kept for %s: %s", func, reason)
+            continue
+        asm_logger.debug("Shadow stack elidable for %s (%s)", func, shadow_class)
+        if stats is not None:
+            stats.counters[f"{shadow_class.replace('-', '_')}_functions"] += 1
+        for inst in instructions:
+            if inst.opcode == ".cfi_startproc" or inst.patching_info == "ret":
+                inst.shadow_class = shadow_class
+
+# Record the proven target of indirect calls and jumps (see transfer_targets).
+# functions are the functions of the file, by default those of function_instructions.
+def assign_resolved_targets(function_instructions, bodies, data, symbol_index, stats=None, functions=None):
+    if functions is None:
+        functions = set(function_instructions)
+    for func, instructions in function_instructions.items():
+        transfers = {inst.line_num: inst for inst in instructions
+                     if inst.patching_info in ("reg", "mem") and inst.src_op is not None and inst.src_op.op_type != "Label"}
+        if not transfers or not bodies.get(func):
+            continue
+        body = [body_line(line_num, line) for line_num, line in bodies[func]]
+        code = functions | {entry.label for entry in body if entry.label is not None and entry.label not in data.tables}
+        for line_num, target in resolve_transfer_targets(body, code, data, symbol_index).items():
+            inst = transfers.get(line_num)
+            if inst is not None:
+                asm_logger.debug("Target of line %d resolved: %s", line_num, target)
+                inst.resolved_target = target
+                if stats is not None:
+                    stats.counters['resolved_targets'] += 1
+
+# Patch plan of parsed functions, see asm_analysis
+def analyze_functions(function_instructions, general_instructions, bodies, data, symbol_index, stats=None,
+                      functions=None):
+    analyze_instructions(function_instructions, general_instructions, symbol_index)
+    assign_free_registers(function_instructions, bodies)
+    assign_shadow_stack_classes(function_instructions, bodies, stats)
+    assign_resolved_targets(function_instructions, bodies, data, symbol_index, stats, functions)
+    return build_patch_plan(function_instructions)
+
+# stats (a FileStats) receives the parse/analysis timings and counters
+def asm_analysis(target_file, symbols, stats=None):
+    asm_logger.info("Analyzing the assembly file: %s", target_file)
+    with open(target_file, 'r') as file:
+        return analyze_lines(file, symbols, stats)
+
+# asm_analysis on the lines of an assembly file, e.g. one only held in memory (xfi_cc.py)
+def analyze_lines(lines, symbols, stats=None):
+    if stats is None:
+        stats = FileStats()
+    with stats.stage('parse'):
+        bodies = {}
+        data = ReadOnlyData()
+        function_instructions, general_instructions, _ = parse_assembly_lines(lines, stats, bodies, data)
+
+    with stats.stage('analysis'):
+        symbol_index = SymbolIndex.of(symbols)
+        patch_plan = analyze_functions(function_instructions, general_instructions, bodies, data, symbol_index, stats)
+    stats.counters['patch_sites'] += len(patch_plan)
+    return patch_plan
+
+# ---- Streaming analysis ---- #
+# For files too big to hold every function at once (amalgamated or
+# LTO-generated sources), the patch plan can be built one function at a time
+# while the rewriter reads the file. What the analysis of a function needs from
+# the rest of the file, the names of the functions and the read-only data
+# tables, is collected by a first pass that keeps nothing else. Memory is then
+# bounded by the largest function and the memo tables (memo_limit) instead of
+# the file size; it still grows with the function names and the read-only data
+# of the file.
+
+# Distinct lines memoised by body_line/instruction_flow before the tables are
+# dropped. A StreamingPlan checks them after every function, so this also bounds
+# what a stream keeps in them.
+memo_limit = 1 << 12
+
+# Also called after every file by the long-lived workers of the daemon (main.py --serve)
+def trim_memo_tables():
+    if len(body_line_table) > memo_limit:
+        body_line_table.clear()
+    if len(flow_table) > memo_limit:
+        flow_table.clear()
+
+# Names of the functions of the file; data (a ReadOnlyData) receives the
+# labelled data of the read-only sections
+def scan_assembly_file(file_path, data, stats=None):
+    functions = set()
+    line_num = 0
+    with open(file_path, 'r') as file:
+        for line_num, line in enumerate(file, 1):
+            line = line.strip()
+            if line.startswith('.type') and '@function' in line:
+                functions.add(line.split()[1].strip('",'))
+            elif line and (line[0] == '.' or line.endswith(':')):
+                data.feed(line)
+    if stats is not None:
+        stats.counters['lines'] += line_num
+        stats.counters['functions'] += len(functions)
+    return functions
+
+# Patch plan of target_file built while lines() reads it: each function, from
+# its .type to its .cfi_endproc, is parsed and analyzed just before its first
+# line is yielded, and the plan only holds the sites of that function. Lines
+# outside of functions are never patched and go through as they are. The sites
+# of a function are the same as in asm_analysis; the analysis time is part of
+# the stage reading the lines.
+class StreamingPlan:
+    def __init__(self, target_file, symbols, stats=None):
+        self.stats = stats if stats is not None else FileStats()
+        self.data = ReadOnlyData()
+        with self.stats.stage('parse'):
+            self.functions = scan_assembly_file(target_file, self.data, self.stats)
+        self.symbol_index = SymbolIndex.of(symbols)
+        self.sites = {}
+        self.block = 0
+        self.read = False # The counters are only taken on the first read
+
+    def get(self, line_num, default=None):
+        return self.sites.get(line_num, default)
+
+    # Lines of file, an open copy of target_file
+    def lines(self, file):
+        chunk = []
+        first = None
+        for line_num, line in enumerate(file, 1):
+            stripped = line.strip()
+            if stripped.startswith('.type') and '@function' in stripped:
+                yield from self.function_lines(first, chunk)
+                chunk, first = [], line_num
+            if first is None:
+                yield line
+                continue
+            chunk.append(line)
+            if stripped.startswith('.cfi_endproc'):
+                yield from self.function_lines(first, chunk)
+                chunk, first = [], None
+        yield from self.function_lines(first, chunk)
+        self.read = True
+
+    def function_lines(self, first, chunk):
+        if not chunk:
+            return
+        stats = self.stats if not self.read else None
+        bodies = {}
+        function_instructions, general_instructions, self.block = parse_assembly_lines(chunk, None, bodies, None,
+                                                                                       first, self.block)
+        self.sites = analyze_functions(function_instructions, general_instructions, bodies, self.data,
+                                       self.symbol_index, stats, self.functions)
+        if stats is not None:
+            stats.counters['instructions'] += sum(len(insts) for insts in function_instructions.values())
+            stats.counters['patch_sites'] += len(self.sites)
+        trim_memo_tables()
+        yield from chunk
+        self.sites = {}
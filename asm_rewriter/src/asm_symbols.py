@@ -0,0 +1,120 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+symbols_logger = logging.getLogger('main')
+
+import codecs
+
+from elf_reader import Symbol
+from transfer_targets import SectionState, section_directives, data_sizes
+
+# Symbols of an assembly file as the native backend reads them from the object
+# the assembler makes of it: the labels defined in the given sections, except
+# the assembler-local .L labels, and the local common symbols (.local name /
+# .comm name,size,align), which the assembler allocates at the end of .bss.
+# Offsets follow the sizes of the data directives and the sections are laid
+# out back to back like elf_reader does, but without the code, which only the
+# assembler sizes: the addresses are not those of the native backend. The
+# analysis only matches the names.
+
+string_directives = {'.string': 1, '.asciz': 1, '.ascii': 0}
+space_directives = ('.zero', '.skip', '.space')
+alignment_directives = ('.align', '.balign', '.p2align')
+# The assembler creates these sections first, the others follow in order of appearance
+first_sections = ('.text', '.data', '.bss')
+
+def align_up(offset, alignment):
+    return -(-offset // alignment) * alignment
+
+class AsmSymbols(SectionState):
+    def __init__(self, section_names):
+        super().__init__()
+        self.section_names = section_names
+        self.order = list(first_sections)
+        self.offsets = {}
+        self.alignments = {}
+        self.labels = [] # (name, section, offset)
+        self.sizes = {}
+        self.local = set()
+        self.commons = [] # (name, size, alignment) of the local common symbols
+
+    # line: a stripped directive or label
+    def feed(self, line):
+        if line.startswith(section_directives):
+            self.switch(line)
+            if self.section not in self.order:
+                self.order.append(self.section)
+            return
+        if line.endswith(':'):
+            name = line[:-1]
+            if self.section in self.section_names and not name.startswith('.L'):
+                self.labels.append((name, self.section, self.offsets.get(self.section, 0)))
+            return
+        words = line.split(None, 1)
+        directive, argument = words[0], words[1] if len(words) == 2 else ''
+        try:
+            if directive == '.size':
+                name, size = argument.split(',', 1)
+                self.sizes[name.strip()] = int(size, 0)
+            elif directive == '.local':
+                self.local.update(name.strip() for name in argument.split(','))
+            elif directive in ('.comm', '.lcomm'):
+                name, *values = [value.strip() for value in argument.split(',')]
+                if directive == '.lcomm' or name in self.local:
+                    self.commons.append((name, int(values[0], 0), int(values[1], 0) if len(values) > 1 else 1))
+            else:
+                self.advance(directive, argument)
+        except ValueError:
+            pass # Symbolic sizes and counts
+
+    def advance(self, directive, argument):
+        offset = self.offsets.get(self.section, 0)
+        size = data_sizes.get(directive)
+        if size is not None:
+            offset += size * (argument.count(',') + 1)
+        elif directive in space_directives:
+            offset += int(argument.split(',')[0], 0)
+        elif directive in string_directives:
+            offset += len(codecs.escape_decode(argument.strip()[1:-1].encode())[0]) + string_directives[directive]
+        elif directive in alignment_directives:
+            alignment = int(argument.split(',')[0], 0)
+            if directive == '.p2align':
+                alignment = 1 << alignment
+            offset = align_up(offset, alignment)
+            self.alignments[self.section] = max(self.alignments.get(self.section, 1), alignment)
+        else:
+            return
+        self.offsets[self.section] = offset
+
+    def symbols(self):
+        entries = list(self.labels)
+        if '.bss' in self.section_names:
+            for name, size, alignment in self.commons:
+                offset = align_up(self.offsets.get('.bss', 0), alignment)
+                entries.append((name, '.bss', offset))
+                self.sizes.setdefault(name, size)
+                self.offsets['.bss'] = offset + size
+                self.alignments['.bss'] = max(self.alignments.get('.bss', 1), alignment)
+        bases = {}
+        address = 0
+        for section in self.order:
+            if section in self.section_names:
+                address = bases[section] = align_up(address, self.alignments.get(section, 1))
+                address += self.offsets.get(section, 0)
+        return [Symbol(name, bases[section] + offset, self.sizes.get(name, 0), section) for name, section, offset in entries]
+
+# Symbols of the assembly lines defined in section_names (see AsmSymbols)
+def read_asm_symbols(lines, section_names):
+    reader = AsmSymbols(section_names)
+    for line in lines:
+        line = line.strip()
+        if line and (line[0] == '.' or line.endswith(':')):
+            reader.feed(line)
+    symbols = reader.symbols()
+    if symbols_logger.isEnabledFor(logging.DEBUG):
+        for symbol in symbols:
+            symbols_logger.debug("  Symbol: %s at %#x (%s)", symbol.name, symbol.address, symbol.section)
+    return symbols
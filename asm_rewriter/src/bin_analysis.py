@@ -1,22 +1,83 @@
 from pathlib import Path
 import sys
+import os
 import logging
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 analysis_logger =  logging.getLogger('main')
 
-from binaryninja import *
-from binaryninja.binaryview import BinaryViewType
-from binaryninja.architecture import Architecture, ArchitectureHook
+from elf_reader import ElfError, read_symbols
+from asm_symbols import read_asm_symbols
 
-def process_binary(input_item):
+# Binary Ninja is only needed for the optional "binaryninja" backend
+try:
+    from binaryninja import *
+    from binaryninja.binaryview import BinaryViewType
+    from binaryninja.architecture import Architecture, ArchitectureHook
+    have_binaryninja = True
+except ImportError:
+    have_binaryninja = False
+
+interested_sections = {".bss", ".data", ".rodata"} # , ".text" For now, ignoring text sections
+
+class NativeBackend:
+    name = "native"
+    reads_assembly = False # process() takes the object file
+
+    def process(self, input_item):
+        analysis_logger.info("Analyzing the binary %s", input_item)
+        return read_symbols(input_item, interested_sections)
+
+class BinaryNinjaBackend:
+    name = "binaryninja"
+    reads_assembly = False
+
+    def __init__(self):
+        if not have_binaryninja:
+            raise RuntimeError("The binaryninja backend requires the Binary Ninja Python API")
+
+    def process(self, input_item):
+        with load(input_item.__str__(), options={"arch.x86.disassembly.syntax": "AT&T"}) as bv:
+            arch = Architecture['x86_64']
+            bn = BinAnalysis(bv, input_item)
+            return bn.analyze_binary()
+
+# Symbols straight from the assembly, without an object file (the path of the
+# assembly file, or its lines when it is only held in memory, see xfi_cc.py)
+class AssemblyBackend:
+    name = "asm"
+    reads_assembly = True
+
+    def process(self, input_item):
+        if isinstance(input_item, (str, os.PathLike)):
+            analysis_logger.info("Reading the symbols of %s", input_item)
+            with open(input_item, encoding='utf-8') as file:
+                return read_asm_symbols(file, interested_sections)
+        return read_asm_symbols(input_item, interested_sections)
+
+backend_types = {
+    NativeBackend.name: NativeBackend,
+    BinaryNinjaBackend.name: BinaryNinjaBackend,
+    AssemblyBackend.name: AssemblyBackend,
+}
+
+# Backends are created once per process and reused for every object file
+default_backend = os.environ.get("XFI_SYMBOL_BACKEND", NativeBackend.name)
+backends = {}
+
+def get_backend(name=None):
+    name = name or default_backend
+    if name not in backends:
+        if name not in backend_types:
+            raise ValueError(f"Unknown symbol backend: {name}")
+        backends[name] = backend_types[name]()
+    return backends[name]
+
+def process_binary(input_item, backend=None):
     # analysis_logger.info("Processing the binary %s", input_item)
-    with load(input_item.__str__(), options={"arch.x86.disassembly.syntax": "AT&T"}) as bv:
-        arch = Architecture['x86_64']
-        bn = BinAnalysis(bv, input_item)
-        return bn.analyze_binary()
-        
+    return get_backend(backend).process(input_item)
+
 class BinAnalysis:
     def find_instructions(self):
         settings = DisassemblySettings()
@@ -35,21 +96,19 @@ class BinAnalysis:
                             analysis_logger.info(f"Instruction using symbol {symbol.name} ({hex(symbol.address)}):")
                             analysis_logger.info(f"  {hex(addr)}: {instruction}")
 
-    
+
     def find_symbols(self, section):
         for symbol in self.bv.symbols.values():
             if isinstance(symbol, list):
                 for sym in symbol:
                     if section.start <= sym.address < section.end:
-                        analysis_logger.debug(f"  Symbol: {sym.name} at {hex(sym.address)}")
+                        analysis_logger.debug("  Symbol: %s at %#x", sym.name, sym.address)
                         self.symbols.append(sym)
-        print()
-        
+
     def print_sections(self):
-        interested_sections = {".bss", ".data", ".rodata"} # , ".text" For now, ignoring text sections
         for section in self.bv.sections.values():
             if section.name in interested_sections:
-                analysis_logger.info(f"Section: {section.name}")
+                analysis_logger.info("Section: %s", section.name)
                 # print(f"  Type: {section.type}")
                 # print(f"  Start: {hex(section.start)}")
                 # Calculate length based on start and end
@@ -64,10 +123,10 @@ class BinAnalysis:
     def analyze_binary(self):
         analysis_logger.info("Analyzing the binary %s", self.input)
         return self.print_sections()
-            
-        
+
+
     def __init__(self, bv, input_item):
         self.bv = bv
         self.symbols = []
         self.fun = None
-        self.input = input_item
\ No newline at end of file
+        self.input = input_item
@@ -0,0 +1,203 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+elf_logger = logging.getLogger('main')
+
+import mmap
+import struct
+from dataclasses import dataclass
+
+# ELF constants (see elf.h)
+ELFMAG = b'\x7fELF'
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ET_REL = 1
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_SYMTAB_SHNDX = 18
+SHF_ALLOC = 0x2
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+STT_SECTION = 3
+STT_FILE = 4
+
+# Elf64_Ehdr fields starting after e_ident
+ehdr_struct = struct.Struct('<HHIQQQIHHHHHH')
+# Elf64_Shdr
+shdr_struct = struct.Struct('<IIQQQQIIQQ')
+# Elf64_Sym
+sym_struct = struct.Struct('<IBBHQQ')
+
+class ElfError(Exception):
+    pass
+
+@dataclass(unsafe_hash=True)
+class Symbol:
+    name: str = None
+    address: int = 0
+    size: int = 0
+    section: str = None
+
+@dataclass
+class Section:
+    index: int
+    name: str
+    sh_type: int
+    flags: int
+    addr: int
+    offset: int
+    size: int
+    link: int
+    addralign: int
+    entsize: int
+
+    @property
+    def start(self):
+        return self.addr
+
+    @property
+    def end(self):
+        return self.addr + self.size
+
+class ElfReader:
+    def __init__(self, path):
+        self.path = str(path)
+        self.sections = []
+        self.e_type = None
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e: # Empty file
+            self._file.close()
+            raise ElfError(f"{self.path}: {e}") from None
+        try:
+            self._read_sections()
+        except (struct.error, IndexError):
+            self.close()
+            raise ElfError(f"{self.path}: truncated or malformed ELF file") from None
+        except ElfError:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _cstring(self, offset):
+        end = self._map.find(b'\0', offset)
+        if end < 0:
+            raise ElfError(f"{self.path}: unterminated string at {hex(offset)}")
+        return self._map[offset:end].decode('utf-8', 'replace')
+
+    def _read_sections(self):
+        mm = self._map
+        if mm[:4] != ELFMAG:
+            raise ElfError(f"{self.path}: not an ELF file")
+        if mm[4] != ELFCLASS64 or mm[5] != ELFDATA2LSB:
+            raise ElfError(f"{self.path}: only little-endian ELF64 is supported")
+
+        (self.e_type, _machine, _version, _entry, _phoff, shoff, _flags, _ehsize,
+         _phentsize, _phnum, shentsize, shnum, shstrndx) = ehdr_struct.unpack_from(mm, 16)
+        if shoff == 0:
+            raise ElfError(f"{self.path}: no section header table")
+
+        # Extended numbering: the real values live in the first section header
+        first = shdr_struct.unpack_from(mm, shoff)
+        if shnum == 0:
+            shnum = first[5]
+        if shstrndx == SHN_XINDEX:
+            shstrndx = first[6]
+
+        headers = [shdr_struct.unpack_from(mm, shoff + i * shentsize) for i in range(shnum)]
+        strtab_offset = headers[shstrndx][4]
+        for index, hdr in enumerate(headers):
+            name, sh_type, flags, addr, offset, size, link, _info, addralign, entsize = hdr
+            self.sections.append(Section(index, self._cstring(strtab_offset + name), sh_type,
+                                         flags, addr, offset, size, link, addralign, entsize))
+
+        if self.e_type == ET_REL:
+            self._layout_relocatable()
+
+    # Sections of a relocatable object all start at 0; lay the allocated ones out
+    # back to back (like Binary Ninja does) so every symbol gets a unique address.
+    def _layout_relocatable(self):
+        address = 0
+        for section in self.sections:
+            if not section.flags & SHF_ALLOC:
+                continue
+            align = max(section.addralign, 1)
+            address = (address + align - 1) & ~(align - 1)
+            section.addr = address
+            address += section.size
+
+    def section_by_name(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def symbols(self):
+        symtab = next((s for s in self.sections if s.sh_type == SHT_SYMTAB), None)
+        if symtab is None:
+            return
+        strtab = self.sections[symtab.link]
+        shndx_table = next((s for s in self.sections
+                            if s.sh_type == SHT_SYMTAB_SHNDX and s.link == symtab.index), None)
+
+        mm = self._map
+        entsize = symtab.entsize or sym_struct.size
+        for i in range(symtab.size // entsize):
+            st_name, st_info, _other, st_shndx, st_value, st_size = sym_struct.unpack_from(mm, symtab.offset + i * entsize)
+            # The reserved indices (SHN_ABS, SHN_COMMON, ...) are not sections; an
+            # index from the extended table can be anything, >= SHN_LORESERVE too
+            if st_shndx == SHN_XINDEX and shndx_table is not None:
+                st_shndx = struct.unpack_from('<I', mm, shndx_table.offset + i * 4)[0]
+            elif st_shndx >= SHN_LORESERVE:
+                st_shndx = None
+            yield st_name and self._cstring(strtab.offset + st_name), st_info, st_shndx, st_value, st_size
+
+    # Return the named symbols that fall inside the given sections
+    def find_symbols(self, section_names):
+        wanted = {s.index: s for s in self.sections if s.name in section_names}
+        found = {index: [] for index in wanted}
+        for name, st_info, st_shndx, st_value, st_size in self.symbols():
+            if not name or (st_info & 0xf) in (STT_SECTION, STT_FILE):
+                continue
+            if st_shndx is None or st_shndx == SHN_UNDEF or st_shndx not in wanted:
+                continue
+            section = wanted[st_shndx]
+            address = section.addr + st_value if self.e_type == ET_REL else st_value
+            if section.start <= address < section.end:
+                found[st_shndx].append(Symbol(name, address, st_size, section.name))
+
+        symbols = []
+        for index in sorted(found):
+            elf_logger.info("Section: %s", wanted[index].name)
+            if elf_logger.isEnabledFor(logging.DEBUG):
+                for sym in found[index]:
+                    elf_logger.debug("  Symbol: %s at %#x", sym.name, sym.address)
+            symbols.extend(found[index])
+        return symbols
+
+def read_symbols(path, section_names):
+    with ElfReader(path) as elf:
+        return elf.find_symbols(section_names)
@@ -0,0 +1,274 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+liveness_logger = logging.getLogger('main')
+
+import re
+from collections import namedtuple
+
+# General purpose register liveness over the instructions of one function, used
+# to pick scratch registers for the XFI macros. Registers are bits of an int
+# mask. Everything the model does not understand is treated conservatively:
+# unknown instructions read every register and write none, so a register is
+# only reported free when it is provably dead.
+
+gprs = ('rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rbp', 'rsp',
+        'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15')
+gpr_bits = {name: 1 << pos for pos, name in enumerate(gprs)}
+all_gprs = (1 << len(gprs)) - 1
+
+def mask_of(*names):
+    mask = 0
+    for name in names:
+        mask |= gpr_bits[name]
+    return mask
+
+def names_of(mask):
+    return [f"%{name}" for name in gprs if mask & gpr_bits[name]]
+
+# Register name -> (64-bit register, width)
+register_aliases = {}
+for full, dword, word, byte in (('rax', 'eax', 'ax', 'al'), ('rbx', 'ebx', 'bx', 'bl'), ('rcx', 'ecx', 'cx', 'cl'),
+                                ('rdx', 'edx', 'dx', 'dl'), ('rsi', 'esi', 'si', 'sil'), ('rdi', 'edi', 'di', 'dil'),
+                                ('rbp', 'ebp', 'bp', 'bpl'), ('rsp', 'esp', 'sp', 'spl')):
+    register_aliases.update({full: (full, 64), dword: (full, 32), word: (full, 16), byte: (full, 8)})
+for high, full in (('ah', 'rax'), ('bh', 'rbx'), ('ch', 'rcx'), ('dh', 'rdx')):
+    register_aliases[high] = (full, 8)
+for num in range(8, 16):
+    full = f"r{num}"
+    register_aliases.update({full: (full, 64), f"{full}d": (full, 32), f"{full}w": (full, 16), f"{full}b": (full, 8)})
+
+register_pattern = re.compile(r'%(\w+)')
+
+# SysV calling convention
+argument_registers = mask_of('rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9', 'rax') # rax: vector count of varargs calls
+caller_saved = mask_of('rax', 'rcx', 'rdx', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11')
+# Live when the function returns: return values, callee-saved registers and the stack pointer
+exit_live = mask_of('rax', 'rdx', 'rbx', 'rbp', 'rsp', 'r12', 'r13', 'r14', 'r15')
+
+# Instructions that only write their last operand / only read their operands
+write_only_mnemonics = ('mov', 'lea', 'cvt', 'pop')
+read_only_mnemonics = ('cmp', 'test', 'push', 'ucomis', 'comis', 'prefetch')
+# Read-modify-write arithmetic whose only register effects are its operands
+arithmetic_mnemonics = ('add', 'sub', 'and', 'or', 'xor', 'adc', 'sbb', 'neg', 'not', 'inc', 'dec',
+                        'shl', 'sal', 'shr', 'sar', 'rol', 'ror', 'cmov', 'set', 'bsf', 'bsr', 'xchg', 'imul', 'bswap')
+# Implicit effects: mnemonic -> (uses, defs)
+implicit_effects = {
+    'cltq': (mask_of('rax'), 0), 'cwtl': (mask_of('rax'), 0),
+    'cqto': (mask_of('rax'), mask_of('rdx')), 'cltd': (mask_of('rax'), mask_of('rdx')),
+    'leave': (mask_of('rbp'), mask_of('rbp', 'rsp')),
+    'nop': (0, 0), 'endbr64': (0, 0),
+}
+# One-operand multiply/divide: rdx:rax
+wide_arithmetic = ('mul', 'imul', 'div', 'idiv')
+
+BodyLine = namedtuple('BodyLine', ('line_num', 'label', 'mnemonic', 'operands'))
+
+def strip_suffix(mnemonic):
+    return mnemonic[:-1] if len(mnemonic) > 1 and mnemonic[-1] in 'bwlq' else mnemonic
+
+# (uses, defs) of the registers named by an operand that is written
+def operand_registers(operand, written):
+    uses = defs = 0
+    if '(' in operand or not operand.startswith('%'):
+        # Memory operand (or immediate): every register in it is an address input
+        for name in register_pattern.findall(operand):
+            if name in register_aliases:
+                uses |= gpr_bits[register_aliases[name][0]]
+        return uses, defs
+    alias = register_aliases.get(operand[1:])
+    if alias is None:
+        return 0, 0 # Not a general purpose register (%xmm0, ...)
+    bit = gpr_bits[alias[0]]
+    if not written:
+        return bit, 0
+    # 32- and 64-bit writes replace the whole register, narrower ones merge into it
+    return (0 if alias[1] >= 32 else bit), bit
+
+def operands_read(operands):
+    uses = 0
+    for operand in operands:
+        uses |= operand_registers(operand, False)[0]
+    return uses
+
+# (uses, defs) of a non-control-flow instruction, or None if it is not modelled
+def instruction_effects(mnemonic, operands):
+    if mnemonic in implicit_effects:
+        return implicit_effects[mnemonic]
+    base = strip_suffix(mnemonic)
+    if base in wide_arithmetic and len(operands) == 1:
+        return operands_read(operands) | mask_of('rax', 'rdx'), mask_of('rax', 'rdx')
+    if not operands or mnemonic.startswith(('cmpxchg', 'xadd')):
+        return None
+    # String instructions (movsb, movsq, ...) only come without operands
+    if mnemonic.startswith(('cmov', 'set', 'bsf', 'bsr', 'xchg')) or base in arithmetic_mnemonics:
+        *sources, dest = operands
+        dest_uses, dest_defs = operand_registers(dest, True)
+        return operands_read(sources) | dest_uses | dest_defs, dest_defs
+    if mnemonic.startswith(write_only_mnemonics):
+        *sources, dest = operands
+        dest_uses, dest_defs = operand_registers(dest, True)
+        uses = operands_read(sources) | dest_uses
+        if base == 'pop':
+            return uses | gpr_bits['rsp'], dest_defs | gpr_bits['rsp']
+        return uses, dest_defs
+    if mnemonic.startswith(read_only_mnemonics):
+        uses = operands_read(operands)
+        if mnemonic.startswith('push'):
+            return uses | gpr_bits['rsp'], gpr_bits['rsp']
+        return uses, 0
+    if any(operand.startswith('%xmm') or operand.startswith('%ymm') for operand in operands):
+        # SSE/AVX arithmetic: general purpose registers are only read (addresses)
+        return operands_read(operands), 0
+    return None
+
+# Instructions (without size suffix) that only read their memory operands
+load_only_mnemonics = {'cmp', 'test', 'push', 'bt', 'nop', 'mul', 'imul', 'div', 'idiv'}
+
+def is_memory_operand(operand):
+    return '(' in operand or not operand.startswith(('%', '$'))
+
+# Memory operands an instruction writes
+def stored_operands(mnemonic, operands):
+    if not operands or strip_suffix(mnemonic) in load_only_mnemonics or mnemonic.startswith(('ucomis', 'comis', 'prefetch')):
+        return ()
+    if mnemonic.startswith(('xchg', 'xadd', 'cmpxchg')):
+        return [operand for operand in operands if is_memory_operand(operand)]
+    return operands[-1:] if is_memory_operand(operands[-1]) else ()
+
+def local_target(operands, labels, count):
+    if len(operands) == 1 and labels.get(operands[0], count) < count:
+        return labels[operands[0]]
+    return None
+
+# (mnemonic, operands) -> (uses, defs, flow), one entry per distinct instruction
+flow_table = {}
+
+# Register effects and control flow of an instruction. flow is 'next' (falls
+# through), 'exit' (no successor in the function) or 'jump' (depends on
+# whether the target is a label of the function)
+def instruction_flow(mnemonic, operands):
+    key = (mnemonic, operands)
+    entry = flow_table.get(key)
+    if entry is None:
+        entry = flow_table[key] = decode_flow(mnemonic, operands)
+    return entry
+
+def decode_flow(mnemonic, operands):
+    if mnemonic is None:
+        return all_gprs, 0, 'next'
+    if mnemonic.startswith('ret'):
+        return exit_live, 0, 'exit'
+    if mnemonic.startswith('call'):
+        return operands_read(operands) | argument_registers | gpr_bits['rsp'], caller_saved, 'next'
+    if mnemonic.startswith('j'):
+        return 0, 0, 'jump'
+    if mnemonic.startswith(('ud2', 'hlt')):
+        return 0, 0, 'exit'
+    effect = instruction_effects(mnemonic, operands)
+    return (*effect, 'next') if effect is not None else (all_gprs, 0, 'next')
+
+# Registers the instructions of body write. With -fipa-ra, GCC lets the callers
+# of a function of the same unit keep values across the call in the
+# caller-saved registers it never writes, so only these are free in it at all.
+# Calls are left out: their callee may write fewer registers than the ABI allows.
+def written_registers(body):
+    written = 0
+    for entry in body:
+        if entry.mnemonic is not None and not entry.mnemonic.startswith('call'):
+            written |= instruction_flow(entry.mnemonic, entry.operands)[1]
+    return written
+
+# Live-in/live-out masks and the (uses, defs) of every instruction in body (a
+# list of BodyLine, labels included). Returns a list of
+# (BodyLine, live_in, live_out, uses, defs) for the instructions only.
+def function_liveness(body):
+    insts = []
+    labels = {}
+    for entry in body:
+        if entry.label is not None:
+            labels[entry.label] = len(insts)
+        else:
+            insts.append(entry)
+    count = len(insts)
+    label_targets = sorted(set(target for target in labels.values() if target < count))
+
+    effects = []
+    successors = []
+    for pos, inst in enumerate(insts):
+        mnemonic, operands = inst.mnemonic, inst.operands
+        uses, defs, flow = instruction_flow(mnemonic, operands)
+        following = [pos + 1] if pos + 1 < count else []
+        if flow == 'next':
+            effects.append((uses, defs))
+            successors.append(following)
+        elif flow == 'exit':
+            effects.append((uses, defs))
+            successors.append([])
+        else:
+            target = local_target(operands, labels, count)
+            if target is not None:
+                effects.append((0, 0))
+                successors.append([target] if mnemonic.startswith('jmp') else [target] + following)
+            elif mnemonic.startswith('jmp') and operands and operands[0].startswith('*'):
+                # Indirect jump: a jump table entry in this function, or a tail call
+                effects.append((operands_read(operands) | exit_live | argument_registers, 0))
+                successors.append(label_targets)
+            elif mnemonic.startswith('jmp'):
+                # Tail call
+                effects.append((all_gprs, 0))
+                successors.append([])
+            else:
+                effects.append((all_gprs, 0))
+                successors.append(following)
+
+    # Solve at basic block granularity: blocks start at branch targets and after
+    # anything that does not just fall through
+    leaders = {0} | set(label_targets)
+    for pos, succ in enumerate(successors):
+        if succ != [pos + 1]:
+            leaders.add(pos + 1)
+    starts = sorted(leader for leader in leaders if leader < count)
+    block_of = {start: block for block, start in enumerate(starts)}
+    ends = starts[1:] + [count]
+    block_succs = []
+    gen = []
+    kill = []
+    for start, end in zip(starts, ends):
+        block_succs.append([block_of[succ] for succ in successors[end - 1]])
+        block_gen = block_kill = 0
+        for pos in range(end - 1, start - 1, -1):
+            uses, defs = effects[pos]
+            block_gen = uses | (block_gen & ~defs)
+            block_kill |= defs
+        gen.append(block_gen)
+        kill.append(block_kill)
+
+    block_in = [0] * len(starts)
+    block_out = [0] * len(starts)
+    changed = True
+    while changed:
+        changed = False
+        for block in range(len(starts) - 1, -1, -1):
+            out = 0
+            for succ in block_succs[block]:
+                out |= block_in[succ]
+            block_out[block] = out
+            new_in = gen[block] | (out & ~kill[block])
+            if new_in != block_in[block]:
+                block_in[block] = new_in
+                changed = True
+
+    live_in = [0] * count
+    live_out = [0] * count
+    for block, (start, end) in enumerate(zip(starts, ends)):
+        live = block_out[block]
+        for pos in range(end - 1, start - 1, -1):
+            live_out[pos] = live
+            uses, defs = effects[pos]
+            live = uses | (live & ~defs)
+            live_in[pos] = live
+    return [(inst, live_in[pos], live_out[pos], *effects[pos]) for pos, inst in enumerate(insts)]
@@ -0,0 +1,284 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+cost_logger = logging.getLogger('main')
+
+import re
+import contextlib
+from collections import Counter
+from dataclasses import replace
+
+# rewriter imports main, which imports this module while rewriter is still
+# half initialised: its names are looked up at call time
+import rewriter
+from run_stats import FileStats
+
+# Static cost of the rewriting, without touching the assembly file: every
+# patched site is expanded through the macros of the header the rewriter would
+# emit, and the instructions of the expansion are counted and sized. Sizes are
+# an estimate from the operand forms (prefixes, ModRM/SIB, displacement and
+# immediate widths), not an encoding; they are meant for comparing sites and
+# files, the assembler has the final word.
+
+macro_pattern = re.compile(r'\\(\w+)')
+memory_pattern = re.compile(r'(?:%\w+:)?([-\w.+]*)\((%\w+)?(?:,(%\w+)(?:,\d)?)?\)')
+extended_registers = re.compile(r'%(?:r(?:8|9|1[0-5])[dwb]?|sil|dil|bpl|spl)\b')
+
+# Encodings whose size does not depend on the operands
+fixed_sizes = {'rdgsbase': 5, 'wrgsbase': 5, 'ret': 1, 'int3': 1, 'nop': 1, 'cltq': 2, 'cqto': 2,
+               'leave': 1, 'ud2': 2, 'endbr64': 4}
+# Size suffixes that do not add a REX.W prefix
+no_rex_w = ('push', 'pop', 'call', 'jmp')
+
+# Macros of a header: name -> (parameters, body lines); parameters are (name, default)
+class MacroHeader:
+    def __init__(self, header):
+        self.macros = {}
+        name = None
+        for line in header.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('.macro'):
+                words = line.split(None, 2)
+                name = words[1]
+                params = []
+                for param in split_arguments(words[2]) if len(words) == 3 else []:
+                    param_name, _, default = param.partition('=')
+                    params.append((param_name.strip(), default.strip()))
+                self.macros[name] = (params, [])
+            elif line.startswith('.endm'):
+                name = None
+            elif name is not None and line:
+                self.macros[name][1].append(line)
+
+    # Instructions (mnemonic, operands) of a piece of assembly text
+    def expand(self, text):
+        insts = []
+        for line in text.splitlines():
+            self.expand_line(line.split('#', 1)[0].strip(), insts)
+        return insts
+
+    def expand_line(self, line, insts):
+        if not line or line.startswith('.') or line.endswith(':'):
+            return
+        words = line.split(None, 1)
+        mnemonic, operands = words[0], split_arguments(words[1]) if len(words) == 2 else []
+        if mnemonic not in self.macros:
+            insts.append((mnemonic, operands))
+            return
+        params, body = self.macros[mnemonic]
+        values = {name: default for name, default in params}
+        for position, argument in enumerate(operands):
+            name, equals, value = argument.partition('=')
+            if equals and name.strip() in values:
+                values[name.strip()] = value.strip()
+            elif position < len(params):
+                values[params[position][0]] = argument
+        # .if nesting: (emitting, a branch was already taken)
+        conditions = []
+        for body_line in body:
+            body_line = macro_pattern.sub(lambda match: values.get(match.group(1), match.group(0)), body_line)
+            directive = body_line.split(None, 1)
+            emitting = all(state[0] for state in conditions)
+            if directive[0] == '.if':
+                taken = emitting and condition(directive[1])
+                conditions.append((taken, taken))
+            elif directive[0] == '.elseif':
+                emitting, done = conditions[-1]
+                taken = not done and all(state[0] for state in conditions[:-1]) and condition(directive[1])
+                conditions[-1] = (taken, done or taken)
+            elif directive[0] == '.else':
+                emitting, done = conditions[-1]
+                conditions[-1] = (not done and all(state[0] for state in conditions[:-1]), True)
+            elif directive[0] == '.endif':
+                conditions.pop()
+            elif emitting:
+                self.expand_line(body_line, insts)
+
+def condition(expression):
+    left, equals, right = expression.partition('==')
+    try:
+        if equals:
+            return int(left.strip(), 0) == int(right.strip(), 0)
+        return int(expression.strip(), 0) != 0
+    except ValueError:
+        return False
+
+# Splits operands/arguments at the commas outside parentheses
+def split_arguments(text):
+    arguments = []
+    depth = 0
+    current = ''
+    for char in text:
+        if char == ',' and depth == 0:
+            arguments.append(current.strip())
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    if current.strip():
+        arguments.append(current.strip())
+    return arguments
+
+def displacement_bytes(displacement, base):
+    if displacement in ('', '0'):
+        return 1 if base in ('%rbp', '%r13') else 0
+    try:
+        return 1 if -128 <= int(displacement, 0) <= 127 else 4
+    except ValueError:
+        return 4 # Symbolic
+
+# Estimated encoding size of one instruction
+def instruction_bytes(mnemonic, operands):
+    if mnemonic in fixed_sizes:
+        return fixed_sizes[mnemonic]
+    direct = operands and not operands[0].startswith('*') and '%' not in operands[0]
+    if mnemonic.startswith('j') and direct:
+        return 5 if mnemonic == 'jmp' else 6
+    if mnemonic.startswith('call') and direct:
+        return 5
+    text = ' '.join(operands)
+    if mnemonic.startswith(('push', 'pop')) and len(operands) == 1 and operands[0].startswith('%'):
+        return 1 + bool(extended_registers.search(text))
+    size = 2 # Opcode and ModRM
+    if (mnemonic.endswith('q') and not mnemonic.startswith(no_rex_w)) or extended_registers.search(text):
+        size += 1 # REX
+    if mnemonic.endswith('w') and not mnemonic.startswith('movz'):
+        size += 1 # Operand size prefix
+    if mnemonic.startswith('movz'):
+        size += 1 # Two-byte opcode
+    for operand in operands:
+        operand = operand.lstrip('*')
+        if operand.startswith('$'):
+            if mnemonic.startswith('mov'):
+                size += {'b': 1, 'w': 2}.get(mnemonic[-1], 4)
+            else:
+                try:
+                    size += 1 if -128 <= int(operand[1:], 0) <= 127 else 4
+                except ValueError:
+                    size += 4
+            continue
+        if ':' in operand:
+            size += 1 # Segment prefix
+        match = memory_pattern.fullmatch(operand)
+        if match is None:
+            if not operand.startswith('%'):
+                size += 4 # Absolute address
+            continue
+        displacement, base, index = match.groups()
+        if base == '%rip':
+            size += 4
+            continue
+        if index is not None or base in ('%rsp', '%r12') or base is None:
+            size += 1 # SIB
+        size += 4 if base is None else displacement_bytes(displacement, base)
+    return size
+
+# (addressing mode, text) -> (instructions, bytes)
+cost_table = {}
+header_table = {}
+
+def text_cost(text, addressing="delta"):
+    key = (addressing, text)
+    cost = cost_table.get(key)
+    if cost is None:
+        header = header_table.get(addressing)
+        if header is None:
+            header = header_table[addressing] = MacroHeader(rewriter.addressing_headers[addressing])
+        insts = header.expand(text)
+        cost = cost_table[key] = (len(insts), sum(instruction_bytes(mnemonic, operands) for mnemonic, operands in insts))
+    return cost
+
+def is_instruction(line):
+    return bool(line) and not line.startswith(('.', '#')) and not line.endswith(':')
+
+# Access width in bits of a memory site, None for the other sites
+def operand_size(inst):
+    if not rewriter.sets_delta(inst):
+        return None
+    value = rewriter.operand_value(inst)
+    return value if value < 100 else value // 100
+
+def elision(inst, options):
+    if rewriter.elides_shadow_stack(inst, options):
+        return f"shadow stack ({inst.shadow_class})"
+    if options.ctrl_flow_elision and inst.resolved_target is not None:
+        return f"target {inst.resolved_target}"
+    return None
+
+# Dry run of the rewriter on target_file: the sites of patch_plan with the
+# macro, operand size and estimated cost of each, per function, plus the totals
+# of the file. The file is only read. With compare, the code size of both
+# emissions (all inline, all outlined) is added per function and file. lines
+# are those of target_file when it is only held in memory.
+def plan_file(target_file, patch_plan, options=None, stats=None, compare=True, lines=None):
+    if options is None:
+        options = rewriter.RewriteOptions()
+    if stats is None:
+        stats = FileStats()
+    patch_counts = Counter()
+    functions = {}
+    fixed = [0, 0] # end_macros
+    trampolines = rewriter.Trampolines(options.addressing) if options.emission == "outlined" else None
+    outlined = rewriter.outlined_functions(target_file, patch_plan, options, lines) if trampolines is not None else None
+    inline_sites = rewriter.profile_inline_sites(target_file, options)
+    with open(target_file, encoding='utf-8') if lines is None else contextlib.nullcontext(lines) as file:
+        planned = rewriter.plan_lines(patch_plan, file)
+        for line_num, function_name, inst, text, macro in rewriter.patch_lines(planned, patch_plan, options, stats, patch_counts,
+                                                                               trampolines, outlined, None, inline_sites):
+            if line_num is None:
+                fixed = list(text_cost(text, options.addressing))
+                continue
+            if function_name is None:
+                continue
+            function = functions.get(function_name)
+            if function is None:
+                function = functions[function_name] = {"name": function_name, "original_instructions": 0,
+                                                        "instructions": 0, "bytes": 0, "sites": []}
+            if inst is None:
+                function["original_instructions"] += is_instruction(text.strip())
+                continue
+            reason = elision(inst, options)
+            if macro is None and reason is None:
+                continue # Direct call or jump
+            original_text = f"{inst.opcode}{inst.prefix} {', '.join(op for op in (inst.src, inst.dest) if op)}".strip()
+            if inst.opcode != ".cfi_startproc":
+                function["original_instructions"] += 1
+            if macro is not None:
+                added = text_cost(text, options.addressing)
+                removed = (0, 0) if inst.opcode == ".cfi_startproc" else text_cost(original_text, options.addressing)
+                instructions, size = added[0] - removed[0], added[1] - removed[1]
+            else:
+                instructions = size = 0
+            function["instructions"] += instructions
+            function["bytes"] += size
+            function["sites"].append({"line": line_num, "instruction": original_text, "macro": macro,
+                                      "operand_size": operand_size(inst), "instructions": instructions,
+                                      "bytes": size, "elided": reason})
+    # Trampolines are counted in every file using them, the linker keeps one copy
+    shared = text_cost(trampolines.text(), options.addressing) if trampolines is not None else (0, 0)
+    function_list = list(functions.values())
+    plan = {
+        "instructions": sum(function["instructions"] for function in function_list) + fixed[0] + shared[0],
+        "bytes": sum(function["bytes"] for function in function_list) + fixed[1] + shared[1],
+        "original_instructions": sum(function["original_instructions"] for function in function_list),
+        "runtime_instructions": fixed[0],
+        "runtime_bytes": fixed[1],
+        "trampolines": len(trampolines.bodies) if trampolines is not None else 0,
+        "trampoline_bytes": shared[1],
+        "patches": dict(sorted(patch_counts.items())),
+        "functions": function_list,
+    }
+    if compare:
+        plan["emission_bytes"] = {}
+        for emission in ("inline", "outlined"):
+            other = replace(options, emission=emission, outline_threshold=0)
+            other_plan = plan if other == options else plan_file(target_file, patch_plan, other, FileStats(), compare=False,
+                                                                 lines=lines)[0]
+            plan["emission_bytes"][emission] = other_plan["bytes"]
+            sizes = {function["name"]: function["bytes"] for function in other_plan["functions"]}
+            for function in function_list:
+                function.setdefault("emission_bytes", {})[emission] = sizes[function["name"]]
+    return plan, patch_counts
@@ -3,15 +3,20 @@ import sys
 import logging
 from typing import *
 
-from asm_analysis import PatchingInst, parse_assembly_line, OperandData
+from asm_analysis import PatchingInst, OperandData, StreamingPlan
+from run_stats import FileStats
+from liveness import gpr_bits, register_aliases, register_pattern
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 # Get the same logger instance. Use __name__ to get a logger with a hierarchical name or a specific string to get the exact same logger.
 rewriter_logger = logging.getLogger('main')
 
-import fileinput
+import tempfile
+import hashlib
+from dataclasses import dataclass, replace
 import time
+from collections import Counter
 import os
 import shutil
 import re
@@ -22,124 +27,278 @@ if parent_dir not in sys.path:
     sys.path.append(parent_dir)
 
 import main
+import patch_cost
+import site_profile
+from analysis_cache import file_digest
 
-asm_macros = """.section .data
+# Address of the sandbox region (create_xfi in input/xfi.c). The mask keeps only
+# its bit, which recovers the region start from any address in the region: the
+# loader keeps the region, sized in whole 2 MB huge pages, below that alignment.
+sandbox_base = 0x100000000000
+
+macro_data = f""".section .data
     .extern base_address
     .extern shadow_stack_ptr
-    mask: .quad 0x100000000000  # Mask to keep only the topmost bit
+    mask: .quad {sandbox_base:#x}  # Mask to keep only the topmost bit
+"""
+
+delta_xfi_delta = """
+.macro xfi_delta delta=%r15
+    rdgsbase \\delta
+    andq    mask(%rip), \\delta  # Use the fixed mask to keep only the topmost bit
+    subq    base_address(%rip), \\delta  # sandbox delta, reused by the _bb macros in the same basic block
+.endm
+"""
+
+memory_macros = """
+# Scratch registers: tmp holds the translated address, delta the sandbox delta.
+# The rewriter passes registers that are dead at the site (see liveness.py).
+.macro lea_load_xfi addr, op, value, tmp=%r14, delta=%r15
+    xfi_delta \\delta
+    lea_load_xfi_bb \\addr, \\op, \\value, \\tmp, \\delta
+.endm
 
-.macro lea_load_xfi addr, op, value
+.macro lea_load_xfi_bb addr, op, value, tmp=%r14, delta=%r15
     leaq    \\addr, \\op
-    rdgsbase %r15
-    andq    mask(%rip), %r15  # Use the fixed mask to keep only the topmost bit
-    movq    base_address(%rip), %r14
-    subq    %r14, \\op
-    addq    %r15, \\op
+    addq    \\delta, \\op
 .endm
 
-.macro mov_load_xfi addr, op, value
-    rdgsbase %r15
-    andq    mask(%rip), %r15  # Use the fixed mask to keep only the topmost bit
-    leaq    \\addr, %r14
-    movq    base_address(%rip), %r13
-    subq    %r13, %r14
-    addq    %r15, %r14
+.macro mov_load_xfi addr, op, value, tmp=%r14, delta=%r15
+    xfi_delta \\delta
+    mov_load_xfi_bb \\addr, \\op, \\value, \\tmp, \\delta
+.endm
+
+.macro mov_load_xfi_bb addr, op, value, tmp=%r14, delta=%r15
+    leaq    \\addr, \\tmp
+    addq    \\delta, \\tmp
     .if \\value == 8
-        movb (%r14), \\op  # 8-bit 
+        movb (\\tmp), \\op  # 8-bit 
     .elseif \\value == 16
-        movw (%r14), \\op  # 16-bit
+        movw (\\tmp), \\op  # 16-bit
     .elseif \\value == 32
-        movl (%r14), \\op  # 32-bit
+        movl (\\tmp), \\op  # 32-bit
     .elseif \\value == 64
-        movq (%r14), \\op  # 64-bit
+        movq (\\tmp), \\op  # 64-bit
     .endif
 .endm
 
-.macro movz_load_xfi addr, op, value
-    rdgsbase %r15
-    andq    mask(%rip), %r15  # Use the fixed mask to keep only the topmost bit
-    leaq    \\addr, %r14
-    movq    base_address(%rip), %r13
-    subq    %r13, %r14
-    addq    %r15, %r14
+.macro movz_load_xfi addr, op, value, tmp=%r14, delta=%r15
+    xfi_delta \\delta
+    movz_load_xfi_bb \\addr, \\op, \\value, \\tmp, \\delta
+.endm
+
+.macro movz_load_xfi_bb addr, op, value, tmp=%r14, delta=%r15
+    leaq    \\addr, \\tmp
+    addq    \\delta, \\tmp
     .if \\value == 816
-        movzbw (%r14), \\op  # 8-bit to 16-bit zero-extension
+        movzbw (\\tmp), \\op  # 8-bit to 16-bit zero-extension
     .elseif \\value == 832
-        movzbl (%r14), \\op  # 8-bit to 32-bit zero-extension
+        movzbl (\\tmp), \\op  # 8-bit to 32-bit zero-extension
     .elseif \\value == 864
-        movzbq (%r14), \\op  # 8-bit to 64-bit zero-extension
+        movzbq (\\tmp), \\op  # 8-bit to 64-bit zero-extension
     .elseif \\value == 1632
-        movzwl (%r14), \\op  # 16-bit to 32-bit zero-extension
+        movzwl (\\tmp), \\op  # 16-bit to 32-bit zero-extension
     .elseif \\value == 1664
-        movzwq (%r14), \\op  # 16-bit to 64-bit zero-extension
+        movzwq (\\tmp), \\op  # 16-bit to 64-bit zero-extension
     .elseif \\value == 3264
-        movzlq (%r14), \\op  # 32-bit to 64-bit zero-extension
+        movzlq (\\tmp), \\op  # 32-bit to 64-bit zero-extension
     .endif
 .endm
 
-.macro mov_store_xfi addr, op, value
-    rdgsbase %r15
-    andq    mask(%rip), %r15  # Use the fixed mask to keep only the topmost bit
-    leaq    \\addr, %r14
-    movq    base_address(%rip), %r13
-    subq    %r13, %r14
-    addq    %r15, %r14
+.macro mov_store_xfi addr, op, value, tmp=%r14, delta=%r15
+    xfi_delta \\delta
+    mov_store_xfi_bb \\addr, \\op, \\value, \\tmp, \\delta
+.endm
+
+.macro mov_store_xfi_bb addr, op, value, tmp=%r14, delta=%r15
+    leaq    \\addr, \\tmp
+    addq    \\delta, \\tmp
     .if \\value == 8
-        movb \\op, (%r14)  # 8-bit 
+        movb \\op, (\\tmp)  # 8-bit 
     .elseif \\value == 16
-        movw \\op, (%r14)  # 16-bit
+        movw \\op, (\\tmp)  # 16-bit
     .elseif \\value == 32
-        movl \\op, (%r14)  # 32-bit
+        movl \\op, (\\tmp)  # 32-bit
     .elseif \\value == 64
-        movq \\op, (%r14)  # 64-bit
+        movq \\op, (\\tmp)  # 64-bit
     .endif
 .endm
+"""
 
-.macro ctrl_flow_xfi addr, mem 
-    rdgsbase %r15
-    xorq    mask(%rip), %r15  # Use the fixed mask to keep only the bottommost bit
+delta_transfer_macros = """
+.macro ctrl_flow_xfi addr, mem, tmp=%r14, bound=%r15
+    rdgsbase \\bound
+    xorq    mask(%rip), \\bound  # Use the fixed mask to keep only the bottommost bit
     .if \\mem    # mem indicates whether addr is memory or reg
-        leaq    \\addr, %r14
+        leaq    \\addr, \\tmp
     .else
-        movq    \\addr, %r14
+        movq    \\addr, \\tmp
     .endif
-    movq    base_address(%rip), %r13
-    subq    %r13, %r14
-    cmpq    %r15, %r14    # Compare %r14 with %r15
-    # Conditional jump if %r14 is not less than %r15 to the interrupt
+    subq    base_address(%rip), \\tmp
+    cmpq    \\bound, \\tmp    # Compare the target with the bound
+    # Conditional jump if the target is not below the bound to the interrupt
     jge     trigger_interrupt
 .endm
 
-.macro ret_xfi
-	rdgsbase %r15
-    xorq    mask(%rip), %r15  # Use the fixed mask to keep only the bottommost bit
-    movq    (%rsp), %r14
-    movq    base_address(%rip), %r13
-    subq    %r13, %r14
-    cmpq    %r15, %r14    # Compare %r14 with %r15
+# A single scratch register (tmp): the bound is rebased to an address instead of
+# rebasing the return address. bound is kept so both modes take the same arguments.
+.macro ret_xfi tmp=%r14, bound=%r15, save=0
+    .if \\save
+    movq    \\tmp, -8(%rsp)
+    .endif
+	rdgsbase \\tmp
+    xorq    mask(%rip), \\tmp  # Use the fixed mask to keep only the bottommost bit
+    addq    base_address(%rip), \\tmp    # The bound as an address
+    cmpq    \\tmp, (%rsp)    # Compare the return address with the bound
+    .if \\save
+    movq    -8(%rsp), \\tmp
+    .endif
     jge     trigger_interrupt
 .endm
+"""
+
+stack_macros = """
+# Used when no scratch register is dead at a site: the saved register goes
+# below the red zone, which leaf functions may be using
+.macro xfi_spill reg
+    leaq    -128(%rsp), %rsp
+    pushq   \\reg
+.endm
 
-.macro push_shadow_stack
-    movq    shadow_stack_ptr(%rip), %r10
-    movq    (%rsp), %r11        # Save the return address of caller function to %r11
-    movq    %r11, (%r10)        # Store return address in shadow stack
-    addq    $8, %r10            # Move shadow stack pointer
-    movq    %r10, shadow_stack_ptr(%rip)  # Update shadow stack pointer
+.macro xfi_reload reg
+    popq    \\reg
+    leaq    128(%rsp), %rsp
+.endm
+
+# The shadow stack checks run where the red zone is free (function entry and
+# return), so with save=1 they keep tmp there instead of moving %rsp
+.macro push_shadow_stack tmp=%r10, save=0
+    .if \\save
+    movq    \\tmp, -16(%rsp)
+    .endif
+    movq    shadow_stack_ptr(%rip), \\tmp
+    pushq   (%rsp)              # Copy the return address of caller function...
+    popq    (\\tmp)               # ...to the shadow stack
+    addq    $8, shadow_stack_ptr(%rip)    # Move shadow stack pointer
+    .if \\save
+    movq    -16(%rsp), \\tmp
+    .endif
 .endm
 
+# trigger_interrupt reads the return address back from the shadow stack
 .macro pop_shadow_stack
     subq    $8, shadow_stack_ptr(%rip)    # Move shadow stack pointer back
-    movq    shadow_stack_ptr(%rip), %r10
-    movq    (%r10), %r11          	# Retrieve return address from shadow stack
 .endm
 """
 
-end_macros="""
+# %gs: addressing: the loader sets the GS base to the sandbox delta itself
+# (region - load base, see create_xfi in input/xfi.c), so %gs:addr reaches the
+# sandbox copy of whatever addr names, with the offset resolved by the normal
+# relocation of addr. The weak xfi_gs_addressing object tells the loader which
+# mode the program was rewritten in.
+gs_data = """    .extern xfi_text_bound
+    .weak   xfi_gs_addressing
+    .type   xfi_gs_addressing, @object
+    .size   xfi_gs_addressing, 1
+xfi_gs_addressing: .byte 1
+"""
+
+gs_xfi_delta = """
+.macro xfi_delta delta=%r15
+    rdgsbase \\delta  # The GS base is the sandbox delta, reused by the _bb macros in the same basic block
+.endm
+"""
+
+# lea only computes an address and ignores the segment, so it keeps the delta macros
+gs_memory_macros = """
+.macro mov_load_xfi_gs addr, op, value
+    .if \\value == 8
+        movb %gs:\\addr, \\op  # 8-bit
+    .elseif \\value == 16
+        movw %gs:\\addr, \\op  # 16-bit
+    .elseif \\value == 32
+        movl %gs:\\addr, \\op  # 32-bit
+    .elseif \\value == 64
+        movq %gs:\\addr, \\op  # 64-bit
+    .endif
+.endm
+
+.macro movz_load_xfi_gs addr, op, value
+    .if \\value == 816
+        movzbw %gs:\\addr, \\op  # 8-bit to 16-bit zero-extension
+    .elseif \\value == 832
+        movzbl %gs:\\addr, \\op  # 8-bit to 32-bit zero-extension
+    .elseif \\value == 864
+        movzbq %gs:\\addr, \\op  # 8-bit to 64-bit zero-extension
+    .elseif \\value == 1632
+        movzwl %gs:\\addr, \\op  # 16-bit to 32-bit zero-extension
+    .elseif \\value == 1664
+        movzwq %gs:\\addr, \\op  # 16-bit to 64-bit zero-extension
+    .elseif \\value == 3264
+        movzlq %gs:\\addr, \\op  # 32-bit to 64-bit zero-extension
+    .endif
+.endm
+
+.macro mov_store_xfi_gs addr, op, value
+    .if \\value == 8
+        movb \\op, %gs:\\addr  # 8-bit
+    .elseif \\value == 16
+        movw \\op, %gs:\\addr  # 16-bit
+    .elseif \\value == 32
+        movl \\op, %gs:\\addr  # 32-bit
+    .elseif \\value == 64
+        movq \\op, %gs:\\addr  # 64-bit
+    .endif
+.endm
+"""
+
+# The GS base no longer encodes the end of .text: the loader stores its offset
+# in xfi_text_bound. bound is kept so both modes take the same arguments.
+gs_transfer_macros = """
+.macro ctrl_flow_xfi addr, mem, tmp=%r14, bound=%r15
+    .if \\mem    # mem indicates whether addr is memory or reg
+        leaq    \\addr, \\tmp
+    .else
+        movq    \\addr, \\tmp
+    .endif
+    subq    base_address(%rip), \\tmp
+    cmpq    xfi_text_bound(%rip), \\tmp    # Compare the target with the end of .text
+    # Conditional jump if the target is not below the bound to the interrupt
+    jge     trigger_interrupt
+.endm
+
+.macro ret_xfi tmp=%r14, bound=%r15, save=0
+    .if \\save
+    movq    \\tmp, -8(%rsp)
+    .endif
+    movq    (%rsp), \\tmp
+    subq    base_address(%rip), \\tmp
+    cmpq    xfi_text_bound(%rip), \\tmp    # Compare the return address with the end of .text
+    .if \\save
+    movq    -8(%rsp), \\tmp
+    .endif
+    jge     trigger_interrupt
+.endm
+"""
+
+asm_macros = macro_data + delta_xfi_delta + memory_macros + delta_transfer_macros + stack_macros
+gs_asm_macros = macro_data + gs_data + gs_xfi_delta + memory_macros + gs_memory_macros + gs_transfer_macros + stack_macros
+
+# Addressing mode (RewriteOptions.addressing) -> macro header
+addressing_headers = {
+    "delta": asm_macros,
+    "gs": gs_asm_macros,
+}
+
+# Compares (%rsp) with the return address on top of the shadow stack (the one
+# pop_shadow_stack just dropped), leaving every register alone
+shadow_stack_compare = ("\tmovq    %r11, -8(%rsp)\n\tmovq    shadow_stack_ptr(%rip), %r11\n\tmovq    (%r11), %r11\n"
+                        "\tcmpq    (%rsp), %r11\n\tmovq    -8(%rsp), %r11\n")
+
+end_macros=f"""
 # Control-flow enforcement interrupt
 trigger_interrupt:
-	cmpq (%rsp), %r11
-	je safe_exec
+{shadow_stack_compare}	je safe_exec
     int3 # If shadow stack fails, then trace trap
 
 safe_exec:
@@ -147,10 +306,109 @@ safe_exec:
 
 """
 
-patch_count = 0
+# ---- Outlined checks ---- #
+# With the outlined emission the expensive checks are emitted once per file as
+# trampolines, one per (macro, operand size, registers), and the sites call
+# them. Each trampoline sits in its own comdat group, so the linker keeps a
+# single copy per program; input/scripts/linker_script.ld places the groups
+# (.text.xfi_tramp_*) in the sandbox .text. Sites in the middle of a function
+# step over the red zone around the call; function entries and returns do not
+# need to.
+#  - push_shadow_stack: the return address is one slot further up
+#  - pop_shadow_stack + ret_xfi: the check runs on the return address above the
+#    trampoline's own; a failure leaves the trampoline before trigger_interrupt's logic
+#  - ctrl_flow_xfi on a register target
+#  - the full delta memory macros: the site computes the address into tmp (lea:
+#    the original leaq), the trampoline derives the delta and does the access
+# Sites that spill registers, _bb and %gs: accesses stay inline.
+
+red_zone_enter = "\tleaq    -128(%rsp), %rsp\n"
+red_zone_leave = "\tleaq    128(%rsp), %rsp\n"
+
+# Failure path of an outlined control-flow check: back to the stack of the
+# checked site (skip bytes), then trigger_interrupt's shadow stack test
+def outlined_trap(skip):
+    return f"1:\n\tleaq    {skip}(%rsp), %rsp\n{shadow_stack_compare}\tje      2f\n\tint3\n2:\n\tret\n"
+
+# Compares tmp (target - base_address) with the end of .text, as ctrl_flow_xfi
+def bound_compare(addressing, tmp, bound):
+    if addressing == "gs":
+        return f"\tcmpq    xfi_text_bound(%rip), {tmp}\n"
+    return f"\trdgsbase {bound}\n\txorq    mask(%rip), {bound}\n\tcmpq    {bound}, {tmp}\n"
+
+# Compares the return address in slot with the end of .text in tmp alone, as ret_xfi
+def return_compare(addressing, tmp, slot):
+    if addressing == "gs":
+        return (f"\tmovq    {slot}, {tmp}\n\tsubq    base_address(%rip), {tmp}\n"
+                f"\tcmpq    xfi_text_bound(%rip), {tmp}\n")
+    return (f"\trdgsbase {tmp}\n\txorq    mask(%rip), {tmp}\n\taddq    base_address(%rip), {tmp}\n"
+            f"\tcmpq    {tmp}, {slot}\n")
+
+# Trampolines of one file: name -> assembly text
+class Trampolines:
+    def __init__(self, addressing="delta"):
+        self.addressing = addressing
+        # Bodies differ between addressing modes, so do the comdat names
+        self.prefix = "xfi_tramp_" if addressing == "delta" else f"xfi_tramp_{addressing}_"
+        self.bodies = {}
+
+    def name(self, parts, body):
+        name = self.prefix + "_".join(str(part).strip("%") for part in parts)
+        if name not in self.bodies:
+            self.bodies[name] = (f'\t.section .text.{name},"axG",@progbits,{name},comdat\n'
+                                 f"\t.globl  {name}\n\t.hidden {name}\n\t.type   {name}, @function\n"
+                                 f"{name}:\n\t.cfi_startproc\n{body}\t.cfi_endproc\n\t.size   {name}, .-{name}\n")
+        return name
+
+    def push_shadow_stack(self, tmp):
+        return self.name(("push_shadow_stack", tmp),
+                         f"\tmovq    shadow_stack_ptr(%rip), {tmp}\n\tpushq   8(%rsp)\n\tpopq    ({tmp})\n"
+                         "\taddq    $8, shadow_stack_ptr(%rip)\n\tret\n")
+
+    def ret_check(self, tmp):
+        return self.name(("ret_xfi", tmp),
+                         f"\tpop_shadow_stack\n{return_compare(self.addressing, tmp, '8(%rsp)')}"
+                         f"\tjge     1f\n\tret\n{outlined_trap(8)}")
+
+    def ctrl_check(self, target, tmp, bound):
+        return self.name(("ctrl_flow_xfi", target, tmp, bound),
+                         f"\tmovq    {target}, {tmp}\n\tsubq    base_address(%rip), {tmp}\n"
+                         f"{bound_compare(self.addressing, tmp, bound)}\tjge     1f\n\tret\n{outlined_trap(8 + 128)}")
+
+    # The address is in tmp (lea: in op) when the trampoline is called
+    def access(self, macro, op, value, tmp, delta):
+        addr = f"({op})" if macro == "lea_load_xfi" else f"({tmp})"
+        return self.name((macro, value, op, tmp, delta),
+                         f"\t{macro} {addr}, {op}, {value}, tmp={tmp}, delta={delta}\n\tret\n")
+
+    def text(self):
+        return "".join(self.bodies.values())
+
+# ---- Site profile ---- #
+# With RewriteOptions.profile every patched site increments its own counter,
+# .Lxfi_site_hits + 8 * site. The counters of a file sit in the xfi_profile
+# section behind a header (next, file name, number of sites) that the file
+# registers with xfi_profile_register (input/xfi.c) from .init_array; the loader
+# dumps them at exit. Sites are numbered in file order and described by the
+# site map written next to the file (site_profile.write_site_map).
+
+def site_counter(site, macro):
+    increment = f"\tincq    .Lxfi_site_hits+{8 * site}(%rip)\n"
+    if macro.endswith("_gs"):
+        # The %gs: accesses leave the flags alone, so must the counter
+        return f"{red_zone_enter}\tpushfq\n{increment}\tpopfq\n{red_zone_leave}"
+    return increment
+
+def profile_text(file_name, count):
+    return (f'\t.section xfi_profile,"aw",@progbits\n\t.balign 8\n'
+            f".Lxfi_site_counts:\n\t.quad   0\n\t.quad   .Lxfi_profile_file\n\t.quad   {count}\n"
+            f".Lxfi_site_hits:\n\t.zero   {8 * count}\n.Lxfi_profile_file:\n\t.string \"{file_name}\"\n"
+            f"\t.text\n.Lxfi_profile_init:\n\tleaq    .Lxfi_site_counts(%rip), %rdi\n"
+            f"\tjmp     xfi_profile_register@PLT\n"
+            f'\t.section .init_array,"aw"\n\t.balign 8\n\t.quad   .Lxfi_profile_init\n')
 
 def parse_inst(opcode):
-    rewriter_logger.info(f"Parsing the opcode: {opcode}")
+    rewriter_logger.debug("Parsing the opcode: %s", opcode)
     # Define all your regex patterns
     regex_patterns = [
         re.compile(r'(?P<opcode>jmp|call|ret)'),            # Indirect transfer regex
@@ -189,25 +447,145 @@ movz_instructions = ["movzbw", "movzbq", "movzwl", "movzwq", "movzlq", "movzbl"]
 indirect_instructions = ['call', 'jmp', 'ret']
 no_prefix_instruction = ['nop']
 
+# Memory macros: the full version computes the sandbox delta into %r15, the
+# _bb version reuses the delta already computed earlier in the basic block
+delta_macros = {"mov_load_xfi", "mov_store_xfi", "movz_load_xfi", "lea_load_xfi"}
 
-def patch_inst(line, inst):
-    global patch_count
-    inst: PatchingInst
-    rewriter_logger.info(f"Patching the line: {line}")
-    # inst.inst_print()
-    # Example patching logic; modify as needed
+# Shadow stack policy -> function classes (see asm_analysis.classify_shadow_stack)
+# whose shadow stack push and return check are skipped
+shadow_stack_policies = {
+    "always": (),
+    "pure-leaf": ("pure-leaf",),
+    "leaf": ("pure-leaf", "leaf"),
+}
+
+@dataclass(unsafe_hash=True)
+class RewriteOptions:
+    bb_reuse: bool = True # Reuse the sandbox delta within a basic block
+    liveness: bool = True # Pick dead scratch registers instead of the macro defaults
+    shadow_stack: str = "leaf" # Key of shadow_stack_policies
+    ctrl_flow_elision: bool = True # Skip ctrl_flow_xfi when the analysis proved the target (PatchingInst.resolved_target)
+    addressing: str = "delta" # Key of addressing_headers
+    emission: str = "inline" # "inline" macros, or "outlined" trampolines (see Trampolines)
+    outline_threshold: int = 0 # With outlined emission, only outline functions whose inline checks add more bytes
+    profile: bool = False # Count the executions of every patched site (see site_counter)
+    profile_in: str = None # Profile (site_profile.build_profile) whose hot sites stay inline with outlined emission
+
+def elides_shadow_stack(inst, options):
+    return inst.shadow_class is not None and inst.shadow_class in shadow_stack_policies[options.shadow_stack]
+
+# True if the patch of inst is one of the delta_macros
+def sets_delta(inst):
+    return inst.patching_info in ("src", "dest") and (inst.opcode in ("mov", "lea") or inst.opcode in movz_instructions)
+
+# True if the memory access of inst is patched into a single %gs: access.
+# Operands that already carry a segment override keep the delta macros.
+def gs_access(inst, options):
+    return (options.addressing == "gs" and sets_delta(inst) and inst.opcode != "lea"
+            and ":" not in f"{inst.src} {inst.dest}")
+
+# Scratch register preference: caller-saved first. %rsp/%rbp are never used
+scratch_order = ("rcx", "rsi", "rdi", "r8", "r9", "r10", "r11", "rdx", "rax", "rbx", "r12", "r13", "r14", "r15")
+default_delta = "%r15"
+
+def operand_register_names(inst):
+    names = set()
+    for operand in (inst.src, inst.dest):
+        if operand:
+            names.update(register_aliases[name][0] for name in register_pattern.findall(operand) if name in register_aliases)
+    return names
+
+# (mask, excluded) -> free registers in preference order
+free_names_table = {}
+
+def free_names(mask, excluded=frozenset()):
+    names = free_names_table.get((mask, excluded))
+    if names is None:
+        names = free_names_table[mask, excluded] = tuple(f"%{name}" for name in scratch_order
+                                                          if mask & gpr_bits[name] and name not in excluded)
+    return names
+
+# Scratch registers for the macro patching inst: (keyword arguments, registers
+# to spill around the macro). Registers are taken from the dead ones; missing
+# ones are spilled, choosing registers the instruction does not name.
+def scratch_registers(inst, names, delta=None):
+    free = [reg for reg in free_names(inst.free_regs) if reg != delta]
+    chosen = list(free[:len(names)])
+    spill = []
+    if len(chosen) < len(names):
+        used = operand_register_names(inst)
+        spare = [f"%{name}" for name in scratch_order if name not in used and f"%{name}" not in chosen and f"%{name}" != delta]
+        spill = spare[:len(names) - len(chosen)]
+        chosen += spill
+    return dict(zip(names, chosen)), spill
+
+
+def checks_transfer(inst):
+    return inst.patching_info == "ret" or (inst.opcode in ("call", "jmp") and inst.src_op is not None
+                                           and inst.src_op.op_type != "Label")
+
+# Register choice for one patched site. delta_state is (block, register) of the
+# sandbox delta currently held in a register, or None. Returns
+# (reuse_delta, scratch, spill, delta_state after the site).
+def site_registers(inst, options, delta_state):
+    use_liveness = options.liveness and inst.free_regs is not None
+    if gs_access(inst, options):
+        # No scratch register; the access may overwrite the register holding the delta
+        return False, None, (), None
+    if sets_delta(inst):
+        names = ["delta"] if inst.opcode == "lea" else ["delta", "tmp"]
+        reuse = options.bb_reuse and delta_state is not None and delta_state[0] == inst.block
+        if not use_liveness:
+            return reuse, None, (), (inst.block, default_delta)
+        if reuse and inst.free_since & gpr_bits[delta_state[1][1:]]:
+            scratch, spill = scratch_registers(inst, names[1:], delta_state[1])
+            scratch["delta"] = delta_state[1]
+        else:
+            reuse = False
+            scratch, spill = scratch_registers(inst, names)
+        if spill and "%rsp" in f"{inst.src} {inst.dest}":
+            # The spill moves %rsp under the operands, keep the macro defaults
+            return False, None, (), None
+        return reuse, scratch, spill, None if scratch["delta"] in spill else (inst.block, scratch["delta"])
+    if use_liveness and (inst.patching_info == "ret" or inst.opcode == ".cfi_startproc"):
+        # The shadow stack macros save a missing register in the red zone (save=1)
+        scratch, spill = scratch_registers(inst, ["tmp"])
+        return False, scratch, spill, None
+    if use_liveness and checks_transfer(inst):
+        scratch, spill = scratch_registers(inst, ["tmp"] if options.addressing == "gs" else ["tmp", "bound"])
+        if spill and "%rsp" in f"{inst.src}":
+            return False, None, (), None
+        return False, scratch, spill, None
+    return False, None, (), None
+
+# Size argument of the memory macros: the operand width in bits, or the
+# source and destination widths of a movz (832: 8 to 32 bits)
+def operand_value(inst):
     if inst.prefix == "b":
-        value = 8
+        return 8
     elif inst.prefix == "w":
-        value = 16
+        return 16
     elif inst.prefix == "l":
-        value = 32
+        return 32
     elif inst.prefix == "q":
-        value = 64
+        return 64
     elif inst.prefix == "":
-        value = parse_inst(inst.opcode) # If it is a bit more complex instruction such as movz, then parse more
-    else:
-        value = 0
+        return parse_inst(inst.opcode) # If it is a bit more complex instruction such as movz, then parse more
+    return 0
+
+# patch_counts collects the emitted patches per XFI macro for the current file;
+# reuse_delta selects the _bb variant of the memory macros; scratch holds the
+# scratch register arguments of the macro and spill the registers to save around it;
+# gs selects the single-instruction %gs: variant of the memory macros;
+# trampolines (a Trampolines) outlines the checks that can be
+def patch_inst(line, inst, patch_counts=None, reuse_delta=False, scratch=None, spill=(), gs=False, trampolines=None):
+    if patch_counts is None:
+        patch_counts = Counter()
+    inst: PatchingInst
+    rewriter_logger.debug("Patching the line: %s", line)
+    # inst.inst_print()
+    # Example patching logic; modify as needed
+    value = operand_value(inst)
         
     original_inst = None
     xfi_inst = None
@@ -242,105 +620,253 @@ def patch_inst(line, inst):
         original_inst = f"{inst.opcode}" # Save the cfi_startproc inst
         xfi_inst = "\tpush_shadow_stack"
     
+    if xfi_inst in delta_macros and gs:
+        xfi_inst += "_gs"
+    elif xfi_inst in delta_macros and reuse_delta:
+        xfi_inst += "_bb"
+
     if xfi_inst:
+        args = [f"{name}={scratch[name]}" for name in ("tmp", "delta", "bound") if name in (scratch or {})]
+        saves = "".join(f"\txfi_spill {reg}\n" for reg in spill)
+        restores = "".join(f"\txfi_reload {reg}\n" for reg in reversed(spill))
+        if spill and (inst.patching_info == "ret" or inst.opcode == ".cfi_startproc"):
+            # The shadow stack macros keep the register in the red zone, %rsp stays put
+            args.append("save=1")
+            saves = restores = ""
         # Prepare the original instruction as a comment
         if original_inst == None:
             original_inst = f"{inst.opcode}{inst.prefix} {inst.src}, {inst.dest}"
             
+        registers = {"tmp": "%r14", "delta": "%r15", "bound": "%r15", **(scratch or {})}
+        outline = trampolines is not None and not spill
         # Format the patched line with proper indentation
-        if inst.patching_info == "src":
-            patch_count += 1
-            patched_line = f"\t{xfi_inst} {inst.src}, {inst.dest}, {value} \t# {original_inst}\n"
+        if outline and xfi_inst in delta_macros and inst.patching_info in ("src", "dest"):
+            addr, op = (inst.src, inst.dest) if inst.patching_info == "src" else (inst.dest, inst.src)
+            outline = not op.startswith("$") and "%rsp" not in addr
+        if outline and inst.patching_info in ("src", "dest") and xfi_inst in delta_macros:
+            patch_counts[xfi_inst] += 1
+            name = trampolines.access(xfi_inst, op, value, registers["tmp"], registers["delta"])
+            address = f"\tleaq    {addr}, {op if xfi_inst == 'lea_load_xfi' else registers['tmp']}\n"
+            patched_line = f"{address}{red_zone_enter}\tcall    {name} \t# {original_inst}\n{red_zone_leave}"
+        elif outline and inst.opcode == ".cfi_startproc":
+            patch_counts[xfi_inst.strip()] += 1
+            patched_line = f"\t{original_inst}\n\tcall    {trampolines.push_shadow_stack((scratch or {}).get('tmp', '%r10'))}\n"
+        elif outline and inst.patching_info == "ret":
+            patch_counts[xfi_inst] += 1
+            patched_line = f"\tcall    {trampolines.ret_check(registers['tmp'])}\n\t{original_inst}\n"
+        elif (outline and xfi_inst == "ctrl_flow_xfi" and value == 0 and inst.src_op is not None
+              and inst.src_op.op_type != "Label" and inst.src_op.value.startswith("%")):
+            patch_counts[xfi_inst] += 1
+            name = trampolines.ctrl_check(inst.src_op.value, registers["tmp"], registers["bound"])
+            patched_line = f"{red_zone_enter}\tcall    {name}\n{red_zone_leave}\t{original_inst}\n"
+        elif inst.patching_info == "src":
+            patch_counts[xfi_inst] += 1
+            patched_line = f"{saves}\t{xfi_inst} {', '.join([inst.src, inst.dest, str(value)] + args)} \t# {original_inst}\n{restores}"
         elif inst.patching_info == "dest":
-            patch_count += 1
-            patched_line = f"\t{xfi_inst} {inst.dest}, {inst.src}, {value} \t# {original_inst}\n"
+            patch_counts[xfi_inst] += 1
+            patched_line = f"{saves}\t{xfi_inst} {', '.join([inst.dest, inst.src, str(value)] + args)} \t# {original_inst}\n{restores}"
         elif inst.opcode == ".cfi_startproc":
-            patch_count += 1
-            patched_line = f"\t{original_inst}\n{xfi_inst}\n"
+            patch_counts[xfi_inst.strip()] += 1
+            push = f"{xfi_inst} {', '.join(args)}" if args else xfi_inst
+            patched_line = f"\t{original_inst}\n{push}\n"
         else:
             # original_inst = f"{inst.opcode}"
             inst.src_op: OperandData
-            rewriter_logger.warning(f"Control flow transfer")
+            rewriter_logger.debug("Control flow transfer")
             if inst.src_op != None and inst.src_op.op_type != "Label":
                 # inst.inst_print()
-                patched_line = f"\t{xfi_inst} {inst.src_op.value}, {value}\n\t{original_inst}\n"
-                patch_count += 1
+                patched_line = f"{saves}\t{xfi_inst} {', '.join([inst.src_op.value, str(value)] + args)}\n{restores}\t{original_inst}\n"
+                patch_counts[xfi_inst] += 1
             elif inst.patching_info == "ret":
                 # inst.inst_print()
                 # patched_line = f"\t{original_inst}\n"
-                patched_line = f"\tpop_shadow_stack\n\t{xfi_inst}\n\t{original_inst}\n" # - factor / sort doesn't work
-                patch_count += 1
+                ret_check = f"{xfi_inst} {', '.join(args)}" if args else xfi_inst
+                patched_line = f"\tpop_shadow_stack\n{saves}\t{ret_check}\n{restores}\t{original_inst}\n" # - factor / sort doesn't work
+                patch_counts[xfi_inst] += 1
             elif inst.src_op.op_type == "Label":
                 # inst.inst_print()
-                rewriter_logger.warning("Direct label, skip")
+                rewriter_logger.debug("Direct label, skip")
                 patched_line = f"\t{original_inst}\n" 
     else:
         patched_line = line
     
     return patched_line
 
-def rewriter(target_file, asm_insts):
-    global patch_count
-    asm_insts: dict
-    rewriter_logger.info(f"Rewriting the assembly file: {target_file}")
+# Patched text of an assembly file, one line of lines at a time. Yields
+# (line_num, function_name, inst, text, macro): text replaces the line, inst is
+# its entry of the patch plan (or None) and macro the XFI macro emitted for it
+# (None if nothing was emitted). end_macros is yielded on its own, with
+# line_num None: before .Letext0, or at the end of the file when it is built
+# without debug information (no .Letext0). patch_counts collects the emitted patches per macro.
+# trampolines (a Trampolines) receives the outlined checks of the functions of
+# outlined (all of them if None) but those of the lines of inline_sites; without
+# it every check is inline. With sites (a list), every emitted macro gets a
+# counter (site_counter) and its (line_num, function_name, macro) is appended.
+def patch_lines(lines, patch_plan, options, stats, patch_counts, trampolines=None, outlined=None, sites=None,
+                inline_sites=frozenset()):
+    in_function = False
+    function_name = None
+    delta_state = None # (basic block, register) of the sandbox delta in a register
+    text_end = False # .Letext0 was seen
+    for line_num, original_line in enumerate(lines, 1):
+        line = original_line.strip()
+        # Check if the current line is the start of a function
+        if line.startswith('.type') and '@function' in line:
+            # Extract the function name
+            function_name = line.split()[1].strip('",')
+            in_function = True
+
+        # Check if the current line is the end of a function
+        if line.startswith('.cfi_endproc'):
+            in_function = False
+
+        # Insert end_macros before .Letext0
+        if line == ".Letext0:":
+            text_end = True
+            yield None, None, None, end_macros, None
+
+        # The plan is keyed by line number, so there is nothing to re-parse here
+        inst = patch_plan.get(line_num) if in_function else None
+        macro = None
+        if inst is not None and elides_shadow_stack(inst, options):
+            if inst.opcode == ".cfi_startproc":
+                rewriter_logger.debug("Shadow stack elided: %s (%s)", function_name, inst.shadow_class)
+                stats.elided.append(function_name)
+        elif inst is not None and options.ctrl_flow_elision and inst.resolved_target is not None:
+            rewriter_logger.debug("Control flow check elided: %s -> %s", function_name, inst.resolved_target)
+            stats.counters['ctrl_flow_elided'] += 1
+        elif inst is not None:
+            if inst.opcode == ".cfi_startproc":
+                rewriter_logger.debug("Starter patching found")
+            else:
+                rewriter_logger.debug("Patching found: %s %s", function_name, inst.opcode)
+            reuse_delta, scratch, spill, delta_state = site_registers(inst, options, delta_state)
+            site_counts = Counter()
+            outline = trampolines if outlined is None or function_name in outlined else None
+            if line_num in inline_sites:
+                outline = None
+            original_line = patch_inst(original_line, inst, site_counts, reuse_delta, scratch, spill,
+                                       gs_access(inst, options), outline)
+            macro = next(iter(site_counts), None)
+            patch_counts.update(site_counts)
+            if sites is not None and macro is not None:
+                original_line = site_counter(len(sites), macro) + original_line
+                sites.append((line_num, function_name, macro))
+            rewriter_logger.debug(original_line)
+        yield line_num, function_name if in_function else None, inst, original_line, macro
+    if not text_end:
+        # The file ends in another section (.note.GNU-stack)
+        yield None, None, None, "\t.text\n" + end_macros, None
+
+# Functions of target_file to outline: those whose inline checks would add more
+# than options.outline_threshold bytes (estimated by patch_cost), None for all.
+# lines are those of target_file when it is only held in memory.
+def outlined_functions(target_file, patch_plan, options, lines=None):
+    if options.outline_threshold <= 0:
+        return None
+    inline = replace(options, emission="inline")
+    plan, _ = patch_cost.plan_file(target_file, patch_plan, inline, FileStats(), compare=False, lines=lines)
+    return {function["name"] for function in plan["functions"] if function["bytes"] > options.outline_threshold}
+
+# Lines of target_file whose checks stay inline: the hot sites of
+# options.profile_in, if the profile was taken on this very file (digest)
+def profile_inline_sites(target_file, options, digest=None):
+    if options.profile_in is None or options.emission != "outlined":
+        return frozenset()
+    return site_profile.hot_lines(options.profile_in, Path(target_file).stem, digest or file_digest(target_file))
+
+# Lines to patch of file (open on the planned file): a StreamingPlan analyzes
+# them as they are read
+def plan_lines(patch_plan, file):
+    return patch_plan.lines(file) if isinstance(patch_plan, StreamingPlan) else file
+
+# The original of a rewritten file stays next to it as .s.bak. It is linked
+# rather than copied where the file system allows it.
+def keep_backup(target_file):
+    backup = target_file + '.bak'
+    try:
+        os.unlink(backup)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(target_file, backup)
+    except OSError:
+        shutil.copy2(target_file, backup)
+
+# stats (a FileStats) receives the functions whose shadow stack was elided and
+# the number of control flow checks left out
+def rewriter(target_file, patch_plan, options=None, stats=None):
+    if options is None:
+        options = RewriteOptions()
+    if stats is None:
+        stats = FileStats()
+    patch_counts = Counter()
+    patch_plan: Dict[int, PatchingInst]
+    rewriter_logger.info("Rewriting the assembly file: %s", target_file)
 
     target_file_str = str(target_file)
+    digest = file_digest(target_file) if options.profile else None
 
-    debug = False
-    # Step 1: Patch the lines and collect them in a list
-    patched_lines = []
-    with fileinput.input(target_file_str, inplace=(not debug), encoding="utf-8", backup='.bak') as file:
-        line_num = 1
-        current_function = None
-        for line in file:
-            original_line = line  # Preserve the original line formatting
-            line = line.strip()
-            # Check if the current line is the start of a function
-            if line.startswith('.type') and '@function' in line:
-                # Extract the function name
-                function_name = line.split()[1].strip('",')
-                current_function = asm_insts.get(function_name)
-            
-            # Check if the current line is the end of a function
-            if line.startswith('.cfi_endproc'):
-                current_function = None
-
-            # Insert end_macros before .Letext0
-            if line == ".Letext0:":
-                patched_lines.append(end_macros)
-
-            if current_function is not None:
-                result = parse_assembly_line(line)
-                if result != None:
-                    opcode, prefix, src, dest = result
-                    if opcode == ".cfi_startproc":
-                        temp_inst = PatchingInst(line_num, opcode, prefix, src, dest)
-                        rewriter_logger.critical("Starter patching found")
-                        original_line = patch_inst(original_line, temp_inst)
-                        rewriter_logger.debug(original_line)
-                        # break
-                    else:
-                        temp_inst = PatchingInst(line_num, opcode, prefix, src, dest)
-                        temp_inst.inst_print()
-                        for inst in current_function:
-                            inst: PatchingInst
-                            if inst.compare(temp_inst):
-                                temp_inst.patching_info = inst.patching_info # Upon finding the patch target, update the info
-                                rewriter_logger.critical("Patching found")
-                                rewriter_logger.warning("%s %s", function_name, inst.opcode)
-                                # if inst.opcode == "ret" and function_name != "main": # Don't patch ret in main
-                                #     rewriter_logger.warning("Skip main - ret patching")
-                                #     continue
-                                # else:
-                                original_line = patch_inst(original_line, inst)
-                                rewriter_logger.debug(original_line)
-                                break
-                    
-            patched_lines.append(original_line)  # Collect the patched lines
-            line_num += 1  # Increment the line number for each line
-
-    # Step 2: Write the patched lines back to the file, adding the asm_macros at the top
-    with open(target_file_str, 'w', encoding='utf-8') as file:
-        file.write(asm_macros + "\n")
-        file.writelines(patched_lines)
-    rewriter_logger.critical(f"Patch count: {patch_count}")
\ No newline at end of file
+    # The patched file is written next to the original and swapped in once complete,
+    # so the target is never partial and no line is kept in memory
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target_file_str)), suffix='.tmp')
+    try:
+        with open(target_file_str, encoding="utf-8") as source, os.fdopen(fd, 'w', encoding='utf-8') as file:
+            sites = write_rewritten(file, plan_lines(patch_plan, source), target_file, patch_plan, options, stats,
+                                    patch_counts, digest)
+        shutil.copymode(target_file_str, temp_path)
+        keep_backup(target_file_str)
+        os.replace(temp_path, target_file_str)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if sites is not None:
+        site_profile.write_site_map(target_file, digest, sites)
+    rewriter_logger.info("Patch count: %d", sum(patch_counts.values()))
+    return patch_counts
+
+# rewriter on the lines (a list) of an assembly file only held in memory, for
+# xfi_cc.py: the rewritten file is written to out. target_file is never read;
+# it names the file, and with options.profile the site map is written next to it.
+def rewrite_lines(lines, out, target_file, patch_plan, options=None, stats=None):
+    if options is None:
+        options = RewriteOptions()
+    if stats is None:
+        stats = FileStats()
+    patch_counts = Counter()
+    digest = None
+    if options.profile or options.profile_in:
+        digest = hashlib.sha256("".join(lines).encode()).hexdigest() # file_digest of the same text
+    sites = write_rewritten(out, lines, target_file, patch_plan, options, stats, patch_counts, digest, lines)
+    if sites is not None:
+        site_profile.write_site_map(target_file, digest, sites)
+    rewriter_logger.info("Patch count: %d", sum(patch_counts.values()))
+    return patch_counts
+
+# Writes the rewriting of lines, those of target_file, to file; digest is the
+# one of target_file before rewriting. source_lines are the lines to read again
+# when target_file is only held in memory. Returns the profiled sites (for the
+# site map), or None without options.profile.
+def write_rewritten(file, lines, target_file, patch_plan, options, stats, patch_counts, digest=None,
+                    source_lines=None):
+    trampolines = Trampolines(options.addressing) if options.emission == "outlined" else None
+    outlined = outlined_functions(target_file, patch_plan, options, source_lines) if trampolines is not None else None
+    inline_sites = profile_inline_sites(target_file, options, digest)
+    sites = [] if options.profile else None
+
+    # Macro header of the addressing mode at the top, trampolines and counters at the end
+    file.write(addressing_headers[options.addressing] + "\n")
+    for _, _, _, text, _ in patch_lines(lines, patch_plan, options, stats, patch_counts,
+                                        trampolines, outlined, sites, inline_sites):
+        file.write(text)
+    if trampolines is not None:
+        file.write(trampolines.text())
+        stats.counters['trampolines'] += len(trampolines.bodies)
+    if sites:
+        file.write(profile_text(Path(target_file).stem, len(sites)))
+
+    if sites is not None:
+        stats.counters['profiled_sites'] += len(sites)
+    if inline_sites:
+        stats.counters['profile_inline'] += len(inline_sites)
+    return sites
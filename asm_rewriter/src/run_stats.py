@@ -0,0 +1,64 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+stats_logger = logging.getLogger('main')
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Stages in pipeline order, as they appear in the run report
+stage_names = ('symbols', 'parse', 'analysis', 'rewrite', 'plan')
+
+# Per-file instrumentation: wall and CPU time per stage plus counters (lines,
+# instructions, functions), patches per macro, symbols per section and the
+# functions whose shadow stack was elided.
+# Instances are returned from the pool workers, so everything is picklable.
+class FileStats:
+    def __init__(self, name=None):
+        self.name = name
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.counters = Counter()
+        self.patches = Counter()
+        self.sections = Counter()
+        self.elided = []
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield self
+        finally:
+            self.wall[name] += time.perf_counter() - wall
+            self.cpu[name] += time.process_time() - cpu
+            stats_logger.debug("Stage %s took %.3fs", name, self.wall[name])
+
+    def count_symbols(self, symbols):
+        for symbol in symbols:
+            self.sections[getattr(symbol, 'section', None) or 'unknown'] += 1
+
+    def update(self, other):
+        self.wall.update(other.wall)
+        self.cpu.update(other.cpu)
+        self.counters.update(other.counters)
+        self.patches.update(other.patches)
+        self.sections.update(other.sections)
+        # Function names are only unique within a file
+        self.elided += [f"{other.name}:{function}" if other.name else function for function in other.elided]
+
+    def to_dict(self):
+        stages = {name: {"wall": round(self.wall[name], 6), "cpu": round(self.cpu[name], 6)}
+                  for name in stage_names if name in self.wall}
+        return {
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "patches": dict(sorted(self.patches.items())),
+            "patch_total": sum(self.patches.values()),
+            "symbols_per_section": dict(sorted(self.sections.items())),
+            "shadow_stack_elided": self.elided,
+        }
@@ -0,0 +1,129 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+profile_logger = logging.getLogger('main')
+
+import json
+from collections import Counter
+
+# Execution profile of the patched sites (RewriteOptions.profile). The rewriter
+# numbers the sites of a file and describes them in a site map next to it
+# (prog.s -> prog.sites.json); the loader appends the counters of every run to
+# a dump (cleanup_xfi in input/xfi.c):
+#   # xfi site profile, pid 1234
+#   file prog 23
+#   0 1
+#   5 4096
+# with one "site count" line per executed site. build_profile joins both into a
+# profile keyed by file and original line number, which --profile-in reads back.
+
+site_map_suffix = ".sites.json"
+# Share of all counted executions the hot sites cover
+hot_coverage = 0.99
+
+def site_map_path(asm_path):
+    return Path(asm_path).with_suffix(site_map_suffix)
+
+# sites: (line_num, function_name, macro) per site, in site order; digest is
+# the one of the assembly file before rewriting
+def write_site_map(asm_path, digest, sites):
+    site_map = {
+        "file": Path(asm_path).stem,
+        "digest": digest,
+        "sites": [{"line": line_num, "function": function_name, "macro": macro}
+                  for line_num, function_name, macro in sites],
+    }
+    with open(site_map_path(asm_path), 'w', encoding='utf-8') as file:
+        json.dump(site_map, file, indent=1)
+        file.write("\n")
+
+# file name -> (number of sites, Counter of site -> executions), summed over
+# the runs of the dump, and the number of runs
+def read_dump(path):
+    files = {}
+    runs = 0
+    counts = None
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == '#':
+                runs += 1
+            elif words[0] == 'file':
+                sites = int(words[2])
+                previous = files.get(words[1])
+                if previous is not None and previous[0] != sites:
+                    profile_logger.warning("%s: %s has %d sites in one run and %d in another, keeping the first",
+                                           path, words[1], previous[0], sites)
+                    counts = None
+                    continue
+                counts = files.setdefault(words[1], (sites, Counter()))[1]
+            elif counts is not None:
+                counts[int(words[0])] += int(words[1])
+    return files, runs
+
+# Profile of the dump at dump_path for the rewritten files of directory. Every
+# site gets its count and whether it is hot: the most executed sites that
+# together make up coverage of all executions.
+def build_profile(dump_path, directory, coverage=hot_coverage):
+    dump, runs = read_dump(dump_path)
+    files = {}
+    for name, (count, counts) in sorted(dump.items()):
+        path = site_map_path(Path(directory) / f"{name}.s")
+        try:
+            with open(path, encoding='utf-8') as file:
+                site_map = json.load(file)
+        except FileNotFoundError:
+            profile_logger.warning("No site map for %s (%s), its counts are left out", name, path)
+            continue
+        if len(site_map["sites"]) != count:
+            profile_logger.warning("%s describes %d sites but the program counted %d, its counts are left out",
+                                   path, len(site_map["sites"]), count)
+            continue
+        sites = [{"site": site, **entry, "count": counts[site], "hot": False}
+                 for site, entry in enumerate(site_map["sites"])]
+        files[name] = {"digest": site_map["digest"], "sites": sites}
+
+    ranked = sorted((site for entry in files.values() for site in entry["sites"] if site["count"]),
+                    key=lambda site: site["count"], reverse=True)
+    total = sum(site["count"] for site in ranked)
+    covered = 0
+    for site in ranked:
+        if covered >= coverage * total:
+            break
+        site["hot"] = True
+        covered += site["count"]
+    return {
+        "dump": str(dump_path),
+        "runs": runs,
+        "executions": total,
+        "coverage": coverage,
+        "hot_sites": sum(site["hot"] for site in ranked),
+        "files": files,
+    }
+
+# Path -> profile, loaded once per process
+profile_table = {}
+
+def load_profile(path):
+    profile = profile_table.get(path)
+    if profile is None:
+        with open(path, encoding='utf-8') as file:
+            profile = profile_table[path] = json.load(file)
+    return profile
+
+# Original line numbers of the hot sites of file_name in the profile at path.
+# Line numbers only carry over to the very file that was profiled, so a file
+# whose digest changed since gets none.
+def hot_lines(path, file_name, digest):
+    entry = load_profile(path)["files"].get(file_name)
+    if entry is None:
+        return frozenset()
+    if entry["digest"] != digest:
+        profile_logger.warning("%s changed since it was profiled, ignoring its profile", file_name)
+        return frozenset()
+    return frozenset(site["line"] for site in entry["sites"] if site["hot"])
@@ -0,0 +1,35 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+index_logger = logging.getLogger('main')
+
+# Symbol lookup table built once per object file: name -> symbol for operand
+# matching.
+class SymbolIndex:
+    def __init__(self, symbols=()):
+        self.by_name = {}
+        for symbol in symbols:
+            # Keep the first definition if a name shows up in several sections
+            self.by_name.setdefault(symbol.name, symbol)
+        index_logger.debug(f"Indexed {len(self.by_name)} symbols")
+
+    @classmethod
+    def of(cls, symbols):
+        if isinstance(symbols, cls):
+            return symbols
+        return cls(symbols)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def get(self, name, default=None):
+        return self.by_name.get(name, default)
@@ -0,0 +1,309 @@
+from pathlib import Path
+import sys
+import logging
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+targets_logger = logging.getLogger('main')
+
+import re
+
+from liveness import instruction_effects, register_aliases, gpr_bits, stored_operands
+
+# Provenance of indirect call/jump targets within a function, used to drop the
+# ctrl_flow_xfi check when the target provably is code of this module:
+#  - the address of a function of the file or a label of the function
+#    (leaq f(%rip), %rax ... call *%rax)
+#  - a function pointer loaded from read-only data of the file
+#    (movq ops+8(%rip), %rax ... call *%rax, or call *ops+8(%rip))
+#  - a jump table dispatch whose index is bounds-checked against the table
+#    (cmpl $n, %eax; ja .Ldefault; ... leaq .L4(%rip), %rdx; movslq (%rdx,%rax,4), %rax;
+#    addq %rdx, %rax; jmp *%rax)
+# Facts are tracked forward through straight-line code: a label (a join point),
+# an unconditional transfer or anything that is not modelled drops them. Only
+# conditional jumps keep them on their fall-through path, which is how the
+# bounds check reaches the dispatch.
+# Memory the rewriter redirects to the sandbox region (the symbols of the
+# symbol list) is writable by the sandboxed code, so only data read in place
+# from a read-only section of the file counts. Frame slots only carry facts
+# while nothing at all is stored or called, and only in functions that never
+# take the address of their frame.
+
+readonly_sections = ('.rodata', '.data.rel.ro')
+data_sizes = {'.byte': 1, '.value': 2, '.short': 2, '.long': 4, '.int': 4, '.quad': 8}
+section_directives = ('.section', '.text', '.data', '.bss', '.previous', '.pushsection', '.popsection')
+
+# Current section of an assembly file read line by line, following the
+# section directives (lines starting with one of section_directives)
+class SectionState:
+    def __init__(self):
+        self.section = '.text'
+        self.previous = '.text'
+        self.stack = []
+
+    def switch(self, line):
+        words = line.split(None, 1)
+        directive = words[0]
+        if directive == '.previous':
+            self.section, self.previous = self.previous, self.section
+        elif directive == '.popsection':
+            if self.stack:
+                self.section, self.previous = self.stack.pop()
+        else:
+            if directive == '.pushsection':
+                self.stack.append((self.section, self.previous))
+            self.previous = self.section
+            if directive in ('.section', '.pushsection'):
+                self.section = words[1].split(',')[0].strip().strip('"') if len(words) == 2 else self.section
+            else:
+                self.section = directive
+
+# Labelled data of the read-only sections of an assembly file, fed one
+# stripped line at a time by parse_assembly_file: label -> {offset: (size, expression)}.
+# Collection for a label stops at the first directive whose size is not known.
+class ReadOnlyData(SectionState):
+    def __init__(self):
+        super().__init__()
+        self.tables = {}
+        self.current = None
+        self.offset = 0
+
+    def feed(self, line):
+        if line.startswith(section_directives):
+            self.switch(line)
+            return
+        if not self.section.startswith(readonly_sections):
+            return
+        if line.endswith(':'):
+            if self.current is None or self.current:
+                self.current = {}
+                self.offset = 0
+            # Several labels at the same offset share the entries
+            self.tables[line[:-1]] = self.current
+            return
+        if self.current is None:
+            return
+        words = line.split(None, 1)
+        size = data_sizes.get(words[0])
+        if size is not None and len(words) == 2:
+            for expression in words[1].split(','):
+                self.current[self.offset] = (size, expression.strip())
+                self.offset += size
+        elif words[0] in ('.align', '.p2align', '.balign') and not self.current:
+            pass
+        elif words[0] == '.zero' and len(words) == 2 and words[1].isdigit():
+            self.offset += int(words[1])
+        elif words[0] not in ('.type', '.size', '.globl', '.local', '.hidden', '.weak'):
+            self.current = None
+
+    def switch(self, line):
+        super().switch(line)
+        self.current = None
+
+    # Number of entries of a jump table (4-byte entries label-table, all
+    # labels in code), or None
+    def jump_table(self, label, code):
+        entries = self.tables.get(label)
+        if not entries:
+            return None
+        suffix = f"-{label}"
+        for offset, (size, expression) in entries.items():
+            if size != 4 or not expression.endswith(suffix) or expression[:-len(suffix)] not in code:
+                return None
+        return len(entries)
+
+    # Code label stored at symbol+offset, or None
+    def code_pointer(self, symbol, offset, code):
+        entry = self.tables.get(symbol, {}).get(offset)
+        if entry is None or entry[0] != 8 or entry[1] not in code:
+            return None
+        return entry[1]
+
+address_pattern = re.compile(r'(-?\d*)\((%\w+)?(?:,(%\w+)(?:,(\d))?)?\)')
+rip_pattern = re.compile(r'([.\w]+)(?:\+(\d+))?\(%rip\)')
+frame_slot_pattern = re.compile(r'(-\d+)\(%rbp\)')
+# The only instructions that may name %rbp/%rsp in a function whose frame address never escapes
+frame_setup = {('movq', ('%rsp', '%rbp')), ('pushq', ('%rbp',)), ('popq', ('%rbp',)), ('movq', ('%rbp', '%rsp'))}
+
+def full_register(operand):
+    alias = register_aliases.get(operand[1:]) if operand.startswith('%') else None
+    return alias[0] if alias is not None else None
+
+def frame_escapes(body):
+    for entry in body:
+        if entry.mnemonic is None or (entry.mnemonic, entry.operands) in frame_setup:
+            continue
+        for operand in entry.operands:
+            if full_register(operand) in ('rbp', 'rsp') and not (entry.mnemonic.startswith(('sub', 'add', 'and'))
+                                                                  and operand == entry.operands[-1]
+                                                                  and entry.operands[0].startswith('$')):
+                return True
+            if entry.mnemonic.startswith('lea') and ('(%rbp' in operand or '(%rsp' in operand):
+                return True
+    return False
+
+def slot_range(operand, width):
+    match = frame_slot_pattern.fullmatch(operand)
+    if match is None:
+        return None
+    start = int(match.group(1))
+    return start, start + width // 8
+
+# Line number -> description of the proven target, for the indirect calls and
+# jumps of body (a list of BodyLine). code is the set of labels that are code
+# of this module, data the ReadOnlyData of the file and redirected the names
+# the rewriter redirects to the sandbox region.
+def resolve_transfer_targets(body, code, data, redirected):
+    resolved = {}
+    slots_private = not frame_escapes(body)
+    facts = {}  # 64-bit register -> fact
+    slots = {}  # frame slot operand -> (fact, width)
+    pending = None  # (register or slot, bound, width) of a cmp against an immediate
+
+    def read_only_symbol(symbol):
+        return symbol in data.tables and symbol not in redirected
+
+    def fact_of(operand):
+        register = full_register(operand)
+        return facts.get(register) if register is not None else None
+
+    # Fact of the value loaded from a memory operand, of the given width
+    def load_fact(operand, width, signed=False):
+        match = rip_pattern.fullmatch(operand)
+        if match is not None:
+            symbol, offset = match.group(1), int(match.group(2) or 0)
+            if width == 64 and read_only_symbol(symbol):
+                target = data.code_pointer(symbol, offset, code)
+                return ('code', target) if target is not None else None
+            return None
+        if operand in slots:
+            fact, slot_width = slots[operand]
+            if fact[0] == 'bound' and slot_width >= width:
+                return fact if width == 64 else ('bound', fact[1], width)
+            if fact[0] == 'code' and width == slot_width == 64:
+                return fact
+            return None
+        match = address_pattern.fullmatch(operand)
+        if match is None or match.group(1) not in ('', '0') or match.group(3) is None:
+            return None
+        base, index, scale = fact_of(match.group(2) or ''), fact_of(match.group(3)), int(match.group(4) or 1)
+        # Table entry: table + 4 * i with i <= bound < entries
+        for table, offset in ((base, (index, scale)), (index, (base, 1)) if scale == 1 else (None, None)):
+            if table is None or table[0] != 'table':
+                continue
+            term, multiplier = offset
+            if term is None:
+                continue
+            if term[0] == 'bound' and term[2] == 64 and multiplier == 4:
+                bound = term[1]
+            elif term[0] == 'scaled' and multiplier == 1:
+                bound = term[1]
+            else:
+                continue
+            if width == 32 and bound < table[2]:
+                return ('entry', table[1], 64 if signed else 32)
+        return None
+
+    for entry in body:
+        if entry.label is not None:
+            facts.clear()
+            slots.clear()
+            pending = None
+            continue
+        mnemonic, operands = entry.mnemonic, entry.operands
+        if mnemonic is None:
+            facts.clear()
+            slots.clear()
+            pending = None
+            continue
+        if mnemonic.startswith(('call', 'j')):
+            if operands and operands[0].startswith('*'):
+                target = operands[0][1:]
+                fact = fact_of(target) if target.startswith('%') else load_fact(target, 64)
+                if fact is not None and fact[0] == 'code':
+                    resolved[entry.line_num] = fact[1]
+            if mnemonic.startswith('j') and not mnemonic.startswith('jmp'):
+                if pending is not None and mnemonic == 'ja':
+                    key, bound, width = pending
+                    if key.startswith('%'):
+                        facts[full_register(key)] = ('bound', bound, width)
+                    else:
+                        slots[key] = (('bound', bound, width), width)
+                pending = None
+                continue
+            facts.clear()
+            slots.clear()
+            pending = None
+            continue
+        pending = None
+        fact = None
+        dest = operands[-1] if operands else None
+        if mnemonic in ('cmpl', 'cmpq') and operands[0].startswith('$') and operands[0][1:].isdigit():
+            if full_register(operands[1]) is not None or (slots_private and slot_range(operands[1], 32)):
+                pending = (operands[1], int(operands[0][1:]), 32 if mnemonic == 'cmpl' else 64)
+            continue
+        if mnemonic in ('cltq', 'cwtl'):
+            # Sign extension of %eax (the entry of a table loaded with movl)
+            fact = facts.pop('rax', None)
+            if mnemonic == 'cltq' and fact is not None and fact[0] == 'entry':
+                facts['rax'] = ('entry', fact[1], 64)
+            continue
+        if mnemonic in ('movl', 'movq', 'movslq') and len(operands) == 2 and full_register(dest) is not None:
+            width = 64 if mnemonic == 'movq' else 32
+            source = operands[0]
+            if source.startswith('%'):
+                fact = fact_of(source)
+                if fact is not None and mnemonic == 'movl':
+                    # A 32-bit move zero-extends
+                    fact = ('bound', fact[1], 64) if fact[0] == 'bound' else None
+            elif not source.startswith('$'):
+                fact = load_fact(source, width, mnemonic == 'movslq')
+                if fact is not None and fact[0] == 'bound' and mnemonic == 'movl':
+                    fact = ('bound', fact[1], 64)
+        elif mnemonic == 'leaq' and len(operands) == 2:
+            source = operands[0]
+            match = rip_pattern.fullmatch(source)
+            if match is not None and match.group(2) is None and match.group(1) not in redirected:
+                label = match.group(1)
+                entries = data.jump_table(label, code)
+                if entries is not None:
+                    fact = ('table', label, entries)
+                elif label in code:
+                    fact = ('code', label)
+            else:
+                match = address_pattern.fullmatch(source)
+                if (match is not None and match.group(1) in ('', '0') and match.group(2) is None
+                        and match.group(4) == '4'):
+                    index = fact_of(match.group(3))
+                    if index is not None and index[0] == 'bound' and index[2] == 64:
+                        fact = ('scaled', index[1])
+        elif mnemonic == 'addq' and len(operands) == 2:
+            source, current = fact_of(operands[0]), fact_of(dest)
+            if source is not None and current is not None:
+                table, offset = (source, current) if source[0] == 'table' else (current, source)
+                if table[0] == 'table' and offset[0] == 'entry' and offset[2] == 64 and offset[1] == table[1]:
+                    fact = ('code', f"jump table {table[1]}")
+
+        # Drop what the instruction overwrites
+        effects = instruction_effects(mnemonic, operands)
+        if effects is None or mnemonic.startswith(('xchg', 'xadd', 'cmpxchg')):
+            facts.clear()
+            slots.clear()
+            continue
+        for register in list(facts):
+            if effects[1] & gpr_bits[register]:
+                del facts[register]
+        written = full_register(dest) if dest is not None else None
+        if written is not None:
+            facts.pop(written, None)
+        stores = stored_operands(mnemonic, operands)
+        if stores or mnemonic.startswith(('push', 'pop')):
+            slots.clear()
+            if stores and slots_private and mnemonic in ('movl', 'movq') and full_register(operands[0]) is not None:
+                source = fact_of(operands[0])
+                width = 64 if mnemonic == 'movq' else 32
+                if source is not None and slot_range(dest, width) is not None:
+                    slots[dest] = (source, width)
+        if fact is not None and written is not None:
+            facts[written] = fact
+    return resolved
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import os
+import shlex
+import subprocess
+import sys
+from pathlib import Path
+
+# Drop-in C compiler for XFI builds (CC=.../asm_rewriter/xfi_cc.py): every
+# compilation of C sources to objects (-c) is rewritten on the way, without a
+# file in between:
+#   $XFI_CC <flags> -S -o - src.c  ->  rewriter, in memory  ->  as -o src.o
+# with the assembler options the driver itself would use. The symbols come from
+# the assembly (the asm backend). Any other invocation (linking, preprocessing,
+# configure probes, other languages) runs $XFI_CC as it is. Every object it
+# compiles is instrumented, so the programs linked from them need the XFI
+# runtime (input/xfi.c), as after the Rewrite step of xfi.sh.
+#   XFI_CC            compiler driver (default gcc, e.g. musl-gcc)
+#   XFI_REWRITE_ARGS  main.py options of the rewriting (e.g. "--addressing gs");
+#                     the log level defaults to WARNING
+
+c_suffixes = ('.c', '.i')
+# Options whose value is the next argument
+value_options = {'-o', '-x', '-I', '-D', '-U', '-include', '-imacros', '-iquote', '-isystem', '-idirafter',
+                 '-iprefix', '-iwithprefix', '-iwithprefixbefore', '-isysroot', '-imultilib', '-MF', '-MT', '-MQ',
+                 '-L', '-l', '-T', '-u', '-z', '-e', '-Xlinker', '-Xassembler', '-Xpreprocessor', '-aux-info', '--param'}
+# Options after which the compiler does not make an object
+stop_options = {'-S', '-E', '-M', '-MM', '-fsyntax-only', '-###'}
+
+# (sources, output, flags) of a compilation of C sources to objects, the flags
+# without -c, -o and the sources; None for any other invocation
+def compile_job(argv):
+    if '-c' not in argv or stop_options.intersection(argv):
+        return None
+    sources = []
+    flags = []
+    output = None
+    args = iter(argv)
+    for arg in args:
+        if arg in value_options:
+            value = next(args, None)
+            if value is None or arg == '-x':
+                return None
+            if arg == '-o':
+                output = value
+            else:
+                flags += [arg, value]
+        elif arg.startswith('-x'):
+            return None # Language given explicitly
+        elif arg.startswith('-o'):
+            output = arg[2:]
+        elif arg.startswith('-') and arg != '-':
+            if arg != '-c':
+                flags.append(arg)
+        else:
+            sources.append(arg)
+    if not sources or not all(source.endswith(c_suffixes) for source in sources):
+        return None
+    if output is not None and len(sources) > 1:
+        return None # The compiler reports it
+    return sources, output, flags
+
+# With -S -o -, -MD/-MMD would write -.d with the target -; they get the ones
+# of a compilation to obj
+def dependency_flags(flags, obj):
+    if '-MD' not in flags and '-MMD' not in flags:
+        return []
+    extra = []
+    if not any(flag.startswith('-MF') for flag in flags):
+        extra += ['-MF', str(Path(obj).with_suffix('.d'))]
+    if not any(flag.startswith(('-MT', '-MQ')) for flag in flags):
+        extra += ['-MT', obj]
+    return extra
+
+# The assembler command the driver runs to make obj of source, reading the
+# assembly from stdin instead of the file the compiler proper writes
+def assembler_command(cc, flags, source, obj):
+    dry_run = subprocess.run([*cc, '-###', *flags, '-c', source, '-o', obj], stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, encoding='utf-8')
+    outputs = []
+    for line in dry_run.stderr.splitlines():
+        if not line.startswith(' '):
+            continue
+        command = shlex.split(line)
+        if '-o' not in command:
+            continue
+        output = command[command.index('-o') + 1]
+        if output == obj and outputs and outputs[-1] in command:
+            command.remove(outputs[-1])
+            return command
+        outputs.append(output)
+    raise RuntimeError(f"No assembler command in the output of {shlex.join([*cc, '-###'])}")
+
+def compile_source(cc, source, obj, flags, options):
+    # Imported here: the invocations passed through do not load the rewriter
+    from asm_analysis import analyze_lines
+    from bin_analysis import process_binary
+    from rewriter import rewrite_lines
+    from run_stats import FileStats
+
+    flags = flags + dependency_flags(flags, obj)
+    compiler = subprocess.run([*cc, *flags, '-S', '-o', '-', source], stdout=subprocess.PIPE, encoding='utf-8')
+    if compiler.returncode != 0:
+        return compiler.returncode
+    lines = compiler.stdout.splitlines(keepends=True)
+    stats = FileStats(Path(source).stem)
+    patch_plan = analyze_lines(lines, process_binary(lines, "asm"), stats)
+    assembler = subprocess.Popen(assembler_command(cc, flags, source, obj), stdin=subprocess.PIPE, encoding='utf-8')
+    try:
+        with assembler.stdin:
+            rewrite_lines(lines, assembler.stdin, obj, patch_plan, options, stats)
+    except BrokenPipeError:
+        pass # The assembler stopped early, its status tells why
+    except BaseException:
+        assembler.kill()
+        assembler.wait()
+        Path(obj).unlink(missing_ok=True)
+        raise
+    return assembler.wait()
+
+def rewrite_compile(cc, sources, output, flags):
+    from main import get_logger, configure_logging, build_parser, log_level, rewrite_options
+
+    parser = build_parser()
+    parser.set_defaults(log_level='WARNING')
+    args = parser.parse_args(shlex.split(os.environ.get("XFI_REWRITE_ARGS", "")))
+    configure_logging(log_level(args), args.log_file)
+    options = rewrite_options(args)
+    for source in sources:
+        obj = output or Path(source).with_suffix('.o').name
+        try:
+            status = compile_source(cc, source, obj, flags, options)
+        except Exception as e:
+            get_logger().error("%s: %s: %s", source, type(e).__name__, e)
+            status = 1
+        if status != 0:
+            return status
+    return 0
+
+def main():
+    cc = shlex.split(os.environ.get("XFI_CC", "gcc"))
+    argv = sys.argv[1:]
+    job = compile_job(argv)
+    if job is None:
+        os.execvp(cc[0], cc + argv)
+    return rewrite_compile(cc, *job)
+
+if __name__ == '__main__':
+    sys.exit(main())
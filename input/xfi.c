@@ -6,14 +6,44 @@
 #include <unistd.h>
 #include <string.h>
 #include <elf.h>
+#include <stdint.h>
+#include <sys/auxv.h>
+#include <sys/ioctl.h>
+#include <sys/syscall.h>
+#include <linux/userfaultfd.h>
+#include <pthread.h>
+#include <time.h>
+#include <errno.h>
 #include <immintrin.h>
 
 #define PAGE_SIZE 4096
+#define HUGE_PAGE_SIZE (2 * 1024 * 1024)
 
 void *xfi_base_address = NULL;  // Global variable to store base address
 void *xfi_mmap_base_address = NULL; // Base address for mmap
 size_t xfi_size = 0;            // Global variable to store size of the mapped region
 void *text_section_end = NULL;  // Global variable to store end address of .text section
+const char *xfi_backing = "4 KB pages"; // Page size backing the region
+
+// %gs: addressing mode of the rewriter (--addressing gs): the rewritten code
+// defines xfi_gs_addressing and compares control-flow targets against
+// xfi_text_bound, the offset of the end of .text from the load base
+extern const char xfi_gs_addressing __attribute__((weak));
+unsigned long xfi_text_bound = 0;
+
+// Load base of the executable: where its program headers are mapped, minus
+// their link-time address
+uintptr_t executable_load_base() {
+    Elf64_Phdr *phdr = (Elf64_Phdr *)getauxval(AT_PHDR);
+    unsigned long phnum = getauxval(AT_PHNUM);
+    for (unsigned long i = 0; i < phnum; i++) {
+        if (phdr[i].p_type == PT_PHDR) {
+            return (uintptr_t)phdr - phdr[i].p_vaddr;
+        }
+    }
+    // No PT_PHDR: the program headers follow the ELF header of the first page
+    return ((uintptr_t)phdr - sizeof(Elf64_Ehdr)) & ~(uintptr_t)(PAGE_SIZE - 1);
+}
 
 unsigned long long get_section_offset(const char *filename, const char *section_name) {
     int fd = open(filename, O_RDONLY);
@@ -85,159 +115,422 @@ void print_section_content(void *address, size_t size) {
     }
 }
 
-void map_section(int fd, Elf64_Shdr *shdr, const char *section_name, void *base_address) {
-    // void *buffer = malloc(shdr->sh_size);
-    // if (buffer == NULL) {
-    //     perror("Failed to allocate buffer");
-    //     return;
-    // }
-    void *buffer = NULL;
-
-    // if (pread(fd, buffer, shdr->sh_size, shdr->sh_offset) != shdr->sh_size) {
-    //     perror("Failed to read section content");
-    //     free(buffer);
-    //     return;
-    // }
-
-    if (strcmp(section_name, ".bss") == 0) {
-        // For .bss section, allocate and zero-initialize memory
-        buffer = calloc(1, shdr->sh_size);
-        if (buffer == NULL) {
-            perror("Failed to allocate buffer for .bss section");
-            return;
-        }
+// Sections copied into the sandbox, at their link-time address from the region start
+const char *sandbox_sections[] = {".rodata", ".data", ".text", ".bss"};
+#define SANDBOX_SECTIONS (sizeof(sandbox_sections) / sizeof(sandbox_sections[0]))
+
+// Places a section in the region. File-backed sections are mapped privately
+// from the executable (their file offset and address agree modulo the page
+// size in any linked executable); with copy, when the offsets disagree or if
+// the mapping fails, they are read straight into the region. .bss is left to
+// the anonymous zero pages of the region, except for the part sharing a page
+// with file-backed contents.
+void map_section(int fd, Elf64_Shdr *shdr, const char *section_name, void *base_address, int copy) {
+    uintptr_t section_offset = (uintptr_t)shdr->sh_addr;
+    void *new_address = base_address + section_offset;
+    printf("Base address: %p, Section address: %p\n", base_address, new_address);
+
+    if (shdr->sh_type == SHT_NOBITS) {
+        // Up to the next page boundary the region may hold the file contents
+        // that follow the previous section
+        size_t tail = PAGE_SIZE - ((uintptr_t)new_address & (PAGE_SIZE - 1));
+        memset(new_address, 0, tail < shdr->sh_size ? tail : shdr->sh_size);
     } else {
-        // For other sections, read the content from the file
-        buffer = malloc(shdr->sh_size);
-        if (buffer == NULL) {
-            perror("Failed to allocate buffer");
-            return;
+        size_t page_offset = shdr->sh_offset & (PAGE_SIZE - 1);
+        void *mapped = MAP_FAILED;
+        if (!copy && (section_offset & (PAGE_SIZE - 1)) == page_offset) {
+            mapped = mmap(new_address - page_offset, shdr->sh_size + page_offset, PROT_READ | PROT_WRITE | PROT_EXEC,
+                          MAP_PRIVATE | MAP_FIXED, fd, shdr->sh_offset - page_offset);
+            if (mapped == MAP_FAILED) {
+                perror("Failed to map section, reading it instead");
+            }
+        }
+        if (mapped == MAP_FAILED) {
+            if (pread(fd, new_address, shdr->sh_size, shdr->sh_offset) != shdr->sh_size) {
+                perror("Failed to read section content");
+                return;
+            }
         }
+    }
+}
 
-        if (pread(fd, buffer, shdr->sh_size, shdr->sh_offset) != shdr->sh_size) {
+// Lazy population (XFI_LAZY set in the environment): the region is registered
+// with userfaultfd and a handler thread fills each page from the executable
+// the first time it is touched, instead of placing every section up front.
+// Before a fork every remaining page is filled and the region unregistered,
+// since the child has no handler.
+int xfi_uffd = -1;
+int xfi_lazy_fd = -1;           // Executable, read by the handler
+void *xfi_lazy_region = NULL;
+Elf64_Shdr *xfi_lazy_sections = NULL;
+size_t xfi_lazy_count = 0;
+unsigned long xfi_pages_populated = 0;
+
+// Contents of the region page at page: the bytes of the file-backed sections
+// overlapping it, zeros elsewhere. Returns 0 once the page is present.
+int fill_page(void *page) {
+    char buffer[PAGE_SIZE];
+    uintptr_t start = (uintptr_t)page - (uintptr_t)xfi_lazy_region;
+    memset(buffer, 0, PAGE_SIZE);
+    for (size_t i = 0; i < xfi_lazy_count; i++) {
+        Elf64_Shdr *shdr = &xfi_lazy_sections[i];
+        if (shdr->sh_type == SHT_NOBITS) {
+            continue;
+        }
+        uintptr_t from = shdr->sh_addr > start ? shdr->sh_addr : start;
+        uintptr_t to = shdr->sh_addr + shdr->sh_size < start + PAGE_SIZE ? shdr->sh_addr + shdr->sh_size : start + PAGE_SIZE;
+        if (from < to && pread(xfi_lazy_fd, buffer + (from - start), to - from, shdr->sh_offset + (from - shdr->sh_addr)) != to - from) {
             perror("Failed to read section content");
-            free(buffer);
-            return;
         }
     }
-    // uintptr_t section_offset = (uintptr_t)shdr->sh_offset;
-    // uintptr_t section_offset = (uintptr_t)shdr->sh_size;
-    uintptr_t section_offset = (uintptr_t)shdr->sh_addr;
+    struct uffdio_copy copy = {.dst = (uintptr_t)page, .src = (uintptr_t)buffer, .len = PAGE_SIZE, .mode = 0};
+    if (ioctl(xfi_uffd, UFFDIO_COPY, &copy) == -1) {
+        // EEXIST: already populated (fill_all_pages racing with a fault)
+        return errno == EEXIST ? 0 : -1;
+    }
+    __atomic_fetch_add(&xfi_pages_populated, 1, __ATOMIC_RELAXED);
+    return 0;
+}
 
-    void *new_address = base_address + section_offset;
-    printf("Base address: %p, Section address: %p\n", base_address, new_address);
+void *lazy_handler(void *arg) {
+    struct uffd_msg msg;
+    while (read(xfi_uffd, &msg, sizeof(msg)) == sizeof(msg)) {
+        if (msg.event != UFFD_EVENT_PAGEFAULT) {
+            continue;
+        }
+        void *page = (void *)(uintptr_t)(msg.arg.pagefault.address & ~(uint64_t)(PAGE_SIZE - 1));
+        if (fill_page(page) == -1) {
+            perror("Failed to populate sandbox page");
+        }
+    }
+    return NULL;
+}
 
-    if ((char *)new_address + shdr->sh_size > (char *)base_address + 1024 * 1024) {
-        fprintf(stderr, "Section %s exceeds allocated memory space\n", section_name);
-        free(buffer);
+void fill_all_pages() {
+    if (xfi_uffd == -1) {
         return;
     }
-    
-    memcpy(new_address, buffer, shdr->sh_size);
-    // printf("Section %s mapped at %p, offset %lx, size %lx, aligned at %p, ends at %p\n", section_name, new_address, (long)shdr->sh_offset, (long)shdr->sh_size, new_address, (new_address +(long)shdr->sh_size));
-    if (strcmp(section_name, ".text") == 0) {
-        text_section_end = new_address + shdr->sh_size;
+    for (size_t offset = 0; offset < xfi_size; offset += PAGE_SIZE) {
+        fill_page((char *)xfi_lazy_region + offset);
     }
+    struct uffdio_range range = {.start = (uintptr_t)xfi_lazy_region, .len = xfi_size};
+    if (ioctl(xfi_uffd, UFFDIO_UNREGISTER, &range) == -1) {
+        perror("Failed to unregister the sandbox region");
+    }
+}
 
-
-    free(buffer);
+// Registers region for lazy population with the given sections. Returns 0, or
+// -1 if userfaultfd is not available, in which case nothing was changed.
+int lazy_sections(int fd, Elf64_Shdr **sections, size_t count, void *region) {
+    // Kernel accesses (system calls on sandboxed buffers) must fault to the
+    // handler too, so no UFFD_USER_MODE_ONLY
+    int uffd = syscall(SYS_userfaultfd, O_CLOEXEC);
+    if (uffd == -1) {
+        perror("userfaultfd unavailable, populating the sandbox eagerly");
+        return -1;
+    }
+    struct uffdio_api api = {.api = UFFD_API, .features = 0};
+    struct uffdio_register reg = {.range = {.start = (uintptr_t)region, .len = xfi_size}, .mode = UFFDIO_REGISTER_MODE_MISSING};
+    if (ioctl(uffd, UFFDIO_API, &api) == -1 || ioctl(uffd, UFFDIO_REGISTER, &reg) == -1) {
+        perror("Failed to register the sandbox region, populating it eagerly");
+        close(uffd);
+        return -1;
+    }
+    xfi_lazy_sections = malloc(count * sizeof(Elf64_Shdr));
+    if (!xfi_lazy_sections) {
+        perror("Failed to allocate the lazy section table, populating the sandbox eagerly");
+        close(uffd);
+        return -1;
+    }
+    xfi_lazy_fd = dup(fd);
+    xfi_uffd = uffd;
+    xfi_lazy_region = region;
+    xfi_lazy_count = count;
+    for (size_t i = 0; i < count; i++) {
+        xfi_lazy_sections[i] = *sections[i];
+    }
+    pthread_t thread;
+    if (pthread_create(&thread, NULL, lazy_handler, NULL) != 0) {
+        perror("Failed to start the sandbox page handler, populating it eagerly");
+        fill_all_pages();
+        close(xfi_lazy_fd);
+        close(uffd);
+        xfi_uffd = -1;
+        return 0;
+    }
+    pthread_detach(thread);
+    pthread_atfork(fill_all_pages, NULL, NULL);
+    return 0;
 }
 
-void map_process(const char* filename, void *base_address) {
+// Reserves the region at base_address, sized to the furthest end of the
+// sandbox sections, and places the sections in it. Returns the region or MAP_FAILED.
+void *map_process(const char* filename, void *base_address) {
     int fd = open(filename, O_RDONLY);
     if (fd < 0) {
         perror("Failed to open file");
-        return;
+        return MAP_FAILED;
     }
 
     Elf64_Ehdr ehdr;
     if (pread(fd, &ehdr, sizeof(ehdr), 0) != sizeof(ehdr)) {
         perror("Failed to read ELF header");
         close(fd);
-        return;
+        return MAP_FAILED;
     }
 
     if (memcmp(ehdr.e_ident, ELFMAG, SELFMAG) != 0) {
         fprintf(stderr, "Not an ELF file\n");
         close(fd);
-        return;
+        return MAP_FAILED;
     }
 
-    Elf64_Shdr shstrtab_hdr;
-    if (pread(fd, &shstrtab_hdr, sizeof(shstrtab_hdr), ehdr.e_shoff + ehdr.e_shstrndx * sizeof(Elf64_Shdr)) != sizeof(Elf64_Shdr)) {
-        perror("Failed to read section header string table header");
+    Elf64_Shdr *shdrs = malloc(ehdr.e_shnum * sizeof(Elf64_Shdr));
+    if (!shdrs) {
+        perror("Failed to allocate memory for section headers");
         close(fd);
-        return;
+        return MAP_FAILED;
     }
 
-    char *shstrtab = malloc(shstrtab_hdr.sh_size);
+    if (pread(fd, shdrs, ehdr.e_shnum * sizeof(Elf64_Shdr), ehdr.e_shoff) != ehdr.e_shnum * sizeof(Elf64_Shdr)) {
+        perror("Failed to read section headers");
+        free(shdrs);
+        close(fd);
+        return MAP_FAILED;
+    }
+
+    Elf64_Shdr *shstrtab_hdr = &shdrs[ehdr.e_shstrndx];
+    char *shstrtab = malloc(shstrtab_hdr->sh_size);
     if (!shstrtab) {
         perror("Failed to allocate memory for section header string table");
+        free(shdrs);
         close(fd);
-        return;
+        return MAP_FAILED;
     }
 
-    if (pread(fd, shstrtab, shstrtab_hdr.sh_size, shstrtab_hdr.sh_offset) != shstrtab_hdr.sh_size) {
+    if (pread(fd, shstrtab, shstrtab_hdr->sh_size, shstrtab_hdr->sh_offset) != shstrtab_hdr->sh_size) {
         perror("Failed to read section header string table");
         free(shstrtab);
+        free(shdrs);
         close(fd);
-        return;
+        return MAP_FAILED;
     }
 
-    // Map each section to the new address
-    for (int i = 0; i < ehdr.e_shnum; i++) {
-        Elf64_Shdr shdr;
-        off_t shdr_offset = ehdr.e_shoff + i * sizeof(shdr);
-        if (pread(fd, &shdr, sizeof(shdr), shdr_offset) != sizeof(shdr)) {
-            perror("Failed to read section header");
-            continue;
+    // Sandbox sections in header order, file-backed ones first so that .bss
+    // is cleared after whatever page it shares with them. A name can be on
+    // several sections (.text output sections the linker script left out of
+    // the sandbox .text), so every header may match.
+    Elf64_Shdr **sections = malloc(ehdr.e_shnum * sizeof(Elf64_Shdr *));
+    if (!sections) {
+        perror("Failed to allocate memory for the sandbox section list");
+        free(shstrtab);
+        free(shdrs);
+        close(fd);
+        return MAP_FAILED;
+    }
+    size_t count = 0;
+    size_t extent = 0;
+    for (int nobits = 0; nobits <= 1; nobits++) {
+        for (int i = 0; i < ehdr.e_shnum; i++) {
+            const char *section_name = shstrtab + shdrs[i].sh_name;
+            if ((shdrs[i].sh_type == SHT_NOBITS) != nobits) {
+                continue;
+            }
+            for (size_t j = 0; j < SANDBOX_SECTIONS; j++) {
+                if (strcmp(section_name, sandbox_sections[j]) == 0) {
+                    sections[count++] = &shdrs[i];
+                    if (shdrs[i].sh_addr + shdrs[i].sh_size > extent) {
+                        extent = shdrs[i].sh_addr + shdrs[i].sh_size;
+                    }
+                    break;
+                }
+            }
         }
+    }
 
-        const char *section_name = shstrtab + shdr.sh_name;
+    // Map new memory space, large enough for every section and in whole huge
+    // pages. The rewriter's mask recovers base_address from any address of the
+    // region, which only holds while the region is smaller than its alignment.
+    xfi_size = (extent + HUGE_PAGE_SIZE - 1) & ~(size_t)(HUGE_PAGE_SIZE - 1);
+    if (xfi_size >= ((uintptr_t)base_address & -(uintptr_t)base_address)) {
+        fprintf(stderr, "Sandbox of %zu bytes does not fit below the alignment of %p\n", xfi_size, base_address);
+        free(sections);
+        free(shstrtab);
+        free(shdrs);
+        close(fd);
+        xfi_size = 0;
+        return MAP_FAILED;
+    }
 
-        if (strcmp(section_name, ".rodata") == 0 || strcmp(section_name, ".data") == 0 || strcmp(section_name, ".text") == 0 || strcmp(section_name, ".bss") == 0) {
-            map_section(fd, &shdr, section_name, base_address);
+    // Huge pages (XFI_HUGEPAGES=thp or hugetlb) need the sections in anonymous
+    // memory, so they are read in instead of mapped from the file. Otherwise
+    // only the anonymous parts of the region (.bss, gaps) can get huge pages.
+    const char *huge = getenv("XFI_HUGEPAGES");
+    int copy = huge != NULL;
+    void *region = MAP_FAILED;
+    if (huge != NULL && strcmp(huge, "hugetlb") == 0) {
+        region = mmap(base_address, xfi_size, PROT_READ | PROT_WRITE | PROT_EXEC,
+                      MAP_PRIVATE | MAP_ANONYMOUS | MAP_FIXED | MAP_HUGETLB, -1, 0);
+        if (region == MAP_FAILED) {
+            perror("MAP_HUGETLB failed, falling back to transparent huge pages");
+        } else {
+            xfi_backing = "hugetlb 2 MB pages";
+        }
+    }
+    if (region == MAP_FAILED) {
+        region = mmap(base_address, xfi_size, PROT_READ | PROT_WRITE | PROT_EXEC, MAP_PRIVATE | MAP_ANONYMOUS | MAP_FIXED, -1, 0);
+        if (region != MAP_FAILED) {
+            if (madvise(region, xfi_size, MADV_HUGEPAGE) == 0) {
+                xfi_backing = "transparent huge pages";
+            } else {
+                perror("MADV_HUGEPAGE failed, using 4 KB pages");
+            }
+        }
+    }
+    if (region == MAP_FAILED) {
+        perror("Failed to allocate new memory space");
+        xfi_size = 0;
+    } else {
+        printf("Sandbox region: %p, %zu bytes, %s%s\n", region, xfi_size, xfi_backing,
+               copy ? "" : " (anonymous parts only)");
+        for (size_t i = 0; i < count; i++) {
+            void *end = region + sections[i]->sh_addr + sections[i]->sh_size;
+            if (strcmp(shstrtab + sections[i]->sh_name, ".text") == 0 && end > text_section_end) {
+                text_section_end = end;
+            }
+        }
+        // Lazy population fills 4 KB pages, so it does not combine with huge pages
+        if (getenv("XFI_LAZY") == NULL || copy || lazy_sections(fd, sections, count, region) == -1) {
+            // Map each section to the new address
+            for (size_t i = 0; i < count; i++) {
+                map_section(fd, sections[i], shstrtab + sections[i]->sh_name, region, copy);
+            }
         }
     }
 
+    free(sections);
     free(shstrtab);
+    free(shdrs);
     close(fd);
+    return region;
 }
 
 void __attribute__((constructor)) create_xfi() {
     printf("Loading process...\n");
+    struct timespec start, end;
+    clock_gettime(CLOCK_MONOTONIC, &start);
     char binary_path[1024];
     ssize_t len = readlink("/proc/self/exe", binary_path, sizeof(binary_path) - 1);
     if (len != -1) {
         binary_path[len] = '\0';
-        // Determine the size required for the new memory space
-        xfi_size = 1024 * 1024; // 1MB, adjust as necessary
-
         // Request specific base address for new memory space
         xfi_mmap_base_address = (void *)0x100000000000;
 
-        // Map new memory space
-        xfi_base_address = mmap(xfi_mmap_base_address, xfi_size, PROT_READ | PROT_WRITE | PROT_EXEC, MAP_PRIVATE | MAP_ANONYMOUS | MAP_FIXED, -1, 0);
+        // Map the process data; the region is sized from its sections
+        xfi_base_address = map_process(binary_path, xfi_mmap_base_address);
         if (xfi_base_address == MAP_FAILED) {
-            perror("Failed to allocate new memory space");
             return;
         }
-        
-        // Map the process data
-        map_process(binary_path, xfi_base_address);
-        if (text_section_end != NULL) {
-            xfi_base_address = text_section_end;
+        if (&xfi_gs_addressing != NULL) {
+            // Sections sit at the same offset from the region as from the load
+            // base, so with the GS base at the difference %gs:addr reaches the
+            // sandbox copy of addr
+            if (text_section_end != NULL) {
+                xfi_text_bound = (char *)text_section_end - (char *)xfi_mmap_base_address;
+            }
+            _writegsbase_u64((uintptr_t)xfi_mmap_base_address - executable_load_base());
+            printf("GS base set to the sandbox delta %p\n", (void *)_readgsbase_u64());
+        } else {
+            if (text_section_end != NULL) {
+                xfi_base_address = text_section_end;
+            }
+            _writegsbase_u64((long long unsigned int)xfi_base_address);
         }
-        _writegsbase_u64((long long unsigned int)xfi_base_address);
         printf("New memory space allocated at %p\n", xfi_base_address);
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        printf("Sandbox set up in %.3f ms (%s)\n", (end.tv_sec - start.tv_sec) * 1e3 + (end.tv_nsec - start.tv_nsec) / 1e6,
+               xfi_uffd != -1 ? "lazy" : "eager");
     } else {
         perror("Failed to get binary path");
     }
 }
 
+// Execution counters of a program rewritten with --profile: every rewritten
+// file registers its block from .init_array (profile_text in
+// asm_rewriter/src/rewriter.py). The increments are not atomic, so counts of
+// threaded programs are approximate.
+struct xfi_site_counts {
+    struct xfi_site_counts *next;
+    const char *file;
+    unsigned long count;
+    unsigned long hits[];
+};
+struct xfi_site_counts *xfi_profiles = NULL;
+
+void xfi_profile_register(struct xfi_site_counts *counts) {
+    counts->next = xfi_profiles;
+    xfi_profiles = counts;
+}
+
+// Appends the executed sites to XFI_PROFILE (default xfi_profile.txt), one
+// "site count" line each under the "file name sites" line of their file, so
+// several runs (and forked children) add up in the same dump
+void dump_profile() {
+    const char *path = getenv("XFI_PROFILE");
+    if (path == NULL) {
+        path = "xfi_profile.txt";
+    }
+    FILE *out = fopen(path, "a");
+    if (out == NULL) {
+        perror("Failed to open the site profile");
+        return;
+    }
+    fprintf(out, "# xfi site profile, pid %d\n", getpid());
+    for (struct xfi_site_counts *counts = xfi_profiles; counts != NULL; counts = counts->next) {
+        fprintf(out, "file %s %lu\n", counts->file, counts->count);
+        for (unsigned long i = 0; i < counts->count; i++) {
+            if (counts->hits[i] != 0) {
+                fprintf(out, "%lu %lu\n", i, counts->hits[i]);
+            }
+        }
+    }
+    fclose(out);
+    printf("Site profile appended to %s\n", path);
+}
+
+// Transparent huge pages backing the region, in kB
+unsigned long region_huge_kb() {
+    FILE *smaps = fopen("/proc/self/smaps", "r");
+    if (smaps == NULL) {
+        return 0;
+    }
+    char line[256];
+    int inside = 0;
+    unsigned long total = 0, start, end, kb;
+    while (fgets(line, sizeof(line), smaps) != NULL) {
+        if (sscanf(line, "%lx-%lx ", &start, &end) == 2) {
+            inside = start >= (uintptr_t)xfi_mmap_base_address && end <= (uintptr_t)xfi_mmap_base_address + xfi_size;
+        } else if (inside && sscanf(line, "AnonHugePages: %lu kB", &kb) == 1) {
+            total += kb;
+        }
+    }
+    fclose(smaps);
+    return total;
+}
+
 void __attribute__((destructor)) cleanup_xfi() {
+    if (xfi_profiles != NULL) {
+        dump_profile();
+    }
+    if (xfi_uffd != -1) {
+        printf("Sandbox pages populated on demand: %lu of %zu\n",
+               __atomic_load_n(&xfi_pages_populated, __ATOMIC_RELAXED), xfi_size / PAGE_SIZE);
+    }
     // Perform cleanup by unmapping the allocated memory space
     if (xfi_mmap_base_address != NULL && xfi_size > 0) {
+        if (strcmp(xfi_backing, "transparent huge pages") == 0) {
+            printf("Sandbox transparent huge pages: %lu kB\n", region_huge_kb());
+        }
         if (munmap(xfi_mmap_base_address, xfi_size) == -1) {
             perror("Failed to unmap memory");
         } else {